@@ -0,0 +1,272 @@
+from io import BytesIO
+from listing import merge
+from requests.adapters import BaseAdapter
+from requests.models import PreparedRequest, Response
+from requests.structures import CaseInsensitiveDict
+from typing import Dict, Iterator, List, Optional
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+# the attributes of a PRAW submission that the pipeline reads
+SUBMISSION_FIELDS = [
+    "id",
+    "url",
+    "permalink",
+    "title",
+    "created_utc",
+    "score",
+    "media_metadata",
+    "preview",
+]
+# kinds of listing requests, see listing.fetch_deeper
+HOT = "hot"
+HOT_NEXT = "hot/next"
+RISING = "rising"
+
+
+class Archive:
+    """
+    Directory that holds what a run fetched from Reddit and the image
+    hosts, so that the run can be replayed without them. Listings are
+    appended to listings.jsonl, one request per line, and image bytes are
+    stored under images/, named by the hash of their URL.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(path, "images"), exist_ok=True)
+
+    def record_listing(self, subs: str, kind: str, limit: int, submissions: List):
+        entry = {
+            "ts": time.time(),
+            "subs": subs,
+            "kind": kind,
+            "limit": limit,
+            "submissions": [to_record(s) for s in submissions],
+        }
+        line = json.dumps(entry)
+        with self.lock:
+            with open(os.path.join(self.path, "listings.jsonl"), "a") as f:
+                f.write(line + "\n")
+
+    def store_image(self, url: str, data: bytes):
+        with open(self.image_path(url), "wb") as f:
+            f.write(data)
+
+    def load_image(self, url: str) -> Optional[bytes]:
+        path = self.image_path(url)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def image_path(self, url: str) -> str:
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.path, "images", name)
+
+    def runs(self) -> Iterator[List[Dict]]:
+        """
+        Group the recorded listings by the run that fetched them. A run
+        fetches each listing at most once, so a listing that repeats
+        starts the next run.
+        @return the listing entries of each run, in the order recorded
+        """
+        path = os.path.join(self.path, "listings.jsonl")
+        if not os.path.exists(path):
+            return
+        run: List[Dict] = []
+        fetched = set()
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                key = (entry["subs"], entry["kind"])
+                if key in fetched:
+                    yield run
+                    run, fetched = [], set()
+                run.append(entry)
+                fetched.add(key)
+        if len(run) > 0:
+            yield run
+
+
+def to_record(submission) -> Dict:
+    # read from the instance dictionary, so that PRAW doesn't fetch the
+    # whole submission again for an attribute it doesn't have
+    attrs = vars(submission)
+    record = {field: attrs.get(field) for field in SUBMISSION_FIELDS}
+    record["author"] = getattr(attrs.get("author"), "name", None)
+    return record
+
+
+class RecordingReddit:
+    """
+    Wraps a PRAW Reddit client, and records every listing that is fetched
+    through it. Only the calls made by listing.py are supported.
+    """
+
+    def __init__(self, reddit, archive: Archive):
+        self.reddit = reddit
+        self.archive = archive
+
+    def subreddit(self, subs: str) -> "RecordingSubreddit":
+        return RecordingSubreddit(self.reddit.subreddit(subs), subs, self.archive)
+
+
+class RecordingSubreddit:
+    def __init__(self, subreddit, subs: str, archive: Archive):
+        self.subreddit = subreddit
+        self.subs = subs
+        self.archive = archive
+
+    def hot(self, limit: int, params: Optional[Dict] = None) -> Iterator:
+        if params is None:
+            return self._record(HOT, limit, self.subreddit.hot(limit=limit))
+        listing = self.subreddit.hot(limit=limit, params=params)
+        return self._record(HOT_NEXT, limit, listing)
+
+    def rising(self, limit: int) -> Iterator:
+        return self._record(RISING, limit, self.subreddit.rising(limit=limit))
+
+    def top(self, time_filter: str, limit: int) -> Iterator:
+        listing = self.subreddit.top(time_filter=time_filter, limit=limit)
+        return self._record(f"top/{time_filter}", limit, listing)
+
+    def _record(self, kind: str, limit: int, listing) -> Iterator:
+        submissions = list(listing)
+        self.archive.record_listing(self.subs, kind, limit, submissions)
+        return iter(submissions)
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    Transport adapter that stores the body of every successful GET request
+    in the archive, on top of another adapter that does the actual request.
+    """
+
+    def __init__(self, adapter: BaseAdapter, archive: Archive):
+        super().__init__()
+        self.adapter = adapter
+        self.archive = archive
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        res = self.adapter.send(request, **kwargs)
+        if request.method == "GET" and res.status_code == 200:
+            # reads the whole body, which the caller can still stream
+            self.archive.store_image(request.url, res.content)
+        return res
+
+    def close(self):
+        self.adapter.close()
+
+
+def record_session(session, archive: Archive):
+    """
+    Record the images downloaded with the session, keeping whatever
+    retries and pooling its adapters are already configured with.
+    """
+    for prefix, adapter in list(session.adapters.items()):
+        session.mount(prefix, RecordingAdapter(adapter, archive))
+
+
+class ReplayAuthor:
+    def __init__(self, name: Optional[str]):
+        self.name = name
+
+
+class ReplaySubmission:
+    # looks enough like a PRAW submission for FoodPost.from_submission
+    def __init__(self, record: Dict):
+        for field in SUBMISSION_FIELDS:
+            setattr(self, field, record.get(field))
+        self.author = ReplayAuthor(record.get("author"))
+
+
+class ReplayReddit:
+    """
+    Stands in for a PRAW Reddit client, serving the listings of one
+    recorded run at a time. Listings that weren't recorded are empty.
+    """
+
+    def __init__(self):
+        self.listings: Dict = {}
+
+    def load(self, run: List[Dict]):
+        self.listings = {
+            (entry["subs"], entry["kind"]): entry["submissions"] for entry in run
+        }
+
+    def subreddit(self, subs: str) -> "ReplaySubreddit":
+        return ReplaySubreddit(self, subs)
+
+
+class ReplaySubreddit:
+    def __init__(self, reddit: ReplayReddit, subs: str):
+        self.reddit = reddit
+        self.subs = subs
+
+    def hot(self, limit: int, params: Optional[Dict] = None) -> Iterator:
+        # the next page is served from what comes after the cursor, so
+        # that a run can be replayed with a smaller limit than recorded
+        listing = merge([self._listing(HOT) + self._listing(HOT_NEXT)])
+        start = 0
+        if params is not None and "after" in params:
+            ids = [f"t3_{s.id}" for s in listing]
+            after = params["after"]
+            start = ids.index(after) + 1 if after in ids else len(listing)
+        return iter(listing[start : start + limit])
+
+    def rising(self, limit: int) -> Iterator:
+        return iter(self._listing(RISING)[:limit])
+
+    def top(self, time_filter: str, limit: int) -> Iterator:
+        return iter(self._listing(f"top/{time_filter}")[:limit])
+
+    def _listing(self, kind: str) -> List[ReplaySubmission]:
+        listings = self.reddit.listings
+        if (self.subs, kind) in listings:
+            records = [listings[(self.subs, kind)]]
+        else:
+            # recorded in parallel mode, one listing per subreddit
+            records = [listings.get((name, kind), []) for name in self.subs.split("+")]
+        return merge([[ReplaySubmission(r) for r in rs] for rs in records])
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport adapter that serves GET requests from the archive, and
+    accepts every POST without sending it anywhere. The JSON bodies of
+    the POSTs are kept in `delivered`.
+    """
+
+    def __init__(self, archive: Archive):
+        super().__init__()
+        self.archive = archive
+        self.delivered: List[Dict] = []
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        if request.method == "POST":
+            self.delivered.append(json.loads(request.body))
+            return _response(request, 204, b"")
+        data = self.archive.load_image(request.url)
+        if data is None:
+            return _response(request, 404, b"")
+        return _response(request, 200, data)
+
+    def close(self):
+        pass
+
+
+def _response(request: PreparedRequest, status: int, body: bytes) -> Response:
+    res = Response()
+    res.status_code = status
+    res.reason = "OK" if status < 400 else "Not Found"
+    res.headers = CaseInsensitiveDict({"Content-Length": str(len(body))})
+    res.raw = BytesIO(body)
+    res.url = request.url
+    res.request = request
+    return res
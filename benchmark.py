@@ -0,0 +1,263 @@
+"""
+Benchmarks for the scrape -> dedup -> deliver pipeline, run against local
+stand-ins: fakeredis instead of Redis, a local HTTP server instead of the image
+hosts, and generated submissions instead of Reddit.
+
+Usage:
+    python benchmark.py --keyspace 10000 --posts-per-author 50 --limit 24
+"""
+from datetime import datetime, timedelta
+from deduplicate_util import already_posted, fuzzy_match, record_post
+from fakeredis import FakeStrictRedis
+from food import get_submission
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from image_util import compute_image_hash
+from contextlib import redirect_stdout
+from io import BytesIO, StringIO
+from PIL import Image, ImageDraw
+from typing import Callable, Dict, List
+import argparse
+import math
+import random
+import threading
+import time
+import tracemalloc
+
+
+TITLE_WORDS = [
+    "homemade",
+    "beef",
+    "tacos",
+    "ramen",
+    "pizza",
+    "margherita",
+    "spicy",
+    "chicken",
+    "curry",
+    "fried",
+    "rice",
+    "sourdough",
+    "bread",
+    "pork",
+    "belly",
+    "bao",
+    "chocolate",
+    "cake",
+    "smash",
+    "burger",
+    "pho",
+    "sushi",
+    "dumplings",
+]
+
+
+class CountingRedis(FakeStrictRedis):
+    """
+    fakeredis client that counts round trips. A pipeline counts as one.
+    """
+
+    round_trips = 0
+
+    def execute_command(self, *args, **kwargs):
+        self.round_trips += 1
+        return super().execute_command(*args, **kwargs)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        execute = pipe.execute
+
+        def counted(*args, **kwargs):
+            self.round_trips += 1
+            return execute(*args, **kwargs)
+
+        pipe.execute = counted
+        return pipe
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    # path -> encoded image, shared by every request
+    images: Dict[str, bytes] = {}
+
+    def do_GET(self):
+        body = self.images.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # keep the report readable
+
+
+class Author:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class SyntheticSubmission:
+    # looks enough like a PRAW submission for FoodPost.from_submission
+    def __init__(self, post_id: str, author: str, url: str, title: str):
+        self.id = post_id
+        self.author = Author(author)
+        self.url = url
+        self.permalink = f"/r/food/comments/{post_id}"
+        self.title = title
+        self.created_utc = datetime.now().timestamp()
+        self.media_metadata = None
+        self.score = random.randint(1, 10000)
+
+
+class SyntheticSubreddit:
+    def __init__(self, submissions: List[SyntheticSubmission]):
+        self.submissions = submissions
+
+    def hot(self, limit: int):
+        return iter(self.submissions[:limit])
+
+
+class SyntheticReddit:
+    def __init__(self, submissions: List[SyntheticSubmission]):
+        self.submissions = submissions
+
+    def subreddit(self, subs: str):
+        return SyntheticSubreddit(self.submissions)
+
+
+def make_image(size: int, seed: int) -> bytes:
+    rng = random.Random(seed)
+    im = Image.new("RGB", (size, size), (rng.randrange(256), 0, 0))
+    draw = ImageDraw.Draw(im)
+    for _ in range(8):
+        x, y = rng.randrange(size), rng.randrange(size)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse([x, y, x + size // 4, y + size // 4], fill=color)
+    buf = BytesIO()
+    im.save(buf, format="JPEG")
+    return buf.getvalue()
+
+
+def title(rng: random.Random) -> str:
+    return " ".join(rng.sample(TITLE_WORDS, 4))
+
+
+def start_image_server(count: int, size: int) -> str:
+    ImageHandler.images = {f"/{i}.jpg": make_image(size, i) for i in range(count)}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ImageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def populate(r: CountingRedis, keyspace: int, per_author: int, rng: random.Random):
+    """
+    Fill Redis with `keyspace` posts, `per_author` posts per author.
+    """
+    date = datetime.now()
+    for i in range(keyspace):
+        post = {
+            "id": f"old{i}",
+            "hash": str(rng.getrandbits(64)),
+            "title": title(rng),
+            "date": (date - timedelta(minutes=i % 600)).strftime("%d/%m/%y %H:%M"),
+        }
+        record_post(r, f"author{i // per_author}", post)
+
+
+def listing(
+    base_url: str, keyspace: int, per_author: int, limit: int, images: int, rng
+) -> List[SyntheticSubmission]:
+    """
+    A hot listing where most posts were already posted, like a busy hourly run.
+    """
+    submissions = []
+    authors = max(1, keyspace // per_author)
+    for i in range(limit):
+        if i < limit * 3 // 4 and keyspace > 0:
+            n = rng.randrange(keyspace)
+            post_id, author = f"old{n}", f"author{n // per_author}"
+        else:
+            post_id, author = (
+                f"new{rng.getrandbits(32)}",
+                f"author{rng.randrange(authors)}",
+            )
+        url = f"{base_url}/{rng.randrange(images)}.jpg"
+        submissions.append(SyntheticSubmission(post_id, author, url, title(rng)))
+    return submissions
+
+
+def measure(name: str, iterations: int, r: CountingRedis, fn: Callable[[], None]):
+    timings = []
+    r.round_trips = 0
+    tracemalloc.start()
+    # the pipeline logs every decision, which would drown out the report
+    with redirect_stdout(StringIO()):
+        for _ in range(iterations):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    # nearest rank, since statistics.quantiles needs Python 3.8
+    p50, p90, p99 = (timings[math.ceil(q * len(timings)) - 1] for q in (0.5, 0.9, 0.99))
+    print(
+        f"{name:<20} p50 {p50:8.2f}ms  p90 {p90:8.2f}ms  p99 {p99:8.2f}ms  "
+        f"redis round trips/op {r.round_trips / iterations:6.1f}  "
+        f"peak memory {peak / 1024:8.0f}KiB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--keyspace", type=int, default=1000)
+    parser.add_argument("--posts-per-author", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=24)
+    parser.add_argument("--image-size", type=int, default=1024)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--hash-workers", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(0)
+
+    base_url = start_image_server(32, args.image_size)
+    r = CountingRedis(version=6)
+    print(
+        f"keyspace={args.keyspace} posts_per_author={args.posts_per_author} "
+        f"limit={args.limit} image_size={args.image_size}"
+    )
+    populate(r, args.keyspace, args.posts_per_author, rng)
+    reddit = SyntheticReddit([])
+    author = "author0"
+    stored = {"id": "x", "hash": "1", "title": title(rng), "date": "21/08/22 01:00"}
+    candidate = {
+        "id": "new",
+        "hash": "2",
+        "title": title(rng),
+        "date": "21/08/22 02:00",
+    }
+
+    def run_get_submission():
+        reddit.submissions = listing(
+            base_url, args.keyspace, args.posts_per_author, args.limit, 32, rng
+        )
+        get_submission(r, reddit, "food", args.limit, args.hash_workers)
+
+    def run_compute_image_hash():
+        compute_image_hash(f"{base_url}/{rng.randrange(32)}.jpg")
+
+    measure("get_submission", args.iterations, r, run_get_submission)
+    measure(
+        "already_posted",
+        args.iterations,
+        r,
+        lambda: already_posted(r, author, candidate),
+    )
+    measure("fuzzy_match", args.iterations, r, lambda: fuzzy_match(stored, candidate))
+    measure("compute_image_hash", args.iterations, r, run_compute_image_hash)
+
+
+if __name__ == "__main__":
+    main()
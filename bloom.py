@@ -0,0 +1,120 @@
+from datetime import timedelta
+from redis import Redis
+from typing import Dict, Optional
+import hashlib
+import math
+import threading
+import time
+
+
+# expected number of posts recorded per slice, and the false positive rate
+# at that size. False positives only cost an EXISTS call to Redis.
+SLICE_CAPACITY = 10000
+ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    """
+    Probabilistic set of strings. contains() never returns False for a
+    string that was added, but can return True for one that wasn't.
+    """
+
+    def __init__(self, capacity: int = SLICE_CAPACITY, error_rate: float = ERROR_RATE):
+        # standard sizing for the optimal number of bits and hash functions
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def contains(self, key: str) -> bool:
+        return all(
+            self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(key)
+        )
+
+    def _positions(self, key: str):
+        # double hashing, so one digest gives every position
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+
+class RotatingBloomFilter:
+    """
+    Bloom filter of the "author/postId" keys that were posted recently,
+    so that most candidates can be ruled out as new without a round trip
+    to Redis. A plain bloom filter can't forget anything, but the keys in
+    Redis expire, so keys are added to a sub-filter for the day they were
+    posted, and sub-filters older than the TTL are dropped.
+    The filter only knows about posts made by this process, plus whatever
+    was in Redis when it was rebuilt, so positives are always confirmed
+    against Redis.
+    """
+
+    def __init__(
+        self,
+        ttl: timedelta,
+        slice_length: timedelta = timedelta(days=1),
+        capacity: int = SLICE_CAPACITY,
+        error_rate: float = ERROR_RATE,
+    ):
+        self.ttl = ttl
+        self.slice_length = slice_length.total_seconds()
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.slices: Dict[int, BloomFilter] = {}
+
+    def add(self, key: str, posted_at: Optional[float] = None):
+        """
+        @param key the "author/postId" key
+        @param posted_at when the post was recorded, defaults to now
+        """
+        posted_at = time.time() if posted_at is None else posted_at
+        n = int(posted_at // self.slice_length)
+        with self.lock:
+            if n not in self.slices:
+                self.slices[n] = BloomFilter(self.capacity, self.error_rate)
+            self.slices[n].add(key)
+            self._rotate()
+
+    def might_contain(self, key: str) -> bool:
+        """
+        @return False if the key was definitely not posted recently
+        """
+        with self.lock:
+            self._rotate()
+            return any(f.contains(key) for f in self.slices.values())
+
+    def rebuild(self, r: Redis) -> int:
+        """
+        Load the "author/postId" keys that are in Redis. Each key's remaining
+        TTL tells how long ago it was posted, which decides its sub-filter.
+        @return the number of keys that were loaded
+        """
+        now = time.time()
+        total = self.ttl.total_seconds()
+        keys = [k for k in r.scan_iter("*/*") if b":" not in _bytes(k)]
+        if len(keys) < 1:
+            return 0
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.ttl(key)
+        for key, remaining in zip(keys, pipe.execute()):
+            if remaining is None or remaining < 0:
+                remaining = total  # no expiry, treat it as posted just now
+            key = key.decode() if isinstance(key, bytes) else key
+            self.add(key, now - (total - remaining))
+        return len(keys)
+
+    def _rotate(self):
+        oldest = int((time.time() - self.ttl.total_seconds()) // self.slice_length)
+        for n in [n for n in self.slices if n < oldest]:
+            del self.slices[n]
+
+
+def _bytes(key) -> bytes:
+    return key if isinstance(key, bytes) else key.encode()
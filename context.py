@@ -0,0 +1,216 @@
+from archive import Archive, RecordingReddit, record_session
+from bloom import RotatingBloomFilter
+from datetime import timedelta
+from deduplicate_util import TIME_TO_LIVE
+from depth import MAX_LIMIT, MIN_LIMIT, LimitController
+from image_cache import ImageHashCache
+from listing import (
+    FETCH_WORKERS,
+    MERGE_ROUND_ROBIN,
+    fetch_multireddit,
+    listing_from_config,
+)
+from outbox import Outbox
+from prefetch import MAX_AGE, CandidatePool
+from praw import Reddit
+from reddit_clients import init_reddit
+from redis import ConnectionPool, Redis
+from requests.adapters import HTTPAdapter
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib3.util.retry import Retry
+from webhook import Webhook, parse_webhooks
+import os
+import requests
+
+
+USER_AGENT = "discord:food_waifu:v0.2"
+# seconds to wait on an image host before giving up on the image
+IMAGE_TIMEOUT = 10.0
+# extra pages to look through if every hot post was already used, and how
+# long to spend on them, see food.find_new_posts
+SEARCH_REQUESTS = 3
+SEARCH_SECONDS = 20.0
+
+
+def init_redis() -> Redis:
+    """
+    Build a Redis client from the connection details in the environment.
+    These values get injected by Railway. The client owns a connection pool,
+    so reusing it reuses connections.
+    """
+    pool = ConnectionPool(
+        host=os.getenv("REDISHOST"),
+        username=os.getenv("REDISUSER"),
+        password=os.getenv("REDISPASSWORD"),
+        port=os.getenv("REDISPORT"),
+        decode_responses=True,
+    )
+    return Redis(connection_pool=pool)
+
+
+def init_session(pool_size: int) -> requests.Session:
+    """
+    Build a requests Session with keep-alive and retries, shared by the
+    image downloads and the Discord webhook. Only idempotent requests are
+    retried on 5xx responses, so a webhook POST never gets sent twice.
+    @param pool_size max number of connections kept open per host
+    """
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class AppContext:
+    """
+    Long lived clients and configuration, created once at startup and
+    reused by every scheduled run. Building these for every run meant
+    a new Redis connection, a new Reddit OAuth token, and new TLS
+    handshakes with Discord and the image hosts each hour.
+    """
+
+    def __init__(self, **kwargs):
+        self.redis: Redis = kwargs.get("redis")
+        self.reddit: Reddit = kwargs.get("reddit")
+        self.session: requests.Session = kwargs.get("session") or requests.Session()
+        self.image_cache: ImageHashCache = kwargs.get("image_cache") or ImageHashCache(
+            self.redis
+        )
+        self.webhooks: List[Webhook] = kwargs.get("webhooks", [])
+        # seconds between refreshes of the prefetched posts. 0 turns it off
+        self.prefetch_interval: float = kwargs.get("prefetch_interval", 0)
+        # prefetched posts for each set of subreddits, see prefetch.py
+        self.pools: Dict[str, CandidatePool] = kwargs.get("pools", {})
+        # where to expose the metrics, see metrics.py
+        self.metrics_port: Optional[int] = kwargs.get("metrics_port")
+        self.metrics_file: Optional[str] = kwargs.get("metrics_file")
+        # in-memory filter of recently posted IDs, see bloom.py
+        self.id_filter: Optional[RotatingBloomFilter] = kwargs.get("id_filter")
+        # compare images against every author's posts, see image_index.py
+        self.global_images: bool = kwargs.get("global_images", False)
+        # fetches the ranked hot posts, see listing.py
+        self.listing: Callable[[Reddit, str, int], Iterable] = kwargs.get(
+            "listing", fetch_multireddit
+        )
+        self.request_limit: int = kwargs.get("request_limit", 24)
+        # adapts request_limit for each set of subreddits, see depth.py
+        self.limits: Optional[LimitController] = kwargs.get("limits")
+        self.hash_workers: int = kwargs.get("hash_workers", 1)
+        self.image_timeout: float = kwargs.get("image_timeout", IMAGE_TIMEOUT)
+        self.search_requests: int = kwargs.get("search_requests", 0)
+        self.search_seconds: float = kwargs.get("search_seconds", SEARCH_SECONDS)
+        # deliveries waiting to be sent, see outbox.py. None delivers in the run
+        self.outbox: Optional[Outbox] = kwargs.get("outbox")
+
+    @staticmethod
+    def from_env() -> "AppContext":
+        """
+        Read the configuration from the environment, and build the clients.
+        See the README for the list of environment variables.
+        """
+        reddit_client_id = os.getenv("REDDIT_CLIENT_ID")
+        reddit_client_secret = os.getenv("REDDIT_CLIENT_SECRET")
+        # expected to be a list of subreddits to search, separated by +
+        # example: "foo+bar+baz" where foo, bar, and baz are all subreddits
+        subs = os.getenv("SUBREDDITS")
+        request_limit = int(os.getenv(key="LIMIT", default="24"))
+        hash_workers = int(os.getenv(key="HASH_WORKERS", default="4"))
+        image_timeout = float(
+            os.getenv(key="IMAGE_TIMEOUT", default=str(IMAGE_TIMEOUT))
+        )
+        search_requests = int(
+            os.getenv(key="SEARCH_REQUESTS", default=str(SEARCH_REQUESTS))
+        )
+        search_seconds = float(
+            os.getenv(key="SEARCH_SECONDS", default=str(SEARCH_SECONDS))
+        )
+        cache_size = int(os.getenv(key="IMAGE_CACHE_SIZE", default="1024"))
+        listing = listing_from_config(
+            os.getenv(key="FETCH_MODE", default="multireddit"),
+            int(os.getenv(key="FETCH_WORKERS", default=str(FETCH_WORKERS))),
+            os.getenv(key="MERGE_POLICY", default=MERGE_ROUND_ROBIN),
+        )
+        metrics_port = os.getenv("METRICS_PORT")
+        metrics_file = os.getenv("METRICS_FILE")
+        global_images = os.getenv(key="GLOBAL_IMAGE_DEDUP", default="on") != "off"
+        prefetch_interval = float(os.getenv(key="PREFETCH_INTERVAL", default="0"))
+        prefetch_max_age = float(
+            os.getenv(key="PREFETCH_MAX_AGE", default=str(MAX_AGE.total_seconds()))
+        )
+
+        if reddit_client_id is None or reddit_client_secret is None:
+            raise Exception("Reddit API credentials not configured in environment")
+        webhooks = parse_webhooks(os.getenv("WEBHOOKS"), os.getenv("WEBHOOK_URL"), subs)
+        if len(webhooks) < 1:
+            raise Exception("No webhook URL specified in environment")
+
+        r = init_redis()
+        print("Instantiated Redis client")
+        # PRAW keeps the OAuth token on the client, and only fetches
+        # a new one when it expires. Every thread gets a client of its own,
+        # since the parallel fetch, prefetching and jobs run concurrently.
+        reddit = init_reddit(reddit_client_id, reddit_client_secret, USER_AGENT)
+        print("Instantiated Reddit client")
+
+        id_filter = None
+        if os.getenv(key="ID_FILTER", default="on") != "off":
+            id_filter = RotatingBloomFilter(TIME_TO_LIVE)
+            count = id_filter.rebuild(r)
+            print(f"Loaded {count} recent posts into the ID filter")
+
+        limits = None
+        if os.getenv(key="ADAPTIVE_LIMIT", default="on") != "off":
+            limits = LimitController(
+                r,
+                int(os.getenv(key="LIMIT_MIN", default=str(MIN_LIMIT))),
+                int(os.getenv(key="LIMIT_MAX", default=str(MAX_LIMIT))),
+            )
+
+        outbox = None
+        if os.getenv(key="OUTBOX", default="on") != "off":
+            outbox = Outbox(r)
+
+        pools = {}
+        if prefetch_interval > 0:
+            max_age = timedelta(seconds=prefetch_max_age)
+            for hook in webhooks:
+                pools[hook.subs] = CandidatePool(
+                    r, hook.subs, max_age=max_age, image_timeout=image_timeout
+                )
+
+        session = init_session(max(hash_workers, len(webhooks), 1) + 1)
+        record_archive = os.getenv("RECORD_ARCHIVE")
+        if record_archive is not None:
+            # keep what Reddit and the image hosts returned, see replay.py
+            archive = Archive(record_archive)
+            reddit = RecordingReddit(reddit, archive)
+            record_session(session, archive)
+            print(f"Recording listings and images to {record_archive}")
+
+        return AppContext(
+            redis=r,
+            reddit=reddit,
+            session=session,
+            image_cache=ImageHashCache(r, max_size=cache_size),
+            webhooks=webhooks,
+            prefetch_interval=prefetch_interval,
+            pools=pools,
+            metrics_port=int(metrics_port) if metrics_port is not None else None,
+            metrics_file=metrics_file,
+            id_filter=id_filter,
+            global_images=global_images,
+            listing=listing,
+            request_limit=request_limit,
+            limits=limits,
+            hash_workers=hash_workers,
+            image_timeout=image_timeout,
+            search_requests=search_requests,
+            search_seconds=search_seconds,
+            outbox=outbox,
+        )
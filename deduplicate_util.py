@@ -1,13 +1,38 @@
-from typing import Dict
+from typing import Callable, Counter, Dict, List, Optional, Set, Tuple
 from redis import Redis
-from thefuzz import fuzz
+from bloom import RotatingBloomFilter
 from datetime import datetime, timedelta
-from food_post import DATETIME_FMT
-import json
+from food_post import DATETIME_FMT, FoodPost, PostRef
+from image_index import find_similar_images, index_image
+from image_util import hamming_distance
+from metrics import METRICS
+from record import decode_record, encode_record
+import collections
+import re
+import time
 
 
 FUZZ_THRESHOLD = 65  # lower threshold isn't bad. we want low tolerance for dupes.
+# max number of bits that can differ between two perceptual image hashes
+# for the images to be considered the same.
+HASH_DISTANCE_THRESHOLD = 6
 ONE_DAY = timedelta(hours=24)
+# Keep records in Redis for at most one week. Reddit moves fast,
+# so although this doesn't prevent karma farmer reposts from
+# showing up, a week is still a long time.
+TIME_TO_LIVE = timedelta(weeks=1)
+
+# thefuzz drops these characters when forcing ASCII, then replaces anything
+# that isn't a word character with a space. Underscores are word characters
+LATIN_1 = {i: None for i in range(128, 256)}
+NON_WORD = re.compile(r"(?ui)\W")
+
+# names of the deduplication stages, in the order that they are evaluated
+STAGE_ID = "id"
+STAGE_TITLE = "title"
+STAGE_HASH = "hash"
+# the checks also keep the "author/postId" of the record a duplicate matched
+MATCH = "match"
 
 
 def already_posted(r: Redis, author: str, post: Dict) -> bool:
@@ -19,59 +44,583 @@ def already_posted(r: Redis, author: str, post: Dict) -> bool:
     Note that this does not modify/add to the Redis cache, only reads from it.
     @param r The Redis cache client
     @param author The username of the Reddit user that posted the submission
-    @param img_hash The hash of the downloaded image file
-    @param post_id The Reddit submission ID to check for
+    @param post The JSON representation of the post, see FoodPost.to_json
     @return True if the post is already in the cache, False otherwise
     """
+    return _check_stages(r, author, post, lambda: post.get("hash"), {})
+
+
+def is_duplicate(
+    r: Redis,
+    author: str,
+    fp: FoodPost,
+    history: Optional[List[Dict]] = None,
+    global_images: bool = False,
+) -> bool:
+    """
+    Same as already_posted, but works off of a FoodPost so that the
+    image hash is only computed if the cheaper checks did not already
+    find a duplicate. The result of every stage is memoized on the FoodPost.
+    @param r The Redis cache client
+    @param author The username of the Reddit user that posted the submission
+    @param fp The candidate post
+    @param history the author's stored records, if they were already read
+                   with prefetch_candidates
+    @param global_images also compare the image against the images posted by
+                         every other author, see image_index.py
+    @return True if the post is already in the cache, False otherwise
+    """
+    post = fp.to_json(include_hash=False)
+    return _check_stages(
+        r,
+        author,
+        post,
+        lambda: str(fp.image_hash()),
+        fp.checks,
+        history,
+        global_images,
+    )
+
+
+def needs_image_hash(
+    r: Redis,
+    author: str,
+    fp: FoodPost,
+    history: Optional[List[Dict]] = None,
+    global_images: bool = False,
+) -> bool:
+    """
+    Run the cheap deduplication stages for a post, and report whether
+    is_duplicate would still have to download the image to reach a verdict.
+    This lets callers download the images that are needed ahead of time.
+    @param r The Redis cache client
+    @param author The username of the Reddit user that posted the submission
+    @param fp The candidate post
+    @param history the author's stored records, if they were already read
+    @param global_images whether is_duplicate will compare against every author
+    @return True if the image hash is needed to decide if fp is a duplicate
+    """
+    if STAGE_HASH in fp.checks or fp.img_hash is not None:
+        return False
+    if history is None:
+        history = stored_posts(r, author)
+    post = fp.to_json(include_hash=False)
+    if _check_stages(r, author, post, None, fp.checks, history):
+        return False
+    return global_images or any(parse_hash(p.get("hash")) is not None for p in history)
+
+
+def least_recently_posted(r: Redis, candidates: List[PostRef]) -> Optional[PostRef]:
+    """
+    Pick the candidate that went out the longest time ago, for when every
+    candidate is a duplicate. Records expire TIME_TO_LIVE after they are
+    posted, so the one whose matching record has the least time left is the
+    oldest. That's the candidate's own "author/postId" key, or for a post
+    that was only similar to another one, the key of the record it matched.
+    Candidates whose record is gone can't be dated, so they come last.
+    Ties go to the candidate that ranked higher in the listing.
+    @param r The Redis cache client
+    @param candidates the candidates to pick from
+    @return the least recently posted candidate, or None if there are none
+    """
+    if len(candidates) < 1:
+        return None
+    pipe = r.pipeline(transaction=False)
+    for c in candidates:
+        pipe.pttl(c.match or f"{c.author}/{c.id}")
+    with METRICS.timer("redis", op="pttl"):
+        # -2 if the key doesn't exist, -1 if it never expires
+        ttls = [float("inf") if ttl == -2 else max(ttl, 0) for ttl in pipe.execute()]
+    ranked = zip(ttls, (c.rank for c in candidates), range(len(candidates)))
+    return candidates[min(ranked)[2]]
+
+
+def verdict(checks: Dict[str, bool]) -> str:
+    """
+    @param checks the memoized stage results of a post
+    @return the name of the stage that found the post to be a duplicate,
+            or "new" if none of them did
+    """
+    for stage in (STAGE_ID, STAGE_TITLE, STAGE_HASH):
+        if checks.get(stage):
+            return stage
+    return "new"
+
+
+def prefetch_candidates(
+    r: Redis,
+    candidates: List[Tuple[str, FoodPost]],
+    id_filter: Optional[RotatingBloomFilter] = None,
+) -> Dict[str, List[Dict]]:
+    """
+    Run the exact ID check for a batch of candidates in one pipeline, and
+    read the stored records of every author that still needs a fuzzy check.
+    The ID verdicts are memoized on each FoodPost, so that is_duplicate
+    does not repeat them.
+    @param r The Redis cache client
+    @param candidates list of (author, FoodPost) pairs
+    @param id_filter if given, posts that it rules out skip the EXISTS call
+    @return the stored records for each author, to pass to is_duplicate
+    """
+    keys = [(author, fp.id) for author, fp in candidates]
+    checks = [fp.checks for _, fp in candidates]
+    return prefetch_history(r, keys, checks, id_filter)
+
+
+def prefetch_history(
+    r: Redis,
+    keys: List[Tuple[str, str]],
+    checks: List[Dict[str, bool]],
+    id_filter: Optional[RotatingBloomFilter] = None,
+) -> Dict[str, List[Dict]]:
+    """
+    @param r The Redis cache client
+    @param keys list of (author, post ID) pairs
+    @param checks memoized stage results for each pair, updated in place
+                  with the result of the exact ID check
+    @param id_filter if given, posts that it rules out skip the EXISTS call
+    @return the stored records for each author
+    """
+    authors = sorted({author for author, _ in keys})
+    pipe = r.pipeline(transaction=False)
+    confirm = []
+    for (author, post_id), c in zip(keys, checks):
+        key = f"{author}/{post_id}"
+        if id_filter is not None and not id_filter.might_contain(key):
+            c[STAGE_ID] = False  # definitely new, no need to ask Redis
+            METRICS.incr("id_filter", result="negative")
+            continue
+        pipe.exists(key)
+        confirm.append((c, key))
+    for author in authors:
+        _read_index(pipe, author)
+    with METRICS.timer("redis", op="prefetch"):
+        results = pipe.execute()
+
+    for (c, key), found in zip(confirm, results[: len(confirm)]):
+        c[STAGE_ID] = found > 0
+        if found > 0:
+            c[MATCH] = key
+    replies = results[len(confirm) :]
+    return {
+        author: _parse_index(r, author, replies[2 * i], replies[2 * i + 1])
+        for i, author in enumerate(authors)
+    }
+
+
+def record_post(
+    r: Redis,
+    author: str,
+    post: Dict,
+    ttl: timedelta = TIME_TO_LIVE,
+    id_filter: Optional[RotatingBloomFilter] = None,
+):
+    """
+    Persist a post that is about to be used, so that it doesn't get
+    posted again. This writes the "author/postId" key used for the exact
+    ID check, and adds the post to the author's index, which holds the
+    records used for the fuzzy checks.
+    @param r The Redis cache client
+    @param author The username of the Reddit user that posted the submission
+    @param post The JSON representation of the post, see FoodPost.to_json
+    @param ttl how long to keep the records for
+    @param id_filter if given, the post is added to it
+    """
+    if id_filter is not None:
+        id_filter.add(f"{author}/{post['id']}")
+    val = encode_record(match_fields(post))
+    pipe = r.pipeline(transaction=False)
+    pipe.set(f"{author}/{post['id']}", val, ex=ttl)
+    _queue_index(pipe, author, post, val, ttl)
+    with METRICS.timer("redis", op="record"):
+        pipe.execute()
+
+
+def claim_post(
+    r: Redis,
+    author: str,
+    post: Dict,
+    ttl: timedelta = TIME_TO_LIVE,
+    id_filter: Optional[RotatingBloomFilter] = None,
+) -> bool:
+    """
+    Same as record_post, but only succeeds if no other instance has
+    recorded the post yet, so that two instances sharing a Redis never
+    both use the same post. The "author/postId" key is set with NX, and the
+    index is only written once the claim is won, so an instance that lost
+    never overwrites the winner's record, which might have an image hash
+    that the loser failed to compute.
+    @param r The Redis cache client
+    @param author The username of the Reddit user that posted the submission
+    @param post The JSON representation of the post, see FoodPost.to_json
+    @param ttl how long to keep the records for
+    @param id_filter if given, the post is added to it
+    @return True if this instance claimed the post, False if another
+            instance already recorded it, and it must not be used
+    """
+    if id_filter is not None:
+        # recorded either way, by this instance or another one
+        id_filter.add(f"{author}/{post['id']}")
+    val = encode_record(match_fields(post))
+    with METRICS.timer("redis", op="claim"):
+        claimed = r.set(f"{author}/{post['id']}", val, ex=ttl, nx=True) is True
+        if claimed:
+            # if this never runs, backfill_index adds the record later
+            pipe = r.pipeline(transaction=False)
+            _queue_index(pipe, author, post, val, ttl)
+            pipe.execute()
+    METRICS.incr("claims", result="won" if claimed else "lost")
+    return claimed
+
+
+def _queue_index(pipe, author: str, post: Dict, val: str, ttl: timedelta):
+    _write_index(pipe, author, post["id"], val, time.time(), ttl)
+    img_hash = parse_hash(post.get("hash"))
+    if img_hash is not None:
+        index_image(pipe, author, post["id"], img_hash, ttl)
+
+
+def backfill_index(r: Redis, ttl: timedelta = TIME_TO_LIVE) -> int:
+    """
+    Migrate records that only exist as "author/postId" keys into the
+    per-author index, converting legacy JSON records to the compact
+    encoding along the way. Records that are already indexed are
+    rewritten, so this is safe to run more than once.
+    @param r The Redis cache client
+    @param ttl how long to keep the records for
+    @return the number of records that were indexed
+    """
+    count = 0
+    now = time.time()
+    pipe = r.pipeline(transaction=False)
+    for key in r.scan_iter("*/*"):
+        key = _str(key)
+        if ":" in key:
+            continue  # some other kind of record, e.g. cached image hashes
+        author, post_id = key.rsplit("/", 1)
+        val, remaining = r.get(key), r.ttl(key)
+        if val is None:
+            continue  # expired since the scan
+        # the key was written with the full TTL when the post was recorded
+        recorded_at = now - ttl.total_seconds() + remaining if remaining > 0 else now
+        post = match_fields(decode_record(val))
+        val = encode_record(post)
+        pipe.set(key, val, keepttl=True)
+        _write_index(pipe, author, post_id, val, recorded_at, ttl)
+        img_hash = parse_hash(post.get("hash"))
+        if img_hash is not None:
+            index_image(pipe, author, post_id, img_hash, ttl)
+        count += 1
+    pipe.execute()
+    return count
+
+
+def _index_key(author: str) -> str:
+    # hash of post ID -> encoded record, see record.py
+    return f"posts:{author}"
+
+
+def _dates_key(author: str) -> str:
+    # sorted set of post IDs, scored by when the post was recorded, so
+    # that records leave the index when their "author/postId" key expires
+    return f"dates:{author}"
+
+
+def _write_index(pipe, author, post_id, val, recorded_at, ttl: timedelta):
+    cutoff = time.time() - ttl.total_seconds()
+    pipe.hset(_index_key(author), post_id, val)
+    pipe.zadd(_dates_key(author), {post_id: recorded_at})
+    # records older than the TTL fall out of the sorted set here, and
+    # out of the hash the next time the index is read.
+    pipe.zremrangebyscore(_dates_key(author), "-inf", f"({cutoff}")
+    pipe.expire(_index_key(author), ttl)
+    pipe.expire(_dates_key(author), ttl)
+
+
+def _read_index(pipe, author: str):
+    # queues two replies, which are consumed by _parse_index
+    cutoff = time.time() - TIME_TO_LIVE.total_seconds()
+    pipe.zrangebyscore(_dates_key(author), cutoff, "+inf")
+    pipe.hgetall(_index_key(author))
+
+
+def _parse_index(r: Redis, author: str, live_ids, records) -> List[Dict]:
+    live = {_str(post_id) for post_id in live_ids}
+    posts = []
+    stale = []
+    for post_id, val in records.items():
+        if _str(post_id) in live:
+            posts.append(match_fields(decode_record(val)))
+        else:
+            stale.append(post_id)
+    if len(stale) > 0:
+        r.hdel(_index_key(author), *stale)
+    return posts
+
+
+def _str(val) -> str:
+    return val.decode() if isinstance(val, bytes) else val
+
+
+def _check_stages(
+    r: Redis,
+    author: str,
+    post: Dict,
+    image_hash: Optional[Callable[[], Optional[str]]],
+    checks: Dict[str, bool],
+    history: Optional[List[Dict]] = None,
+    global_images: bool = False,
+) -> bool:
+    """
+    Run the deduplication checks from cheapest to most expensive:
+    1. exact match on the "author/postId" key
+    2. fuzzy match on the title and date of the author's other posts
+    3. image hash match against the author's other posts, which requires
+       downloading the image. If global_images is set, the image is also
+       looked up in the index of every author's images
+    Each stage only runs if the previous ones did not find a duplicate.
+    @param image_hash computes the hash of the post's image. If None, the
+                      image hash stage is skipped
+    @param checks memoized stage results, updated in place. The key of
+                  the record that the post duplicates is kept under MATCH
+    """
     post_id = post["id"]
-    if r.exists(f"{author}/{post_id}") > 0:
+
+    def memo(stage: str, fn: Callable[[], bool]) -> bool:
+        if stage not in checks:
+            checks[stage] = fn()
+        return checks[stage]
+
+    def exists() -> bool:
+        with METRICS.timer("redis", op="exists"):
+            found = r.exists(f"{author}/{post_id}") > 0
+        if found:
+            checks[MATCH] = f"{author}/{post_id}"
+        return found
+
+    def title_stage() -> bool:
+        match = similar_title(post, history)
+        if match is not None:
+            checks[MATCH] = f"{author}/{match['id']}"
+        return match is not None
+
+    if memo(STAGE_ID, exists):
         print(f"Post {post_id} by {author} has already been used recently.")
         return True
 
     # https://github.com/SaxyPandaBear/my-webhooks/issues/14
     # If the author/post combination key does not exist, there is still
     # a possibility that the author reposted the same image, so it needs
-    # a deduplication check. Since all of the keys are expected to follow
-    # the scheme "author/postId", we can scan the Redis cache by the author
-    # name, iterate over the returned records and compare image hashes and
-    # post titles to do a fuzzy match.
-    r.scan()
-    i = r.scan_iter(f"{author}/*")
-    done = False
-    while not done:
-        try:
-            key = next(i)
-            val = r.get(key)  # realistically this should never be None...
-            if val is not None:
-                p = json.loads(val)
-                if fuzzy_match(p, post):
-                    print(
-                        f"Something similar to {author}/{post_id} has already been posted recently."
-                    )
-                    return True
-        except StopIteration:
-            done = True
+    # a deduplication check. Every post is also stored in an index for its
+    # author, so read the author's records from there and compare post
+    # titles and image hashes.
+    if history is None and (STAGE_TITLE not in checks or STAGE_HASH not in checks):
+        history = stored_posts(r, author)
+    history = history or []
+
+    if memo(STAGE_TITLE, title_stage):
+        print(
+            f"Something similar to {author}/{post_id} has already been posted recently."
+        )
+        return True
+
+    def hash_stage() -> bool:
+        hashes = [(parse_hash(p.get("hash")), p.get("id")) for p in history]
+        hashes = [(h, i) for h, i in hashes if h is not None]
+        if len(hashes) < 1 and not global_images:
+            return False  # nothing to compare against, skip the download
+        h = parse_hash(image_hash())
+        if h is None:
+            return False
+        if len(hashes) > 0:
+            distance, match = min(
+                ((hamming_distance(h, o), i) for o, i in hashes), key=lambda m: m[0]
+            )
+            if distance <= HASH_DISTANCE_THRESHOLD:
+                checks[MATCH] = f"{author}/{match}"
+                return True
+        if not global_images:
+            return False
+        # karma farmers repost the same images from different accounts
+        with METRICS.timer("redis", op="image_index"):
+            matches = find_similar_images(
+                r, h, HASH_DISTANCE_THRESHOLD, TIME_TO_LIVE, f"{author}/{post_id}"
+            )
+        METRICS.incr("image_index", result="match" if matches else "miss")
+        if len(matches) > 0:
+            print(f"The image for {author}/{post_id} matches {matches[0][0]}.")
+            checks[MATCH] = matches[0][0]
+        return len(matches) > 0
+
+    if image_hash is None:
+        return False  # the caller only wanted the cheap stages
+    if memo(STAGE_HASH, hash_stage):
+        print(f"The image for {author}/{post_id} has already been posted recently.")
+        return True
     print(f"Post {post_id} has not been posted yet.")
     return False  # it was not posted already.
 
 
-def fuzzy_match(a, b) -> bool:
+def stored_posts(r: Redis, author: str) -> List[Dict]:
+    """
+    Read all of the records stored for the given author.
+    @param r The Redis cache client
+    @param author The username of the Reddit user
+    @return the list of JSON records stored for the author
+    """
+    pipe = r.pipeline(transaction=False)
+    _read_index(pipe, author)
+    with METRICS.timer("redis", op="history"):
+        live_ids, records = pipe.execute()
+    return _parse_index(r, author, live_ids, records)
+
+
+def fuzzy_match(a, b, threshold: int = HASH_DISTANCE_THRESHOLD) -> bool:
     if "hash" not in a or "hash" not in b:
         return False
-    if a["hash"] == b["hash"]:
+    if hash_match(a, b, threshold):
         return True
+    return title_match(a, b)
+
 
-    if "title" not in a or "title" not in b:
+def hash_match(a, b, threshold: int = HASH_DISTANCE_THRESHOLD) -> bool:
+    if "hash" not in a or "hash" not in b:
         return False
-    title_a = a["title"].lower()
-    title_b = b["title"].lower()
-    ratio = fuzz.token_set_ratio(title_a, title_b)
-    if ratio < FUZZ_THRESHOLD:
+    if a["hash"] == b["hash"]:
+        return True
+    hash_a = parse_hash(a["hash"])
+    hash_b = parse_hash(b["hash"])
+    if hash_a is None or hash_b is None:
         return False
+    return hamming_distance(hash_a, hash_b) <= threshold
+
+
+def parse_hash(val) -> Optional[int]:
+    """
+    Image hashes are decoded to ints from the compact records. Legacy
+    records store them as decimal strings, or "None" if the image could
+    not be hashed.
+    """
+    if val is None:
+        return None
+    try:
+        return int(val)
+    except ValueError:
+        return None
+
+
+def title_match(a, b) -> bool:
+    return similar_title(a, [b]) is not None
+
+
+def similar_title(post: Dict, history: List[Dict]) -> Optional[Dict]:
+    """
+    Find a record in the history with a similar title, that was posted
+    around the same time. Records are first narrowed down by date, and by
+    a cheap upper bound on the fuzzy ratio, see _may_be_similar. Only the
+    records that are left get the more expensive fuzzy ratio, which is
+    scored in a single batch.
+    @param post the JSON record of the candidate post
+    @param history the JSON records to compare against
+    @return the first similar record, or None if there are none
+    """
+    if len(history) < 1:
+        return None  # skip tokenizing the title, nothing to compare it to
+    tokens = _tokens(post)
+    ts = _timestamp(post)
+    if tokens is None or ts is None:
+        return None
+    words = set(tokens)
+    chars = collections.Counter(" ".join(words))
+    window = ONE_DAY.total_seconds()
+
+    survivors = []
+    for p in history:
+        other_tokens = _tokens(p)
+        other_ts = _timestamp(p)
+        if other_tokens is None or other_ts is None or abs(ts - other_ts) >= window:
+            continue
+        if _may_be_similar(words, chars, other_tokens):
+            survivors.append((p, " ".join(other_tokens)))
+    if len(survivors) < 1:
+        return None
+
+    # only imported when an author has history to compare against
+    from thefuzz import fuzz, process
+
+    # the tokens are already normalized, so skip the processor
+    choices = {i: title for i, (_, title) in enumerate(survivors)}
+    with METRICS.timer("fuzzy_match"):
+        best = process.extractOne(
+            " ".join(tokens),
+            choices,
+            processor=None,
+            scorer=fuzz.token_set_ratio,
+            score_cutoff=FUZZ_THRESHOLD,
+        )
+    if best is None:
+        return None
+    return survivors[best[2]][0]
+
+
+def _may_be_similar(words: Set[str], chars: Counter, other_tokens: List[str]) -> bool:
+    # an upper bound on token_set_ratio, so that no title it would match
+    # is skipped. Titles that share a word are always compared. Otherwise
+    # the ratio is that of the two sets of words, each joined, and it can't
+    # be more than the share of characters that the two have in common.
+    # That still lets "burger" match "cheeseburger".
+    other_words = set(other_tokens)
+    if not words.isdisjoint(other_words):
+        return True
+    other_chars = collections.Counter(" ".join(other_words))
+    common = sum((chars & other_chars).values())
+    total = sum(chars.values()) + sum(other_chars.values())
+    # the ratio is rounded before it's compared to the threshold
+    return total > 0 and 200 * common >= (FUZZ_THRESHOLD - 0.5) * total
+
+
+def tokenize(title: str) -> List[str]:
+    """
+    Normalize a title into the words that are compared by the fuzzy
+    matching. This is the same processing as full_process with force_ascii
+    in the pinned thefuzz 0.19, which token_set_ratio does internally, so
+    comparing the joined tokens gives the same ratio as comparing the
+    original titles.
+    It's done here rather than with thefuzz, since every recorded post is
+    tokenized, and thefuzz is only needed once there's history to match.
+    """
+    return NON_WORD.sub(" ", title.translate(LATIN_1)).lower().split()
+
+
+def match_fields(post: Dict) -> Dict:
+    """
+    Add the precomputed fields used for fuzzy matching to a record, so
+    that they don't need to be computed for every comparison.
+    @param post the JSON record of a post
+    @return the same record, with "tokens" and "ts" set if possible
+    """
+    tokens = _tokens(post)
+    if tokens is not None:
+        post["tokens"] = tokens
+    ts = _timestamp(post)
+    if ts is not None:
+        post["ts"] = ts
+    return post
+
+
+def _tokens(post: Dict) -> Optional[List[str]]:
+    # older records only have the title
+    if "tokens" in post:
+        return post["tokens"]
+    if "title" in post and post["title"] is not None:
+        return tokenize(post["title"])
+    return None
 
-    if "date" not in a or "date" not in b:
-        return False
 
-    date1 = datetime.strptime(a["date"], DATETIME_FMT)
-    date2 = datetime.strptime(b["date"], DATETIME_FMT)
-    return abs(date1 - date2) < ONE_DAY
+def _timestamp(post: Dict) -> Optional[int]:
+    # older records only have the formatted date
+    if "ts" in post:
+        return post["ts"]
+    if "date" in post:
+        return int(datetime.strptime(post["date"], DATETIME_FMT).timestamp())
+    return None
@@ -0,0 +1,111 @@
+from datetime import timedelta
+from metrics import METRICS
+from redis import Redis
+from typing import Dict, List, Optional
+import math
+
+
+# bounds for the adapted limit. 100 is the most Reddit returns per request
+MIN_LIMIT = 5
+MAX_LIMIT = 100
+# how many of the latest runs the limit is based on
+WINDOW = 50
+# runs needed before the limit adapts, until then the configured LIMIT is used
+MIN_RUNS = 5
+# fetch enough posts for this share of the latest runs to find a new one
+QUANTILE = 0.9
+# extra room on top of that, since the history keeps filling up
+HEADROOM = 1.25
+# subreddits that haven't been posted from in this long start over
+HISTORY_TTL = timedelta(weeks=2)
+
+
+class LimitController:
+    """
+    Adapts how many hot posts to fetch for each set of subreddits, from how
+    deep into the listing the latest runs had to go to find a new post.
+    Too low a limit means falling back to a post that was already used, and
+    too high a limit wastes Reddit requests and image downloads. As the
+    history of used posts fills up, new posts are found further down, so the
+    limit grows with it.
+    Each run's depth is pushed to the `depth:<subreddits>` list in Redis, as
+    the number of posts it examined, followed by a + if it found nothing new.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        min_limit: int = MIN_LIMIT,
+        max_limit: int = MAX_LIMIT,
+        window: int = WINDOW,
+        quantile: float = QUANTILE,
+    ):
+        self.redis = redis
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window = window
+        self.quantile = quantile
+
+    def record(self, subs: str, depth: int, found: bool):
+        """
+        @param subs the subreddits, separated by +
+        @param depth how many posts the run examined, up to and including
+                     the new post it found
+        @param found False if every post it examined was already used
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.lpush(self._key(subs), f"{depth}" if found else f"{depth}+")
+        pipe.ltrim(self._key(subs), 0, self.window - 1)
+        pipe.expire(self._key(subs), HISTORY_TTL)
+        pipe.execute()
+        METRICS.incr("selection_depth_runs", result="found" if found else "miss")
+
+    def stats(self, subs: str, default: int) -> Dict:
+        """
+        The history of the latest runs, and the number of hot posts the next
+        run should fetch, which is both how many it asks Reddit for at once
+        and where it stops looking.
+        @param subs the subreddits, separated by +
+        @param default the configured LIMIT, used until there's enough history
+        @return the number of runs in the history, how many of them found
+                nothing new, the median and quantile depths needed, and the
+                limit that follows from them, within the bounds
+        """
+        history = [_str(v) for v in self.redis.lrange(self._key(subs), 0, -1)]
+        needed = sorted(_needed(entry) for entry in history)
+        misses = sum(1 for entry in history if entry.endswith("+"))
+        if len(needed) < MIN_RUNS:
+            limit = default
+        else:
+            limit = math.ceil(_percentile(needed, self.quantile) * HEADROOM)
+        limit = max(self.min_limit, min(limit, self.max_limit))
+        METRICS.set("adaptive_limit", limit, subs=subs)
+        return {
+            "runs": len(needed),
+            "misses": misses,
+            "median": _percentile(needed, 0.5),
+            "quantile": _percentile(needed, self.quantile),
+            "limit": limit,
+        }
+
+    def _key(self, subs: str) -> str:
+        return f"depth:{subs}"
+
+
+def _needed(entry: str) -> int:
+    # a run that found nothing needed to go deeper than it did, by an
+    # unknown amount. doubling grows the limit quickly, up to the bound
+    if entry.endswith("+"):
+        return max(int(entry[:-1]) * 2, 1)
+    return int(entry)
+
+
+def _percentile(values: List[int], q: float) -> Optional[int]:
+    # nearest rank, so the result is always a depth that was seen
+    if len(values) < 1:
+        return None
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+
+def _str(val) -> str:
+    return val.decode() if isinstance(val, bytes) else val
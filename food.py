@@ -1,143 +1,580 @@
-from deduplicate_util import already_posted
-from food_post import FoodPost
-import os
-import json
-from typing import List, Optional
-from datetime import timedelta
+from deduplicate_util import (
+    MATCH,
+    TIME_TO_LIVE,
+    claim_post,
+    is_duplicate,
+    least_recently_posted,
+    needs_image_hash,
+    prefetch_candidates,
+    verdict,
+)
+from bloom import RotatingBloomFilter
+from context import IMAGE_TIMEOUT, SEARCH_SECONDS, AppContext
+from food_post import FoodPost, PostRef, prefetch_image_hashes
+from image_cache import ImageHashCache
+from itertools import count, islice
+from listing import fetch_deeper, fetch_multireddit
+from metrics import METRICS
+from outbox import LEASE, delivery_key
+from reservoir import Reservoir
+from webhook import Webhook, deliver_all
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 from praw import Reddit
-from redis import Redis, from_url as init_redis_client
+from redis import Redis
+from datetime import timedelta
+from depth import LimitController
+from functools import partial
+import os
 import requests
-import random
+import signal
 import sys
-import schedule
 import time
 import queue
 import threading
+import uuid
 
+# only needed for type annotations. The async runner is only imported when
+# it is used, see main()
+if TYPE_CHECKING:
+    from runner import Job
 
-# Keep records in Redis for at most one week. Reddit moves fast,
-# so although this doesn't prevent karma farmer reposts from
-# showing up, a week is still a long time.
-TIME_TO_LIVE = timedelta(weeks=1)
+
+# posts are built and checked against Redis this many at a time
+BATCH_SIZE = 25
+# max number of posts remembered for the fallback, see get_submission
+FALLBACK_CANDIDATES = 32
+# seconds between checks for due deliveries, when the outbox is empty
+DELIVERY_POLL_INTERVAL = 1.0
+
+
+def find_new_posts(
+    redis_client: Redis,
+    reddit_client: Reddit,
+    subs: str,
+    request_limit: int,
+    hash_workers: int = 1,
+    image_timeout: float = IMAGE_TIMEOUT,
+    cache: Optional[ImageHashCache] = None,
+    session: Optional[requests.Session] = None,
+    seen: Optional[Reservoir[PostRef]] = None,
+    listing: Callable[[Reddit, str, int], Iterable] = fetch_multireddit,
+    id_filter: Optional[RotatingBloomFilter] = None,
+    global_images: bool = False,
+    search_requests: int = 0,
+    search_seconds: float = SEARCH_SECONDS,
+) -> Iterator[Tuple[str, FoodPost]]:
+    """
+    Lazily go through the "hot" posts of the given subreddits, in order,
+    and yield the ones that haven't been posted yet. Nothing is recorded
+    in Redis, that's up to the caller.
+    See get_submission for the parameters.
+    @param seen if given, every post that was looked at is offered to it
+    @param listing fetches the ranked hot posts, see listing.py
+    @param id_filter in-memory filter of recently posted IDs, see bloom.py
+    @param global_images compare images against every author's posts
+    @param search_requests max number of extra pages to fetch once the hot
+                           listing runs out, see listing.fetch_deeper
+    @param search_seconds stop fetching and checking extra pages after this
+                          long, counting from the start of the search
+    @return (author, post) pairs for the posts that are new
+    """
+    started = time.monotonic()
+    # IDs of the posts looked at so far. Only the IDs are kept, so that
+    # memory doesn't grow with the limit.
+    examined: Set[str] = set()
+    # the last post of the hot listing, to continue paging from
+    last_id: Optional[str] = None
+    ranks = count()
+
+    def unexamined(page: Iterable) -> Iterator:
+        nonlocal last_id
+        for submission in page:
+            if submission.id not in examined:
+                examined.add(submission.id)
+                last_id = submission.id
+                yield submission
+
+    def check(page: Iterable, deadline: Optional[float] = None):
+        return _new_posts(
+            redis_client,
+            unexamined(page),
+            ranks,
+            hash_workers,
+            image_timeout,
+            cache,
+            session,
+            seen,
+            id_filter,
+            global_images,
+            deadline,
+        )
+
+    yield from check(listing(reddit_client, subs, request_limit))
+    if search_requests < 1:
+        return
+
+    # every hot post was already used, so keep looking a little deeper
+    # rather than repost something, within a budget so the run still
+    # finishes on time.
+    deadline = started + search_seconds
+    after = f"t3_{last_id}" if last_id is not None else None
+    pages = fetch_deeper(reddit_client, subs, request_limit, after)
+    for _ in range(search_requests):
+        if time.monotonic() >= deadline:
+            METRICS.incr("deep_search_stops", reason="time")
+            return
+        with METRICS.timer("reddit_listing", kind="deep"):
+            page = next(pages, None)
+        if page is None:
+            return
+        METRICS.incr("deep_search_pages")
+        yield from check(page, deadline)
+    METRICS.incr("deep_search_stops", reason="requests")
+
+
+def _new_posts(
+    redis_client: Redis,
+    submissions: Iterator,
+    ranks: Iterator[int],
+    hash_workers: int,
+    image_timeout: float,
+    cache: Optional[ImageHashCache],
+    session: Optional[requests.Session],
+    seen: Optional[Reservoir[PostRef]],
+    id_filter: Optional[RotatingBloomFilter],
+    global_images: bool,
+    deadline: Optional[float],
+) -> Iterator[Tuple[str, FoodPost]]:
+    # runs the dedup pipeline over one page of submissions, a batch at a
+    # time, so that only one batch of posts is held in memory at once.
+    while True:
+        with METRICS.timer("reddit_listing"):
+            batch = list(islice(submissions, BATCH_SIZE))
+        if len(batch) < 1:
+            return
+        candidates = []
+        for submission in batch:
+            # deleted accounts have no author to check the history of, and
+            # reading them would fail the whole batch
+            author = getattr(submission.author, "name", None)
+            if author is not None:
+                fp = FoodPost.from_submission(submission, cache, session, image_timeout)
+                candidates.append((author, fp))
+        yield from _check_batch(
+            redis_client,
+            candidates,
+            ranks,
+            hash_workers,
+            image_timeout,
+            session,
+            seen,
+            id_filter,
+            global_images,
+            deadline,
+        )
+        if deadline is not None and time.monotonic() >= deadline:
+            return
+
+
+def _check_batch(
+    redis_client: Redis,
+    candidates: List[Tuple[str, FoodPost]],
+    ranks: Iterator[int],
+    hash_workers: int,
+    image_timeout: float,
+    session: Optional[requests.Session],
+    seen: Optional[Reservoir[PostRef]],
+    id_filter: Optional[RotatingBloomFilter],
+    global_images: bool,
+    deadline: Optional[float],
+) -> Iterator[Tuple[str, FoodPost]]:
+    # check the whole batch against Redis in a couple of round trips,
+    # rather than a few per candidate
+    history = prefetch_candidates(redis_client, candidates, id_filter)
+    for i, (author, fp) in enumerate(candidates):
+        if deadline is not None and time.monotonic() >= deadline:
+            METRICS.incr("deep_search_stops", reason="time")
+            return
+        if hash_workers > 1 and needs_image_hash(
+            redis_client, author, fp, history.get(author), global_images
+        ):
+            # hash this image along with the next few that will need it
+            upcoming = (
+                c
+                for a, c in candidates[i:]
+                if needs_image_hash(redis_client, a, c, history.get(a), global_images)
+            )
+            batch = list(islice(upcoming, hash_workers))
+            prefetch_image_hashes(batch, hash_workers, image_timeout, session)
+        # the image hash is only computed if the cheaper checks pass
+        duplicate = is_duplicate(
+            redis_client, author, fp, history.get(author), global_images
+        )
+        if seen is not None:
+            seen.add(fp.ref(author, next(ranks), fp.checks.get(MATCH)))
+        METRICS.incr("candidates_examined")
+        METRICS.incr("dedup_verdicts", reason=verdict(fp.checks))
+        if not duplicate:
+            yield author, fp
 
 
 def get_submission(
-    redis_client: Redis, reddit_client: Reddit, subs: str, request_limit: int
+    redis_client: Redis,
+    reddit_client: Reddit,
+    subs: str,
+    request_limit: int,
+    hash_workers: int = 1,
+    image_timeout: float = IMAGE_TIMEOUT,
+    cache: Optional[ImageHashCache] = None,
+    session: Optional[requests.Session] = None,
+    listing: Callable[[Reddit, str, int], Iterable] = fetch_multireddit,
+    id_filter: Optional[RotatingBloomFilter] = None,
+    global_images: bool = False,
+    search_requests: int = 0,
+    search_seconds: float = SEARCH_SECONDS,
+    limits: Optional[LimitController] = None,
 ) -> Optional[FoodPost]:
     """
     Retrieve a "hot" post from the list of subreddits defined in the
     'SUBREDDITS' environment variable, returning a FoodPost object
     @param redis_client  Redis client to interface with Heroku Redis
     @param reddit_client PRAW Reddit client
+    @param hash_workers  number of images to download at once. 1 downloads
+                         them one at a time, only when needed
+    @param image_timeout seconds to wait on an image host
+    @param cache         cache of image hashes, to avoid downloading images
+                         that were already seen in previous runs
+    @param session       shared session for downloading images
+    @param listing       fetches the ranked hot posts, see listing.py
+    @param id_filter     in-memory filter of recently posted IDs, see bloom.py
+    @param global_images also compare images against every author's posts,
+                         see image_index.py
+    @param search_requests max number of extra pages to fetch if every hot
+                           post was already used. 0 turns it off
+    @param search_seconds  time budget for fetching the extra pages
+    @param limits        adapts request_limit to how deep the latest runs
+                         had to look, see depth.py
     @return a "hot" post from the list of subreddits, or None if there are no
             posts, or an error occurs
     """
-    # fallback in case all of the posts are already used
-    submissions: List[FoodPost] = []
+    # fallback in case all of the posts are already used. Only a sample of
+    # the posts is kept, as tuples, so memory doesn't grow with the limit.
+    submissions: Reservoir[PostRef] = Reservoir(FALLBACK_CANDIDATES)
+    METRICS.incr("selection_runs")
+    if limits is not None:
+        stats = limits.stats(subs, request_limit)
+        print(f"Selection depth for {subs}: {stats}")
+        request_limit = stats["limit"]
     try:
-        for submission in reddit_client.subreddit(subs).hot(limit=request_limit):
-            fp = FoodPost.from_submission(submission)
-            submissions.append(fp)
-            fp_hash = fp.to_json()
-            if not already_posted(redis_client, submission.author.name, fp_hash):
-                redis_client.set(
-                    f"{submission.author.name}/{fp.id}",
-                    json.dumps(fp_hash),
-                    ex=TIME_TO_LIVE,
-                )
+        for author, fp in find_new_posts(
+            redis_client,
+            reddit_client,
+            subs,
+            request_limit,
+            hash_workers,
+            image_timeout,
+            cache,
+            session,
+            submissions,
+            listing,
+            id_filter,
+            global_images,
+            search_requests,
+            search_seconds,
+        ):
+            # another instance sharing the Redis can pick the same post in
+            # between the checks and here, in which case it's theirs.
+            if claim_post(redis_client, author, fp.to_json(), TIME_TO_LIVE, id_filter):
+                if limits is not None:
+                    limits.record(subs, submissions.count, found=True)
                 return fp  # short-circuit early if we know this is new
+            print(f"Post {fp.id} by {author} was claimed by another instance.")
+        # if we did not return before this, then all of the posts that were
+        # looked at have already been posted. rather than search again, to
+        # limit execution time, default to the one that went out the longest
+        # time ago.
+        fallback = least_recently_posted(redis_client, submissions.items)
+        if limits is not None and submissions.count > 0:
+            limits.record(subs, submissions.count, found=False)
     except Exception as e:
         print(f"An unexpected exception occurred: {repr(e)}")
         return None
-    # if we did not return before this, then all of the hot posts
-    # returned have already been posted. default to return a random one,
-    # rather than try the search again to limit execution time
-    if len(submissions) > 0:
-        print("Picking random submission")
-        return random.choice(submissions)
+    if fallback is not None:
+        print("Picking least recently posted submission")
+        METRICS.incr("selection_fallbacks")
+        fp = fallback.to_post()
+        fp.reposted = True
+        return fp
     else:
         print("No submissions found from Reddit for supplied subreddits")
         return None
 
 
-def post():
-    """
-    Initialize the Reddit and Redis clients, get a random Reddit post
-    from the configured subreddits, and post to the webhook URL
-    """
-    # Read the Redis URL from the environment. This value gets injected
-    # by Heroku
-    print("Finding Reddit submission")
-    r = Redis(
-        host=os.getenv("REDISHOST"),
-        username=os.getenv("REDISUSER"),
-        password=os.getenv("REDISPASSWORD"),
-        port=os.getenv("REDISPORT"),
-        decode_responses=True,
-    )
-    print("Instantiated Redis client")
-
-    # TODO: modify this to allow for multiple webhook URLs
-    webhook_url = os.getenv("WEBHOOK_URL")
-
-    reddit_client_id = os.getenv("REDDIT_CLIENT_ID")
-    reddit_client_secret = os.getenv("REDDIT_CLIENT_SECRET")
-    # expected to be a list of subreddits to search, separated by +
-    # example: "foo+bar+baz" where foo, bar, and baz are all subreddits
-    subs = os.getenv("SUBREDDITS")
-    request_limit = int(os.getenv(key="LIMIT", default="24"))
-
-    if webhook_url is None:
-        raise Exception("No webhook URL specified in environment")
-    if reddit_client_id is None or reddit_client_secret is None:
-        raise Exception("Reddit API credentials not configured in environment")
-    if subs is None:
-        raise Exception("No subreddits list defined in environment")
-
-    reddit = Reddit(
-        client_id=reddit_client_id,
-        client_secret=reddit_client_secret,
-        user_agent="discord:food_waifu:v0.2",
-    )
-    print("Instantiated Reddit client")
-
-    submission = get_submission(r, reddit, subs, request_limit)
-    if submission is None:
+def post(ctx: Optional[AppContext] = None, webhooks: Optional[List[Webhook]] = None):
+    """
+    Get a random Reddit post for each of the configured webhooks, and
+    post to them. Webhooks that share the same subreddits share the same
+    post, so the scraping and deduplication is only done once for them.
+    @param ctx clients and configuration to reuse. If not given, they are
+               built from the environment for just this run
+    @param webhooks only post to these webhooks, instead of all of them
+    """
+    if ctx is None:
+        ctx = AppContext.from_env()
+
+    groups: Dict[str, List[Webhook]] = {}
+    for hook in webhooks or ctx.webhooks:
+        groups.setdefault(hook.subs, []).append(hook)
+
+    deliveries = []
+    run = uuid.uuid4().hex[:12]
+    selecting = time.perf_counter()
+    for subs, hooks in groups.items():
+        submission = None
+        pool = ctx.pools.get(subs)
+        while pool is not None and submission is None:
+            popped = pool.pop()
+            if popped is None:
+                break
+            author, candidate = popped
+            if claim_post(
+                ctx.redis, author, candidate.to_json(), TIME_TO_LIVE, ctx.id_filter
+            ):
+                print(f"Using prefetched submission {candidate}")
+                submission = candidate
+        if submission is None:
+            print(f"Finding Reddit submission from {subs}")
+            submission = get_submission(
+                ctx.redis,
+                ctx.reddit,
+                subs,
+                ctx.request_limit,
+                ctx.hash_workers,
+                ctx.image_timeout,
+                ctx.image_cache,
+                ctx.session,
+                listing=ctx.listing,
+                id_filter=ctx.id_filter,
+                global_images=ctx.global_images,
+                search_requests=ctx.search_requests,
+                search_seconds=ctx.search_seconds,
+                limits=ctx.limits,
+            )
+        if submission is None:
+            print(f"No Reddit submission found for {subs}")
+            continue
+        data = {
+            "username": "Food from Reddit",
+            "avatar_url": "https://i.imgur.com/gLP2Tl0.jpeg",
+            "embeds": [submission.to_embed()],
+        }
+        print(f"Submitting {data} to {len(hooks)} Discord webhook(s)")
+        deliveries.extend(
+            {
+                "url": hook.url,
+                "data": data,
+                # a repost was already delivered, so it's a new delivery
+                # for this run rather than a duplicate of the earlier one
+                "key": delivery_key(
+                    submission.id,
+                    hook.url,
+                    run if submission.reposted else None,
+                ),
+            }
+            for hook in hooks
+        )
+    METRICS.observe("run_phase", time.perf_counter() - selecting, phase="select")
+    cache = ctx.image_cache
+    print(f"Image hash cache: {cache.stats}, hit rate {cache.hit_rate():.0%}")
+
+    if ctx.metrics_file is not None:
+        METRICS.dump(ctx.metrics_file)
+    if len(deliveries) < 1:
         raise Exception("No Reddit submission found")
-    embed = submission.to_embed()
-    data = {
-        "username": "Food from Reddit",
-        "avatar_url": "https://i.imgur.com/gLP2Tl0.jpeg",
-        "embeds": [embed],
-    }
-    print(f"Submitting {data} to Discord webhook")
-    result = requests.post(url=webhook_url, json=data)
-    result.raise_for_status()
+    if ctx.outbox is not None:
+        # the delivery worker sends them, so a slow Discord doesn't hold
+        # up this run, and a failed delivery is retried instead of lost
+        with METRICS.timer("run_phase", phase="enqueue"):
+            queued = [
+                ctx.outbox.enqueue(d["url"], d["data"], d["key"]) for d in deliveries
+            ]
+        if not any(queued):
+            raise Exception("Every delivery was already queued or delivered")
+        if not all(queued):
+            print(f"{queued.count(False)} deliveries were already queued or delivered")
+        return
+    with METRICS.timer("run_phase", phase="deliver"):
+        errors = deliver_all(ctx.session, deliveries, workers=len(deliveries))
+    failed = [e for e in errors if e is not None]
+    if len(failed) > 0:
+        raise Exception(f"{len(failed)} of {len(deliveries)} deliveries failed")
 
-    print("Payload delivered successfully, code {}.".format(result.status_code))
 
+def prefetch_main(ctx: AppContext):
+    """
+    Keep the prefetched posts fresh in between scheduled runs, so that
+    a run only has to pop a post from the pool and deliver it.
+    """
+    print("Running prefetch thread")
+    while True:
+        for subs, pool in ctx.pools.items():
+            try:
+                pool.refresh(
+                    find_new_posts(
+                        ctx.redis,
+                        ctx.reddit,
+                        subs,
+                        ctx.request_limit,
+                        ctx.hash_workers,
+                        ctx.image_timeout,
+                        ctx.image_cache,
+                        ctx.session,
+                        listing=ctx.listing,
+                        id_filter=ctx.id_filter,
+                        global_images=ctx.global_images,
+                    )
+                )
+            except Exception as e:
+                # the scheduled run falls back to scraping on its own
+                print(f"Failed to prefetch posts from {subs}: {repr(e)}")
+        time.sleep(ctx.prefetch_interval)
 
-jobqueue = queue.Queue()
-schedule.every().hour.at(":00").do(jobqueue.put, post)
 
+def delivery_main(ctx: AppContext, stop: threading.Event):
+    """
+    Drain the outbox that runs enqueue their deliveries to, until stop is
+    set. A batch that is being sent when that happens is finished first, so
+    that its deliveries aren't sent again once their lease runs out.
+    """
+    print("Running delivery thread")
+    while not stop.is_set():
+        try:
+            taken = ctx.outbox.deliver(ctx.session, workers=len(ctx.webhooks))
+        except Exception as e:
+            # the deliveries stay in the outbox, to be taken again
+            print(f"Failed to deliver from the outbox: {repr(e)}")
+            taken = 0
+        if taken < 1:
+            stop.wait(DELIVERY_POLL_INTERVAL)
+    print("Delivery thread stopped")
+
+
+def stop_delivery(stop: threading.Event, thread: Optional[threading.Thread]):
+    """
+    Stop the delivery thread, and wait for the batch it is sending.
+    """
+    stop.set()
+    if thread is None:
+        return
+    thread.join(timeout=LEASE.total_seconds())
+    if thread.is_alive():
+        print("Delivery thread did not stop in time")
 
-def worker_main():
+
+def worker_main(ctx: AppContext, jobs: queue.Queue):
     print("Running job exec thread")
     while True:
-        job_func = jobqueue.get()
+        job_func = jobs.get()
+        if job_func is None:
+            break  # shutting down
         try:
-            job_func()
+            job_func(ctx)
         except Exception as e:
             # swallow the exception so it moves on gracefully
             print(repr(e))
-        jobqueue.task_done()
+        jobs.task_done()
 
 
-if __name__ == "__main__":
-    print("Starting cron scheduler")
+def schedule_jobs(jobs: queue.Queue):
+    """
+    Queue a run at the top of every hour. This only happens when running
+    on the schedule, so that importing this module has no side effects.
+    @param jobs the queue that the worker thread runs jobs from
+    @return the schedule module, to run the pending jobs with
+    """
+    import schedule
+
+    schedule.every().hour.at(":00").do(jobs.put, post)
+    return schedule
+
 
-    worker_thread = threading.Thread(target=worker_main)
+def async_jobs(ctx: AppContext) -> List["Job"]:
+    """
+    One job for each set of webhooks that share subreddits and an interval,
+    so that each feed runs on its own schedule.
+    """
+    from runner import Job
+
+    feeds: Dict[Tuple[str, int], List[Webhook]] = {}
+    for hook in ctx.webhooks:
+        feeds.setdefault((hook.subs, hook.interval), []).append(hook)
+    return [
+        Job(
+            f"{subs} every {interval}m",
+            partial(post, ctx, hooks),
+            interval=timedelta(minutes=interval),
+        )
+        for (subs, interval), hooks in feeds.items()
+    ]
+
+
+def main():
+    # created once, so that every run reuses the same connections
+    context = AppContext.from_env()
+    if context.metrics_port is not None:
+        METRICS.serve(context.metrics_port)
+    if context.prefetch_interval > 0:
+        prefetch_thread = threading.Thread(
+            target=prefetch_main, args=(context,), daemon=True
+        )
+        prefetch_thread.start()
+    delivery_stop = threading.Event()
+    delivery_thread = None
+    if context.outbox is not None:
+        delivery_thread = threading.Thread(
+            target=delivery_main, args=(context, delivery_stop), daemon=True
+        )
+        delivery_thread.start()
+    on_stop = partial(stop_delivery, delivery_stop, delivery_thread)
+
+    if os.getenv("RUNNER") == "async":
+        import asyncio
+        from runner import AsyncRunner
+
+        print("Starting async runner")
+        max_jobs = int(os.getenv(key="MAX_CONCURRENT_JOBS", default="2"))
+        runner = AsyncRunner(async_jobs(context), max_jobs, on_stop=on_stop)
+        asyncio.run(runner.run())
+        sys.exit(0)
+
+    print("Starting cron scheduler")
+    jobs = queue.Queue()
+    scheduler = schedule_jobs(jobs)
+    worker_thread = threading.Thread(target=worker_main, args=(context, jobs))
     worker_thread.start()
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    stopping = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopping.set())
+    while not stopping.is_set():
+        scheduler.run_pending()
+        stopping.wait(1)
+
+    print("Shutting down scheduler")
+    # the run in progress finishes, then the worker stops
+    jobs.put(None)
+    worker_thread.join()
+    on_stop()
+
+
+if __name__ == "__main__":
+    main()
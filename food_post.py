@@ -1,6 +1,10 @@
 from datetime import datetime
+import html
+import math
 from image_util import compute_image_hash
-from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, NamedTuple, Optional
+import requests
 
 
 GALLERY_URL = "https://www.reddit.com/gallery/"
@@ -13,18 +17,52 @@ class FoodPost:
     # title - the Post title
     # post_url - the permalink for this post
     # image_url - the url for the associated image of a submission
+    # reposted - True if every candidate was already used, and this one is
+    #            being sent again, see food.get_submission
+    # A run builds one of these for every candidate, so they use slots
+    # instead of a dict per instance.
+    __slots__ = (
+        "id",
+        "title",
+        "post_url",
+        "image_url",
+        "preview_url",
+        "img_hash",
+        "hash_failed",
+        "cache",
+        "session",
+        "timeout",
+        "checks",
+        "date_posted",
+        "reposted",
+    )
+    color = 0xDB5172
+
     def __init__(self, **kwargs):
         self.id = kwargs.get("id")
         self.title = kwargs.get("title")
         self.post_url = kwargs.get("permalink")
         self.image_url = kwargs.get("image_url")
+        # smaller rendition of the image, only used to compute the hash
+        self.preview_url = kwargs.get("preview_url")
         self.img_hash = kwargs.get("img_hash")  # for testing
-        self.color = 0xDB5172
+        self.hash_failed = False
+        # optional ImageHashCache, shared between posts and runs
+        self.cache = kwargs.get("cache")
+        # optional requests.Session used to download the image
+        self.session = kwargs.get("session")
+        # seconds to wait on the image host, so a stalled host can't hang
+        # whichever step ends up hashing the image
+        self.timeout: Optional[float] = kwargs.get("timeout")
+        # memoized results of the deduplication stages, keyed by stage name.
+        # see deduplicate_util.is_duplicate
+        self.checks: Dict[str, bool] = {}
         ts = kwargs.get("created_utc")
         if ts is not None and ts > 0:
             self.date_posted = datetime.fromtimestamp(ts)
         else:
             self.date_posted = None
+        self.reposted = False
 
     def __str__(self):
         return f"{self.title} : {self.post_url}"
@@ -44,12 +82,37 @@ class FoodPost:
             data["image"] = {"url": self.image_url}
         return data
 
-    def image_hash(self) -> Optional[int]:
-        if self.img_hash is None:
-            self.img_hash = compute_image_hash(self.image_url)
+    def image_hash(
+        self, session: Optional[requests.Session] = None, timeout: float = None
+    ) -> Optional[int]:
+        if self.img_hash is not None or self.hash_failed:
+            return self.img_hash
+        # hashes are cached by the URL that gets embedded, even when the
+        # preview is what gets downloaded, since that URL is the stable one.
+        if self.cache is not None and self.image_url is not None:
+            found, h = self.cache.lookup(self.image_url)
+            if found:
+                self.img_hash = h
+                self.hash_failed = h is None
+                return h
+
+        # the hash is perceptual, so a downscaled preview hashes the same
+        # as the original, for a fraction of the download.
+        url = self.preview_url or self.image_url
+        try:
+            self.img_hash = compute_image_hash(
+                url, session or self.session, timeout or self.timeout
+            )
+        except (requests.RequestException, OSError, ValueError) as e:
+            # a broken image shouldn't fail the whole run, and there's no
+            # point in trying to download it again.
+            print(f"Failed to hash image {url}: {repr(e)}")
+            self.hash_failed = True
+        if self.cache is not None and self.image_url is not None:
+            self.cache.store(self.image_url, self.img_hash)
         return self.img_hash
 
-    def to_json(self) -> Dict:
+    def to_json(self, include_hash: bool = True) -> Dict:
         """
         Transform the submission and it's hash into a Python
         dictionary, so that it can be converted into a JSON string
@@ -61,16 +124,25 @@ class FoodPost:
             "hash": "1234567890",
             "title" "Something here",
             "date": "2022-01-01",
+            "ts": 1640995200,
         }
-        @param img_hash the hash of the byte array of the Image from PIL
+        @param include_hash whether to download the image and include its hash.
+                            Skipping it avoids the download when only the
+                            cheaper fields are needed.
         @return dictionary to be persisted into the Redis cache.
         """
-        return {
-            "id": self.id,
-            "hash": str(self.image_hash()),
-            "title": self.title,
-            "date": self.date_posted.strftime(DATETIME_FMT),
-        }
+        data = {"id": self.id, "title": self.title}
+        if self.date_posted is not None:
+            data["date"] = self.date_posted.strftime(DATETIME_FMT)
+            data["ts"] = int(self.date_posted.timestamp())
+        if include_hash:
+            data["hash"] = str(self.image_hash())
+        return data
+
+    def ref(self, author: str, rank: int, match: Optional[str] = None) -> "PostRef":
+        return PostRef(
+            author, self.id, self.title, self.post_url, self.image_url, rank, match
+        )
 
     # Given a Reddit submission title, truncate the title if it's too long
     # https://github.com/SaxyPandaBear/discord-food-bot/issues/28
@@ -87,9 +159,10 @@ class FoodPost:
 
     # Take a Reddit submission object, and transform that into a FoodPost
     @staticmethod
-    def from_submission(submission):
+    def from_submission(submission, cache=None, session=None, timeout=None):
         sub_id = submission.id
         url = FoodPost.derive_image_url(submission)
+        preview_url = FoodPost.derive_preview_url(submission)
         # permalink does not give the full URL, so build it instead.
         permalink = f"https://www.reddit.com{submission.permalink}"
         title = submission.title
@@ -98,8 +171,12 @@ class FoodPost:
             id=sub_id,
             title=title,
             image_url=url,
+            preview_url=preview_url,
             permalink=permalink,
             created_utc=created_utc,
+            cache=cache,
+            session=session,
+            timeout=timeout,
         )
 
     @staticmethod
@@ -133,3 +210,105 @@ class FoodPost:
         if query_param_idx >= 0:
             url = url[:query_param_idx]
         return url
+
+    @staticmethod
+    def derive_preview_url(submission) -> Optional[str]:
+        """
+        Reddit generates a few downscaled renditions of submitted images.
+        Pick the smallest one, since that's all that's needed for hashing.
+        The attributes are read from the instance dictionary because PRAW
+        lazily fetches the whole submission again if an attribute is missing.
+        @param submission The submission object from PRAW
+        @return URL of the smallest preview, or None if there aren't any
+        """
+        if submission is None:
+            return None
+        attrs = vars(submission)
+        if (attrs.get("url") or "").startswith(GALLERY_URL):
+            # gallery previews are listed under "p" for each image
+            images = attrs.get("media_metadata") or {}
+            ids = sorted(images)
+            if len(ids) < 1 or not isinstance(images[ids[0]], dict):
+                return None
+            renditions = [
+                {"url": p.get("u"), "width": p.get("x", 0)}
+                for p in images[ids[0]].get("p", [])
+            ]
+        else:
+            images = (attrs.get("preview") or {}).get("images") or []
+            if len(images) < 1:
+                return None
+            renditions = images[0].get("resolutions") or []
+
+        renditions = [r for r in renditions if r.get("url")]
+        if len(renditions) < 1:
+            return None
+        smallest = min(renditions, key=lambda r: r.get("width", 0))
+        # the API returns HTML escaped URLs
+        return html.unescape(smallest["url"])
+
+
+class PostRef(NamedTuple):
+    """
+    Just enough of a post to deliver it, without its image hash, or the
+    clients and memoized checks that a FoodPost holds. Used to remember
+    candidates that might still be needed for the fallback.
+    """
+
+    author: str
+    id: str
+    title: str
+    post_url: str
+    image_url: Optional[str]
+    # position in the listing, lower is better
+    rank: int
+    # "author/postId" of the recorded post that this one duplicates
+    match: Optional[str] = None
+
+    def to_post(self) -> FoodPost:
+        return FoodPost(
+            id=self.id,
+            title=self.title,
+            permalink=self.post_url,
+            image_url=self.image_url,
+        )
+
+
+def prefetch_image_hashes(
+    posts: List[FoodPost],
+    workers: int,
+    timeout: float,
+    session: Optional[requests.Session] = None,
+):
+    """
+    Download and hash the images for a batch of posts concurrently, so that
+    a later call to FoodPost.image_hash returns immediately. All downloads
+    share one session, so connections to the same image host are reused.
+    Images that aren't hashed within the timeout are treated as failed, so
+    that one slow image host can't stall the run.
+    @param posts the posts that need their image hashed
+    @param workers max number of images to download at once
+    @param timeout seconds to wait for each image, and for the whole batch
+    @param session the session to share. If not given, one is created just
+                   for this batch
+    """
+    if len(posts) < 1:
+        return
+    if session is None:
+        with requests.Session() as session:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            prefetch_image_hashes(posts, workers, timeout, session)
+        return
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    futures = {pool.submit(fp.image_hash, session, timeout): fp for fp in posts}
+    # every worker gets `timeout` seconds per image it has to handle
+    deadline = timeout * math.ceil(len(posts) / workers)
+    _, not_done = wait(futures, timeout=deadline)
+    pool.shutdown(wait=False)
+    for future in not_done:
+        future.cancel()
+        futures[future].hash_failed = True
+        print(f"Timed out hashing image for {futures[future]}")
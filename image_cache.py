@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from metrics import METRICS
+from datetime import timedelta
+from redis import Redis
+from typing import Dict, Optional, Tuple
+import threading
+
+
+# Hashes of images that were downloaded successfully don't change, so keep
+# them around as long as the posts themselves. Failures might be temporary,
+# so only remember those for a day.
+HASH_TTL = timedelta(weeks=1)
+NEGATIVE_TTL = timedelta(days=1)
+# marks an image that couldn't be hashed, since Redis can't store None
+NEGATIVE = "-"
+
+
+class ImageHashCache:
+    """
+    Two tier cache of image URL -> perceptual hash. The first tier is a
+    bounded LRU in this process, and the second tier is Redis, so that
+    hashes survive restarts. Images that could not be hashed are cached
+    as None, so that they aren't downloaded again on every run.
+    The cache is shared by the image download threads, so it is thread safe.
+    """
+
+    def __init__(
+        self,
+        redis: Optional[Redis] = None,
+        max_size: int = 1024,
+        ttl: timedelta = HASH_TTL,
+        negative_ttl: timedelta = NEGATIVE_TTL,
+    ):
+        self.redis = redis
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, Optional[int]]" = OrderedDict()
+        self.stats: Dict[str, int] = {
+            "memory_hits": 0,
+            "redis_hits": 0,
+            "negative_hits": 0,
+            "misses": 0,
+        }
+
+    def lookup(self, url: str) -> Tuple[bool, Optional[int]]:
+        """
+        @param url the normalized image URL, see FoodPost.derive_image_url
+        @return whether the URL was found, and its hash. The hash is None if
+                the image previously failed to download or decode.
+        """
+        with self.lock:
+            if url in self.entries:
+                self.entries.move_to_end(url)
+                h = self.entries[url]
+                self._count("memory_hits", h)
+                return True, h
+
+        val = self.redis.get(_key(url)) if self.redis is not None else None
+        if val is None:
+            with self.lock:
+                self.stats["misses"] += 1
+            METRICS.incr("image_cache_misses")
+            return False, None
+
+        if isinstance(val, bytes):
+            val = val.decode()
+        h = None if val == NEGATIVE else int(val)
+        with self.lock:
+            self._remember(url, h)
+            self._count("redis_hits", h)
+        return True, h
+
+    def store(self, url: str, h: Optional[int]):
+        """
+        @param url the normalized image URL, see FoodPost.derive_image_url
+        @param h the hash of the image, or None if it couldn't be computed
+        """
+        with self.lock:
+            self._remember(url, h)
+        if self.redis is not None:
+            if h is None:
+                self.redis.set(_key(url), NEGATIVE, ex=self.negative_ttl)
+            else:
+                self.redis.set(_key(url), str(h), ex=self.ttl)
+
+    def hit_rate(self) -> float:
+        with self.lock:
+            hits = self.stats["memory_hits"] + self.stats["redis_hits"]
+            total = hits + self.stats["misses"]
+        return hits / total if total > 0 else 0.0
+
+    def _remember(self, url: str, h: Optional[int]):
+        self.entries[url] = h
+        self.entries.move_to_end(url)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _count(self, tier: str, h: Optional[int]):
+        self.stats[tier] += 1
+        METRICS.incr("image_cache_hits", tier=tier)
+        if h is None:
+            self.stats["negative_hits"] += 1
+
+
+def _key(url: str) -> str:
+    return f"imghash:{url}"
@@ -0,0 +1,85 @@
+from datetime import timedelta
+from image_util import HASH_SIZE, hamming_distance
+from redis import Redis
+from typing import List, Optional, Tuple
+import time
+
+
+# Image hashes are split into bands, and every recorded image is added to
+# one bucket per band, keyed by the value of its bits in that band. If two
+# hashes differ in fewer bits than there are bands, then at least one band
+# is identical (pigeonhole), so they always share a bucket. With 8 bands
+# this finds every match within a distance of 7 bits, which covers
+# HASH_DISTANCE_THRESHOLD, while a lookup only reads 8 of the 2048 buckets.
+BANDS = 8
+BAND_BITS = HASH_SIZE * HASH_SIZE // BANDS
+BAND_MASK = (1 << BAND_BITS) - 1
+
+
+def index_image(pipe, author: str, post_id: str, img_hash: int, ttl: timedelta):
+    """
+    Queue the commands that add a recorded image to its buckets. Entries
+    older than the TTL are pruned from each bucket as it is written to.
+    @param pipe Redis pipeline to queue the commands on
+    @param author The username of the Reddit user that posted the submission
+    @param post_id The ID of the submission
+    @param img_hash The perceptual hash of the submission's image
+    @param ttl how long to keep the entry for
+    """
+    now = time.time()
+    cutoff = now - ttl.total_seconds()
+    member = _member(author, post_id, img_hash)
+    for key in _bucket_keys(img_hash):
+        pipe.zadd(key, {member: now})
+        pipe.zremrangebyscore(key, "-inf", f"({cutoff}")
+        pipe.expire(key, ttl)
+
+
+def find_similar_images(
+    r: Redis,
+    img_hash: int,
+    threshold: int,
+    ttl: timedelta,
+    exclude: Optional[str] = None,
+) -> List[Tuple[str, int]]:
+    """
+    Find recorded images by any author that are close to the given hash.
+    @param r The Redis cache client
+    @param img_hash The perceptual hash of the image to look up
+    @param threshold max number of bits that can differ for a match
+    @param ttl entries older than this are ignored
+    @param exclude "author/postId" of a post to leave out of the results
+    @return ("author/postId", distance) pairs for each match, closest first
+    """
+    cutoff = time.time() - ttl.total_seconds()
+    pipe = r.pipeline(transaction=False)
+    for key in _bucket_keys(img_hash):
+        pipe.zrangebyscore(key, cutoff, "+inf")
+    members = {_str(m) for bucket in pipe.execute() for m in bucket}
+
+    matches = []
+    for member in members:
+        post_key, other = member.rsplit("|", 1)
+        if post_key == exclude:
+            continue
+        distance = hamming_distance(img_hash, int(other, 16))
+        if distance <= threshold:
+            matches.append((post_key, distance))
+    return sorted(matches, key=lambda m: (m[1], m[0]))
+
+
+def _bucket_keys(img_hash: int) -> List[str]:
+    return [
+        f"lsh:{band}:{(img_hash >> (band * BAND_BITS)) & BAND_MASK:x}"
+        for band in range(BANDS)
+    ]
+
+
+def _member(author: str, post_id: str, img_hash: int) -> str:
+    # the hash is part of the member, so that lookups don't need another
+    # round trip to filter the candidates by distance
+    return f"{author}/{post_id}|{img_hash:x}"
+
+
+def _str(val) -> str:
+    return val.decode() if isinstance(val, bytes) else val
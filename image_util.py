@@ -1,21 +1,133 @@
-from PIL import Image
-from tempfile import TemporaryFile
+from io import BytesIO
+from metrics import METRICS
+from typing import TYPE_CHECKING, Optional
 import requests
 
+# Pillow is only imported once an image actually needs to be hashed, since
+# most runs never get that far, and importing it is a big part of startup.
+if TYPE_CHECKING:
+    from PIL import Image
 
-def compute_image_hash(img_url: str) -> int:
+
+# The hash is a grid of HASH_SIZE x HASH_SIZE bits, so 64 bits by default.
+HASH_SIZE = 8
+HASH_MASK = (1 << (HASH_SIZE * HASH_SIZE)) - 1
+# The hash only needs a tiny thumbnail, so images are decoded
+# at (roughly) this resolution rather than at full size.
+THUMBNAIL_SIZE = 64
+# Don't download anything larger than this. Full size photos are
+# usually well under this, and previews are much smaller.
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+# modes that Image.reduce() supports. Anything else, like palette PNGs and
+# GIFs, is converted to grayscale first, which is all the hash uses anyway.
+REDUCE_MODES = {"L", "LA", "RGB", "RGBA", "CMYK"}
+CHUNK_SIZE = 64 * 1024
+
+
+def compute_image_hash(
+    img_url: str, session: Optional[requests.Session] = None, timeout: float = None
+) -> int:
     """
     Download an image file from the given url, open it, and
-    return the hash of the image. This uses a temporary file
-    to prevent cluttering disk space with image files.
+    return the perceptual hash of the image. The image is read into
+    memory, and only decoded at the resolution the hash needs.
+    @param img_url URL of the image
+    @param session reuse connections from this session, if given
+    @param timeout seconds to wait on the image host before giving up
     """
     print(f"Downloading image from {img_url}")
-    with TemporaryFile() as f:
-        bytes = requests.get(img_url).content
-        f.write(bytes)
-
-        # don't need to close the file after writing (hopefully),
-        # so just read from here, and then compute the hash.
-        with Image.open(f) as im:
-            print("Calculating image hash")
-            return hash(im.tobytes())
+    with METRICS.timer("image_download"):
+        buf = download_image(img_url, session=session, timeout=timeout)
+    with METRICS.timer("image_decode"):
+        im = open_thumbnail(buf)
+    with im:
+        print("Calculating image hash")
+        with METRICS.timer("image_hash"):
+            return dhash(im)
+
+
+def download_image(
+    img_url: str,
+    max_bytes: int = MAX_IMAGE_BYTES,
+    session: Optional[requests.Session] = None,
+    timeout: float = None,
+) -> BytesIO:
+    """
+    Stream an image into an in-memory buffer, without a temporary file.
+    @param img_url URL of the image
+    @param max_bytes give up on images larger than this
+    @param session reuse connections from this session, if given
+    @param timeout seconds to wait on the image host before giving up
+    @return a buffer holding the image, positioned at the start
+    """
+    client = session or requests
+    with client.get(img_url, stream=True, timeout=timeout) as res:
+        res.raise_for_status()
+        length = res.headers.get("Content-Length")
+        if length is not None and int(length) > max_bytes:
+            raise ValueError(f"Image at {img_url} is too large ({length} bytes)")
+        buf = BytesIO()
+        for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+            buf.write(chunk)
+            if buf.tell() > max_bytes:
+                raise ValueError(f"Image at {img_url} is larger than {max_bytes} bytes")
+    buf.seek(0)
+    return buf
+
+
+def open_thumbnail(buf: BytesIO, size: int = THUMBNAIL_SIZE) -> "Image.Image":
+    """
+    Open an image, decoding it at a reduced resolution. JPEGs can be
+    scaled down by the decoder itself with draft(), which is much cheaper
+    than decoding the full image. Other formats are shrunk by an integer
+    factor with reduce() right after decoding.
+    @param buf the encoded image
+    @param size the smallest width/height that the image needs to keep
+    @return the opened image, which should be closed by the caller
+    """
+    from PIL import Image
+
+    im = Image.open(buf)
+    im.draft("L", (size, size))
+    factor = min(im.size) // size
+    if factor > 1:
+        if im.mode not in REDUCE_MODES:
+            converted = im.convert("L")
+            im.close()
+            im = converted
+        reduced = im.reduce(factor)
+        im.close()
+        im = reduced
+    return im
+
+
+def dhash(im: "Image.Image", hash_size: int = HASH_SIZE) -> int:
+    """
+    Compute the difference hash of an image. The image is shrunk down to a
+    (hash_size + 1) x hash_size grayscale thumbnail, and each bit of the hash
+    records whether a pixel is brighter than its neighbor to the right.
+    Unlike hash(im.tobytes()), this is stable across processes, and visually
+    similar images (resized, recompressed) end up with similar hashes.
+    @param im the image to hash
+    @param hash_size the width and height of the grid of bits
+    @return the hash, as an unsigned integer of hash_size^2 bits
+    """
+    from PIL import Image
+
+    small = im.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = small.tobytes()  # one byte per pixel in grayscale
+    bits = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            left = pixels[offset + col]
+            right = pixels[offset + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """
+    Count the bits that differ between two image hashes.
+    """
+    return bin((a ^ b) & HASH_MASK).count("1")
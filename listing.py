@@ -0,0 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, zip_longest
+from praw import Reddit
+from typing import Callable, Iterable, Iterator, List, Optional
+import math
+
+
+MERGE_ROUND_ROBIN = "round_robin"
+MERGE_SCORE = "score"
+
+# Reddit allows 100 requests a minute per OAuth client, which the clients
+# built by reddit_clients.py stay within. One run only makes a handful of
+# requests, so this only needs to stop a long list of subreddits from
+# sending them all at once.
+FETCH_WORKERS = 4
+
+
+def fetch_multireddit(reddit_client: Reddit, subs: str, limit: int) -> Iterable:
+    """
+    Fetch the "hot" posts of all of the subreddits as a single listing.
+    This is one request per 100 posts, but the biggest subreddits tend to
+    take up most of the listing.
+    @param reddit_client PRAW Reddit client
+    @param subs subreddits separated by +
+    @param limit max number of posts to fetch
+    @return the submissions, in hot order. They are fetched lazily, so
+            pages that aren't reached are never requested
+    """
+    return reddit_client.subreddit(subs).hot(limit=limit)
+
+
+def fetch_parallel(
+    reddit_client: Reddit,
+    subs: str,
+    limit: int,
+    workers: int = FETCH_WORKERS,
+    policy: str = MERGE_ROUND_ROBIN,
+) -> List:
+    """
+    Fetch the "hot" posts of each subreddit on its own, at the same time,
+    and merge them into one ranked listing. A PRAW client can't be shared
+    between threads, so the client should be a ThreadLocalReddit, which
+    gives each worker a client of its own.
+    @param reddit_client PRAW Reddit client
+    @param subs subreddits separated by +
+    @param limit max number of posts in the merged listing
+    @param workers max number of subreddits to fetch at once
+    @param policy how to merge the listings, see merge
+    @return the merged submissions
+    """
+    names = [name for name in subs.split("+") if name]
+    if len(names) < 1:
+        return []
+    # every subreddit gets an equal share of the listing
+    per_sub = math.ceil(limit / len(names))
+
+    def fetch(name: str) -> List:
+        return list(reddit_client.subreddit(name).hot(limit=per_sub))
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(names)))) as pool:
+        listings = list(pool.map(fetch, names))
+    return merge(listings, policy)[:limit]
+
+
+def merge(listings: List[List], policy: str = MERGE_ROUND_ROBIN) -> List:
+    """
+    Merge the hot listings of several subreddits.
+    round_robin takes the best post of each subreddit, then the second best,
+    and so on, so every subreddit is represented equally.
+    score orders all of the posts by their score, which favors big subreddits.
+    Posts that show up in more than one listing are only kept once.
+    @param listings the submissions of each subreddit, in hot order
+    @param policy either "round_robin" or "score"
+    @return the merged submissions
+    """
+    if policy == MERGE_ROUND_ROBIN:
+        merged = [s for s in chain(*zip_longest(*listings)) if s is not None]
+    elif policy == MERGE_SCORE:
+        merged = sorted(chain(*listings), key=lambda s: s.score, reverse=True)
+    else:
+        raise ValueError(f"Unknown merge policy {policy}")
+
+    seen = set()
+    unique = []
+    for submission in merged:
+        if submission.id not in seen:
+            seen.add(submission.id)
+            unique.append(submission)
+    return unique
+
+
+def fetch_deeper(
+    reddit_client: Reddit, subs: str, limit: int, after: Optional[str] = None
+) -> Iterator[List]:
+    """
+    Lazily fetch more posts for when every post in the hot listing has
+    already been used: the next page of "hot", then "rising", then the
+    top posts of the day. Each page is one request, and is only fetched
+    when the previous one has been used up. Pages can overlap with each
+    other and with the hot listing.
+    @param reddit_client PRAW Reddit client
+    @param subs subreddits separated by +
+    @param limit max number of posts per page
+    @param after fullname of the last post in the hot listing, to continue
+                 paging from. If not given, the next hot page is skipped
+    @return the submissions of each page
+    """
+    subreddit = reddit_client.subreddit(subs)
+    if after is not None:
+        yield list(subreddit.hot(limit=limit, params={"after": after}))
+    yield list(subreddit.rising(limit=limit))
+    yield list(subreddit.top(time_filter="day", limit=limit))
+
+
+def listing_from_config(
+    mode: str, workers: int = FETCH_WORKERS, policy: str = MERGE_ROUND_ROBIN
+) -> Callable[[Reddit, str, int], Iterable]:
+    """
+    @param mode "multireddit" to fetch all subreddits in one listing, or
+                "parallel" to fetch each one on its own
+    @return the function that fetches the hot listing
+    """
+    if mode == "multireddit":
+        return fetch_multireddit
+    if mode == "parallel":
+        return lambda reddit_client, subs, limit: fetch_parallel(
+            reddit_client, subs, limit, workers, policy
+        )
+    raise ValueError(f"Unknown fetch mode {mode}")
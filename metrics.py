@@ -0,0 +1,143 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, Tuple
+import json
+import os
+import threading
+import time
+
+
+LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Metrics:
+    """
+    Minimal, thread safe registry of counters and timers for the hot path.
+    Counters only go up. Gauges hold the last value they were set to.
+    Timers keep the count, total and max duration of what they measure.
+    All of them can have labels, like Prometheus metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[LabelKey, float] = {}
+        self.gauges: Dict[LabelKey, float] = {}
+        self.timers: Dict[LabelKey, Dict[str, float]] = {}
+
+    def incr(self, name: str, amount: float = 1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def gauge(self, name: str, **labels) -> float:
+        with self.lock:
+            return self.gauges.get(_key(name, labels), 0)
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            t = self.timers.setdefault(key, {"count": 0, "sum": 0.0, "max": 0.0})
+            t["count"] += 1
+            t["sum"] += seconds
+            t["max"] = max(t["max"], seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[None]:
+        """
+        Time the body of a with statement, even if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name: str, **labels) -> float:
+        with self.lock:
+            return self.counters.get(_key(name, labels), 0)
+
+    def to_prometheus(self) -> str:
+        """
+        Render the metrics in the Prometheus text exposition format.
+        Timers are rendered as summaries without quantiles, plus a max gauge.
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}_total{_labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{name}{_labels(labels)} {value}")
+            for (name, labels), t in sorted(self.timers.items()):
+                lines.append(f"{name}_seconds_count{_labels(labels)} {t['count']}")
+                lines.append(f"{name}_seconds_sum{_labels(labels)} {t['sum']:.6f}")
+                lines.append(f"{name}_seconds_max{_labels(labels)} {t['max']:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> Dict:
+        with self.lock:
+            return {
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.gauges.items())
+                ],
+                "timers": [
+                    {"name": name, "labels": dict(labels), **t}
+                    for (name, labels), t in sorted(self.timers.items())
+                ],
+            }
+
+    def dump(self, path: str):
+        """
+        Write the metrics as JSON, replacing the file in one go.
+        """
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.to_json(), f)
+        # rename is atomic, so readers never see a partial file
+        os.replace(tmp, path)
+
+    def serve(self, port: int) -> ThreadingHTTPServer:
+        """
+        Serve the metrics for Prometheus to scrape, from a background thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # don't log every scrape
+
+        server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on port {server.server_port}")
+        return server
+
+
+def _key(name: str, labels: Dict[str, str]) -> LabelKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if len(labels) < 1:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+# shared by the whole process, like the Prometheus client's default registry
+METRICS = Metrics()
@@ -0,0 +1,12 @@
+from deduplicate_util import backfill_index
+from context import init_redis
+
+
+# One-off migration that builds the per-author index from the
+# "author/postId" keys written before the index existed.
+# Usage: python migrate.py
+if __name__ == "__main__":
+    r = init_redis()
+    print("Backfilling per-author index")
+    count = backfill_index(r)
+    print(f"Indexed {count} records")
@@ -0,0 +1,225 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from metrics import METRICS
+from redis import Redis
+from typing import Dict, List, Optional, Tuple
+from webhook import retry_after
+import hashlib
+import json
+import requests
+import time
+
+
+# deliveries taken from the outbox, and sent concurrently, at once
+BATCH_SIZE = 10
+# how long a worker has to deliver what it took before another can take it
+LEASE = timedelta(seconds=30)
+# a slow Discord gives up well within the lease, so the lease never expires
+# while a request is still in flight
+DELIVERY_TIMEOUT = 10.0
+# give up on a delivery after this many failed attempts
+MAX_ATTEMPTS = 6
+# first wait after a failed attempt, doubled for every attempt after that
+BASE_BACKOFF = 2.0
+MAX_BACKOFF = 600.0
+# remember what was delivered for as long as posts are remembered, so that
+# the same post is never sent to the same webhook twice
+SENT_TTL = timedelta(weeks=1)
+# deliveries that gave up, kept for troubleshooting
+MAX_DEAD_LETTERS = 100
+
+SENT = "sent"
+RETRY = "retry"
+FAILED = "failed"
+
+
+def delivery_key(post_id: str, url: str, run: Optional[str] = None) -> str:
+    """
+    Idempotency key for delivering a post to a webhook. The URL is hashed,
+    since it holds the webhook token.
+    @param run ID of the run, for a post that is deliberately sent again.
+               Its earlier delivery would otherwise block it
+    """
+    key = f"{post_id}@{hashlib.sha256(url.encode()).hexdigest()[:16]}"
+    return key if run is None else f"{key}@{run}"
+
+
+def backoff(attempts: int) -> float:
+    return min(BASE_BACKOFF * 2 ** (attempts - 1), MAX_BACKOFF)
+
+
+class Outbox:
+    """
+    Deliveries that were selected but not sent yet, kept in Redis so that a
+    Discord outage doesn't lose posts that were already recorded as used.
+    Runs enqueue their payloads, and a delivery worker drains the outbox,
+    retrying on 429 and 5xx responses with backoff.
+    Pending deliveries are a sorted set of idempotency keys, scored by when
+    they are due, and their payloads are kept in a hash. A worker takes a
+    delivery by leasing its key with SET NX, like posts are claimed, and
+    delivered keys are remembered so they are never enqueued again.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        prefix: str = "outbox",
+        batch_size: int = BATCH_SIZE,
+        lease: timedelta = LEASE,
+        max_attempts: int = MAX_ATTEMPTS,
+    ):
+        self.redis = redis
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def enqueue(self, url: str, data: Dict, key: str) -> bool:
+        """
+        Queue a payload for delivery.
+        @param url the webhook URL
+        @param data the JSON payload
+        @param key idempotency key, see delivery_key
+        @return False if the key was already queued or delivered
+        """
+        if self.redis.exists(self._sent(key)) > 0:
+            METRICS.incr("outbox_enqueued", result="duplicate")
+            return False
+        message = json.dumps({"url": url, "data": data, "attempts": 0})
+        pipe = self.redis.pipeline()
+        pipe.hsetnx(self._messages(), key, message)
+        pipe.zadd(self._pending(), {key: time.time()}, nx=True)
+        added = pipe.execute()[0] == 1
+        METRICS.incr("outbox_enqueued", result="new" if added else "duplicate")
+        return added
+
+    def take(self) -> List[Tuple[str, Dict]]:
+        """
+        Lease a batch of the deliveries that are due. Deliveries that
+        another worker holds the lease for are skipped.
+        @return (key, message) for each delivery taken
+        """
+        due = [
+            _str(key)
+            for key in self.redis.zrangebyscore(
+                self._pending(), "-inf", time.time(), start=0, num=self.batch_size
+            )
+        ]
+        if len(due) < 1:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for key in due:
+            pipe.set(self._lease(key), "1", nx=True, px=self.lease)
+            pipe.hget(self._messages(), key)
+        results = pipe.execute()
+
+        taken = []
+        for i, key in enumerate(due):
+            leased, message = results[2 * i], results[2 * i + 1]
+            if leased and message is not None:
+                taken.append((key, json.loads(message)))
+            elif leased:
+                # delivered by another worker since it was listed
+                self.redis.delete(self._lease(key))
+        return taken
+
+    def deliver(self, session: requests.Session, workers: int = 4) -> int:
+        """
+        Deliver one batch of the deliveries that are due.
+        @param session the session to send the requests with
+        @param workers max number of deliveries in flight at once
+        @return how many deliveries were taken from the outbox
+        """
+        taken = self.take()
+        if len(taken) < 1:
+            return 0
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(taken)))) as pool:
+            outcomes = list(pool.map(lambda t: _send(session, t[1]), taken))
+
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for (key, message), (outcome, wait, reason) in zip(taken, outcomes):
+            attempts = message["attempts"] + 1
+            if outcome == RETRY and attempts >= self.max_attempts:
+                outcome = FAILED
+            if outcome == SENT:
+                pipe.set(self._sent(key), "1", ex=SENT_TTL)
+            if outcome == RETRY:
+                print(f"Failed to deliver {key}: {reason}, retrying in {wait}s")
+                message["attempts"] = attempts
+                pipe.hset(self._messages(), key, json.dumps(message))
+                pipe.zadd(self._pending(), {key: now + wait})
+            else:
+                pipe.zrem(self._pending(), key)
+                pipe.hdel(self._messages(), key)
+            if outcome == FAILED:
+                print(f"Gave up delivering {key} after {attempts} attempts: {reason}")
+                dead = {"key": key, "data": message["data"], "reason": reason}
+                pipe.lpush(self._dead(), json.dumps(dead))
+                pipe.ltrim(self._dead(), 0, MAX_DEAD_LETTERS - 1)
+            pipe.delete(self._lease(key))
+            METRICS.incr("outbox_deliveries", result=outcome)
+        pipe.execute()
+        return len(taken)
+
+    def drain(self, session: requests.Session, workers: int = 4) -> int:
+        """
+        Deliver batches until nothing is due, taking at most as many
+        deliveries as were pending to begin with. Deliveries that are
+        waiting to be retried are left for later.
+        @return how many deliveries were taken from the outbox
+        """
+        total, pending = 0, len(self)
+        while total < pending:
+            taken = self.deliver(session, workers)
+            if taken < 1:
+                break
+            total += taken
+        return total
+
+    def __len__(self):
+        return self.redis.zcard(self._pending())
+
+    def _pending(self) -> str:
+        return f"{self.prefix}:pending"
+
+    def _messages(self) -> str:
+        return f"{self.prefix}:messages"
+
+    def _dead(self) -> str:
+        return f"{self.prefix}:dead"
+
+    def _lease(self, key: str) -> str:
+        return f"{self.prefix}:lease:{key}"
+
+    def _sent(self, key: str) -> str:
+        return f"{self.prefix}:sent:{key}"
+
+
+def _send(
+    session: requests.Session, message: Dict
+) -> Tuple[str, Optional[float], Optional[str]]:
+    # one attempt only. waiting for a rate limit to reset would hold up
+    # the rest of the batch, so the wait is scheduled in the outbox instead.
+    attempts = message["attempts"] + 1
+    try:
+        with METRICS.timer("webhook_delivery"):
+            result = session.post(
+                url=message["url"], json=message["data"], timeout=DELIVERY_TIMEOUT
+            )
+    except requests.RequestException as e:
+        return RETRY, backoff(attempts), repr(e)
+    METRICS.incr("webhook_responses", code=result.status_code)
+    if result.status_code < 300:
+        return SENT, None, None
+    reason = f"status {result.status_code}"
+    if result.status_code == 429:
+        return RETRY, min(retry_after(result), MAX_BACKOFF), reason
+    if result.status_code >= 500:
+        return RETRY, backoff(attempts), reason
+    # the webhook was deleted, or the payload is invalid. retrying won't help
+    return FAILED, None, reason
+
+
+def _str(val) -> str:
+    return val.decode() if isinstance(val, bytes) else val
@@ -0,0 +1,123 @@
+from datetime import timedelta
+from food_post import FoodPost
+from redis import Redis
+from typing import Dict, Iterable, List, Optional, Tuple
+import json
+import threading
+import time
+
+
+# how many new posts to keep ready for each set of subreddits
+POOL_SIZE = 3
+# posts that were found longer ago than this might not be hot anymore
+MAX_AGE = timedelta(minutes=30)
+
+
+class CandidatePool:
+    """
+    A small, ranked queue of posts that are ready to be posted, which is
+    filled in the background between scheduled runs. That way a run only
+    has to pop a post and deliver it, instead of scraping Reddit and
+    downloading images while the post is due.
+    The queue is mirrored to Redis so that it survives restarts.
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        subs: str,
+        size: int = POOL_SIZE,
+        max_age: timedelta = MAX_AGE,
+        image_timeout: Optional[float] = None,
+    ):
+        self.redis = redis
+        self.subs = subs
+        self.size = size
+        self.max_age = max_age
+        # seconds to wait on an image host, for popped posts whose image
+        # still has to be hashed
+        self.image_timeout = image_timeout
+        self.lock = threading.Lock()
+        # ranked entries, best first. each entry is a JSON-able dict
+        self.entries: Optional[List[Dict]] = None
+
+    def refresh(self, candidates: Iterable[Tuple[str, FoodPost]]):
+        """
+        Replace the queue with the first new posts from the candidates.
+        Replacing the whole queue evicts posts that dropped out of "hot".
+        Only one post per author is kept, since posts by the same author
+        are likely to be duplicates of each other.
+        @param candidates (author, post) pairs that are not duplicates,
+                          in ranked order. Consumed lazily.
+        """
+        entries = []
+        authors = set()
+        now = time.time()
+        for author, fp in candidates:
+            if author in authors:
+                continue
+            authors.add(author)
+            # the hash gets stored when the post is used, so compute it
+            # now rather than while the post is due.
+            fp.image_hash()
+            entries.append(_to_entry(author, fp, now))
+            if len(entries) >= self.size:
+                break
+        with self.lock:
+            self.entries = entries
+            self._mirror()
+        print(f"Prefetched {len(entries)} posts from {self.subs}")
+
+    def pop(self) -> Optional[Tuple[str, FoodPost]]:
+        """
+        Take the best post out of the queue. Stale posts are dropped, and
+        each post gets a final check against the "author/postId" key in case
+        it was used since it was queued.
+        @return (author, post), or None if there's nothing ready
+        """
+        with self.lock:
+            if self.entries is None:
+                self.entries = self._load()
+            cutoff = time.time() - self.max_age.total_seconds()
+            popped = None
+            while len(self.entries) > 0 and popped is None:
+                entry = self.entries.pop(0)
+                if entry["fetched_at"] < cutoff:
+                    continue
+                if self.redis.exists(f"{entry['author']}/{entry['id']}") > 0:
+                    continue
+                popped = _from_entry(entry, self.image_timeout)
+            self._mirror()
+            return popped
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries or [])
+
+    def _key(self) -> str:
+        return f"pool:{self.subs}"
+
+    def _mirror(self):
+        self.redis.set(self._key(), json.dumps(self.entries), ex=self.max_age)
+
+    def _load(self) -> List[Dict]:
+        val = self.redis.get(self._key())
+        return json.loads(val) if val is not None else []
+
+
+def _to_entry(author: str, fp: FoodPost, fetched_at: float) -> Dict:
+    return {
+        "author": author,
+        "id": fp.id,
+        "title": fp.title,
+        "permalink": fp.post_url,
+        "image_url": fp.image_url,
+        "preview_url": fp.preview_url,
+        "created_utc": fp.date_posted.timestamp() if fp.date_posted else None,
+        "img_hash": fp.img_hash,
+        "fetched_at": fetched_at,
+    }
+
+
+def _from_entry(entry: Dict, timeout: Optional[float]) -> Tuple[str, FoodPost]:
+    return entry["author"], FoodPost(**entry, timeout=timeout)
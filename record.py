@@ -0,0 +1,83 @@
+from typing import Dict, List, Optional
+import json
+
+
+# Records used to be stored as the JSON of FoodPost.to_json, e.g.
+#   {"id": "abc123", "title": "...", "date": "21/08/22 01:00", "hash": "1234"}
+# They are now stored in a compact, versioned encoding:
+#   2|abc123|<hash in base 36>|<created time in base 36>|token token ...
+# The Redis client decodes replies to strings, so the encoding is plain
+# text rather than raw bytes. Post IDs never contain the separator, and
+# neither do the tokens, since tokenize strips everything that isn't a
+# letter or a digit. Empty fields mean the value is unknown.
+VERSION = "2"
+SEPARATOR = "|"
+FIELDS = 5
+
+
+def encode_record(post: Dict) -> str:
+    """
+    Encode the fields of a post that are needed for deduplication. The
+    title is only kept as its normalized tokens, see match_fields.
+    @param post the JSON record of a post, with match fields already set
+    @return the compact encoding of the record
+    """
+    tokens = post.get("tokens")
+    return SEPARATOR.join(
+        [
+            VERSION,
+            str(post["id"]),
+            _pack_int(_parse_int(post.get("hash"))),
+            _pack_int(_parse_int(post.get("ts"))),
+            " ".join(tokens) if tokens is not None else "",
+        ]
+    )
+
+
+def decode_record(val) -> Dict:
+    """
+    Decode a stored record, in either the compact encoding or the legacy
+    JSON. Legacy records are returned as they were stored, and still need
+    match_fields to be applied to them.
+    @param val the stored value, as a string or bytes
+    @return the record, with "id", and "hash", "ts" and "tokens" if known
+    """
+    if isinstance(val, bytes):
+        val = val.decode()
+    if not val.startswith(VERSION + SEPARATOR):
+        return json.loads(val)
+    parts = val.split(SEPARATOR, FIELDS - 1)
+    if len(parts) != FIELDS:
+        raise ValueError(f"Malformed record: {val}")
+    _, post_id, img_hash, ts, tokens = parts
+    post = {"id": post_id}
+    if img_hash != "":
+        post["hash"] = int(img_hash, 36)
+    if ts != "":
+        post["ts"] = int(ts, 36)
+    if tokens != "":
+        post["tokens"] = tokens.split(" ")
+    return post
+
+
+def _parse_int(val) -> Optional[int]:
+    # image hashes are decimal strings in the legacy records, or "None"
+    # if the image could not be hashed.
+    if val is None:
+        return None
+    try:
+        n = int(val)
+    except ValueError:
+        return None
+    return n if n >= 0 else None
+
+
+def _pack_int(n: Optional[int]) -> str:
+    if n is None:
+        return ""
+    digits: List[str] = []
+    while True:
+        n, d = divmod(n, 36)
+        digits.append("0123456789abcdefghijklmnopqrstuvwxyz"[d])
+        if n == 0:
+            return "".join(reversed(digits))
@@ -0,0 +1,113 @@
+from collections import deque
+from praw import Reddit
+from prawcore import Requestor
+from typing import Callable, Deque, Dict, List
+import threading
+import time
+
+
+# Reddit allows 100 requests a minute per OAuth client, and every client
+# built here uses the same credentials, so they share the budget
+REQUESTS_PER_MINUTE = 100
+
+
+class RequestBudget:
+    """
+    Limits how many requests are made in any minute, across every thread.
+    Each PRAW client only paces its own requests, so clients that share
+    credentials could go over the limit together without this.
+    """
+
+    def __init__(self, per_minute: int = REQUESTS_PER_MINUTE):
+        self.per_minute = per_minute
+        self.lock = threading.Lock()
+        # when each of the requests in the last minute was made
+        self.sent: Deque[float] = deque()
+
+    def acquire(self):
+        """
+        Wait until a request can be made within the budget, and count it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while len(self.sent) > 0 and self.sent[0] <= now - 60:
+                    self.sent.popleft()
+                if len(self.sent) < self.per_minute:
+                    self.sent.append(now)
+                    return
+                wait = self.sent[0] + 60 - now
+            time.sleep(wait)
+
+
+class BudgetedRequestor(Requestor):
+    """
+    Requestor that counts every request a PRAW client makes against a
+    shared RequestBudget.
+    """
+
+    def __init__(self, *args, budget: RequestBudget, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+
+    def request(self, *args, **kwargs):
+        self.budget.acquire()
+        return super().request(*args, **kwargs)
+
+
+class ThreadLocalReddit:
+    """
+    Stands in for a PRAW Reddit client, but hands every thread a client of
+    its own. PRAW isn't thread safe, since a client's session and rate
+    limiter are shared by every request made with it, and a single client
+    is used by the parallel fetch, the prefetch thread and concurrent jobs
+    at once. A client is built the first time a thread uses one, and the
+    clients of threads that exited are handed to new threads, so they keep
+    their OAuth tokens between runs.
+    """
+
+    def __init__(self, factory: Callable[[], Reddit]):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.owners: Dict[threading.Thread, Reddit] = {}
+        self.free: List[Reddit] = []
+
+    def client(self) -> Reddit:
+        """
+        @return the client of the current thread
+        """
+        thread = threading.current_thread()
+        with self.lock:
+            if thread not in self.owners:
+                for owner in [t for t in self.owners if not t.is_alive()]:
+                    self.free.append(self.owners.pop(owner))
+                if len(self.free) > 0:
+                    self.owners[thread] = self.free.pop()
+                else:
+                    self.owners[thread] = self.factory()
+            return self.owners[thread]
+
+    def __getattr__(self, name: str):
+        return getattr(self.client(), name)
+
+
+def init_reddit(
+    client_id: str,
+    client_secret: str,
+    user_agent: str,
+    requests_per_minute: int = REQUESTS_PER_MINUTE,
+) -> ThreadLocalReddit:
+    """
+    Build a Reddit client that is safe to share between threads, and stays
+    within the request budget of the credentials.
+    """
+    budget = RequestBudget(requests_per_minute)
+    return ThreadLocalReddit(
+        lambda: Reddit(
+            client_id=client_id,
+            client_secret=client_secret,
+            user_agent=user_agent,
+            requestor_class=BudgetedRequestor,
+            requestor_kwargs={"budget": budget},
+        )
+    )
@@ -0,0 +1,165 @@
+"""
+Replay recorded runs through the scrape -> dedup -> deliver pipeline, against
+fakeredis and a stubbed webhook instead of Reddit, Redis and Discord. Runs are
+recorded by setting RECORD_ARCHIVE, see the README.
+
+Every combination of the given settings replays the whole archive from an
+empty Redis, and reports how many posts went out per second, and how many of
+them repeated an earlier post (the same submission, or the same image bytes)
+from within TIME_TO_LIVE.
+
+Usage:
+    python replay.py archive/ --fuzz-threshold 55 65 75 --limit 12 24
+"""
+from archive import Archive, ReplayAdapter, ReplayReddit
+from context import SEARCH_REQUESTS, AppContext
+from contextlib import redirect_stdout
+from deduplicate_util import FUZZ_THRESHOLD, TIME_TO_LIVE
+from fakeredis import FakeStrictRedis
+from food import post
+from io import StringIO
+from itertools import product
+from metrics import METRICS
+from typing import Dict, List, Optional
+from unittest import mock
+from webhook import Webhook
+import argparse
+import deduplicate_util
+import hashlib
+import requests
+import time
+
+# deliveries go to the stubbed session, so this is never contacted
+SINK_URL = "https://discord.com/api/webhooks/replay"
+
+
+def replay(
+    archive: Archive,
+    fuzz_threshold: int = FUZZ_THRESHOLD,
+    limit: Optional[int] = None,
+    hash_workers: int = 4,
+    global_images: bool = True,
+    search_requests: int = SEARCH_REQUESTS,
+) -> Dict:
+    """
+    Replay every recorded run in the archive, in order, from an empty Redis.
+    The clock is set to when each run was recorded, so that records expire
+    like they would have.
+    @param archive the recorded runs
+    @param fuzz_threshold the FUZZ_THRESHOLD to deduplicate titles with
+    @param limit the LIMIT to fetch listings with. Can't be more than what was
+                 recorded. Defaults to the recorded limit
+    @param hash_workers number of images to hash at once
+    @param global_images compare images against every author's posts
+    @param search_requests extra pages to check when every hot post was used
+    @return the report for the replay
+    """
+    reddit = ReplayReddit()
+    sink = ReplayAdapter(archive)
+    session = requests.Session()
+    session.mount("http://", sink)
+    session.mount("https://", sink)
+    ctx = AppContext(
+        redis=FakeStrictRedis(version=6),
+        reddit=reddit,
+        session=session,
+        global_images=global_images,
+        hash_workers=hash_workers,
+        search_requests=search_requests,
+    )
+
+    runs = 0
+    sent: List[Dict] = []
+    fallbacks = METRICS.counter("selection_fallbacks")
+    started = time.perf_counter()
+    with mock.patch.object(deduplicate_util, "FUZZ_THRESHOLD", fuzz_threshold):
+        for run in archive.runs():
+            hot = [entry for entry in run if entry["kind"] == "hot"]
+            if len(hot) < 1:
+                continue
+            runs += 1
+            reddit.load(run)
+            ctx.request_limit = limit or hot[0]["limit"]
+            ctx.webhooks = [Webhook(SINK_URL, "+".join(e["subs"] for e in hot))]
+            clock = hot[0]["ts"]
+            with mock.patch("time.time", return_value=clock):
+                try:
+                    post(ctx)
+                except Exception as e:
+                    print(f"Run at {clock} did not post: {repr(e)}")
+            for data in sink.delivered:
+                for embed in data["embeds"]:
+                    sent.append(_delivery(archive, embed, clock))
+            sink.delivered.clear()
+    elapsed = time.perf_counter() - started
+
+    return {
+        "runs": runs,
+        "delivered": len(sent),
+        "fallbacks": int(METRICS.counter("selection_fallbacks") - fallbacks),
+        "repeats": _repeats(sent),
+        "seconds": elapsed,
+    }
+
+
+def _delivery(archive: Archive, embed: Dict, clock: float) -> Dict:
+    url = embed.get("image", {}).get("url")
+    data = archive.load_image(url) if url is not None else None
+    return {
+        "post": embed.get("description"),
+        # identical bytes are the same image, even under another URL
+        "image": hashlib.sha256(data).hexdigest() if data is not None else url,
+        "ts": clock,
+    }
+
+
+def _repeats(sent: List[Dict]) -> int:
+    # the ground truth for dedup accuracy: posts that repeat an earlier
+    # post, or its exact image, from within the time to live.
+    count = 0
+    for i, d in enumerate(sent):
+        window = d["ts"] - TIME_TO_LIVE.total_seconds()
+        if any(
+            p["ts"] > window
+            and (p["post"] == d["post"] or (d["image"] and p["image"] == d["image"]))
+            for p in sent[:i]
+        ):
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("archive")
+    parser.add_argument("--fuzz-threshold", type=int, nargs="+", default=[65])
+    parser.add_argument("--limit", type=int, nargs="+", default=[None])
+    parser.add_argument("--hash-workers", type=int, default=4)
+    parser.add_argument("--search-requests", type=int, default=SEARCH_REQUESTS)
+    parser.add_argument("--no-global-images", action="store_true")
+    args = parser.parse_args()
+    archive = Archive(args.archive)
+
+    for threshold, limit in product(args.fuzz_threshold, args.limit):
+        # the pipeline logs every decision, which would drown out the report
+        with redirect_stdout(StringIO()):
+            report = replay(
+                archive,
+                threshold,
+                limit,
+                args.hash_workers,
+                not args.no_global_images,
+                args.search_requests,
+            )
+        delivered = report["delivered"]
+        accuracy = 1 - report["repeats"] / delivered if delivered > 0 else 1
+        print(
+            f"fuzz_threshold={threshold:<3} limit={limit or 'recorded':<8} "
+            f"runs {report['runs']:5d}  delivered {delivered:5d}  "
+            f"fallbacks {report['fallbacks']:4d}  repeats {report['repeats']:4d}  "
+            f"accuracy {accuracy:6.1%}  "
+            f"posts/s {delivered / max(report['seconds'], 1e-9):8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
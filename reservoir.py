@@ -0,0 +1,35 @@
+from typing import Generic, Iterator, List, Optional, TypeVar
+import random
+
+T = TypeVar("T")
+
+
+class Reservoir(Generic[T]):
+    """
+    Uniform random sample of at most `size` items from a stream of unknown
+    length, so that memory stays the same no matter how long the stream is.
+    https://en.wikipedia.org/wiki/Reservoir_sampling#Simple:_Algorithm_R
+    """
+
+    def __init__(self, size: int, rng: Optional[random.Random] = None):
+        self.size = size
+        self.rng = rng or random.Random()
+        self.items: List[T] = []
+        # number of items offered so far
+        self.count = 0
+
+    def add(self, item: T):
+        self.count += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+        # keep the new item with probability size/count
+        i = self.rng.randrange(self.count)
+        if i < self.size:
+            self.items[i] = item
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self.items)
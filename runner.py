@@ -0,0 +1,177 @@
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Set
+import asyncio
+import signal
+import threading
+
+
+# how long a single run can take before it's abandoned
+JOB_TIMEOUT = 15 * 60.0
+# how long to wait for runs in progress when shutting down
+DRAIN_TIMEOUT = 60.0
+
+
+class Job:
+    # Attributes
+    # name - used for logging
+    # func - the blocking function to run
+    # interval - how often to run, aligned to midnight, so an hourly job
+    #            runs at :00 like the schedule library did
+    # timeout - seconds a run can take before it's abandoned
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], None],
+        interval: timedelta = timedelta(hours=1),
+        timeout: float = JOB_TIMEOUT,
+    ):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.timeout = timeout
+
+    def next_run(self, now: datetime) -> datetime:
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        periods = (now - midnight) // self.interval + 1
+        return midnight + periods * self.interval
+
+    def __repr__(self):
+        return f"Job({self.name}, every {self.interval})"
+
+
+class AsyncRunner:
+    """
+    Runs several independent jobs on their own schedules in one process.
+    The jobs themselves are blocking (PRAW, redis-py and requests), so each
+    run gets a thread of its own, while the scheduling, timeouts and shutdown
+    are handled by asyncio. At most max_concurrency jobs run at once, and a job
+    that is still running when it is due again skips that run.
+    """
+
+    def __init__(
+        self,
+        jobs: List[Job],
+        max_concurrency: int = 2,
+        on_stop: Optional[Callable[[], None]] = None,
+    ):
+        self.jobs = jobs
+        # called once the runs in progress are drained, to stop the
+        # background threads that the runs hand work off to
+        self.on_stop = on_stop
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.max_concurrency = max_concurrency
+        # threads of runs that timed out, which can't be stopped
+        self.abandoned: Set[threading.Thread] = set()
+        self.stopping: Optional[asyncio.Event] = None
+        self.in_flight: Set[asyncio.Task] = set()
+        self.running: Set[str] = set()
+
+    async def run(self, drain_timeout: float = DRAIN_TIMEOUT):
+        """
+        Run the jobs until shutdown is called, or the process gets SIGINT
+        or SIGTERM. Runs that are in progress get drain_timeout seconds to
+        finish, so that deliveries aren't cut off halfway.
+        """
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.shutdown)
+            except (NotImplementedError, RuntimeError):
+                pass  # not supported on this platform, or not the main thread
+
+        schedulers = [asyncio.ensure_future(self._schedule(job)) for job in self.jobs]
+        await self.stopping.wait()
+        for s in schedulers:
+            s.cancel()
+        await asyncio.gather(*schedulers, return_exceptions=True)
+
+        if len(self.in_flight) > 0:
+            print(f"Waiting for {len(self.in_flight)} run(s) to finish")
+            _, pending = await asyncio.wait(self.in_flight, timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+        if self.on_stop is not None:
+            await loop.run_in_executor(None, self.on_stop)
+        print("Runner stopped")
+
+    def shutdown(self):
+        print("Shutting down runner")
+        if self.stopping is not None:
+            self.stopping.set()
+
+    async def run_job(self, job: Job):
+        """
+        Run a job once, in a new thread. If it takes longer than its timeout,
+        stop waiting for it so that it doesn't hold up the rest. The thread
+        itself can't be interrupted, so it finishes in the background. It
+        isn't taken from a pool, so a run that hangs never holds up the runs
+        after it, but the job counts as running until its thread exits, so
+        that a run that hangs is never joined by a second run of the job.
+        """
+        if job.name in self.running:
+            print(f"{job} is still running, skipping this run")
+            return
+        self.running.add(job.name)
+        thread: Optional[threading.Thread] = None
+        try:
+            async with self.semaphore:
+                future, thread = _start_thread(
+                    job, lambda: self.running.discard(job.name)
+                )
+                await asyncio.wait_for(future, timeout=job.timeout)
+        except asyncio.TimeoutError:
+            self.abandoned = {t for t in self.abandoned if t.is_alive()}
+            if thread is not None:
+                self.abandoned.add(thread)
+            print(
+                f"{job} timed out after {job.timeout} seconds, abandoning its "
+                f"thread ({len(self.abandoned)} abandoned thread(s) still running)"
+            )
+        except Exception as e:
+            # swallow the exception so it moves on gracefully
+            print(f"{job} failed: {repr(e)}")
+        finally:
+            if thread is None:
+                self.running.discard(job.name)  # it never started
+
+    async def _schedule(self, job: Job):
+        print(f"Scheduling {job}")
+        while True:
+            now = datetime.now()
+            await asyncio.sleep((job.next_run(now) - now).total_seconds())
+            task = asyncio.ensure_future(self.run_job(job))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+
+def _start_thread(job: Job, on_exit: Callable[[], None]):
+    # the thread reports back to the event loop, like run_in_executor does.
+    # on_exit is called on the event loop once the thread is done, even if
+    # the run timed out by then
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, error: Optional[BaseException]):
+        on_exit()
+        if future.done():
+            return  # cancelled after the job timed out
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        try:
+            outcome = (job.func(), None)
+        except Exception as e:
+            outcome = (None, e)
+        try:
+            loop.call_soon_threadsafe(settle, *outcome)
+        except RuntimeError:
+            pass  # the event loop already stopped
+
+    thread = threading.Thread(target=target, name=job.name, daemon=True)
+    thread.start()
+    return future, thread
@@ -0,0 +1,163 @@
+from archive import (
+    Archive,
+    RecordingReddit,
+    ReplayAdapter,
+    ReplayReddit,
+    record_session,
+)
+from contextlib import redirect_stdout
+from food_post import FoodPost
+from image_util import compute_image_hash
+from io import BytesIO, StringIO
+from PIL import Image
+from replay import replay
+from requests.adapters import BaseAdapter
+from requests.models import Response
+import random
+import requests
+import tempfile
+import time
+import unittest
+
+
+def make_image(seed: int) -> bytes:
+    # random noise, so that different seeds have very different hashes
+    rng = random.Random(seed)
+    im = Image.new("L", (32, 32))
+    im.putdata([rng.randrange(256) for _ in range(32 * 32)])
+    buf = BytesIO()
+    im.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class Author:
+    def __init__(self, name):
+        self.name = name
+
+
+class DummySubmission:
+    def __init__(self, post_id, author, title, created_utc=None):
+        self.id = post_id
+        self.author = Author(author)
+        self.url = f"https://i.redd.it/{post_id}.png"
+        self.permalink = f"/r/food/comments/{post_id}"
+        self.title = title
+        self.created_utc = created_utc or time.time()
+        self.media_metadata = None
+        self.score = 1
+
+
+class DummySubreddit:
+    def __init__(self, listing):
+        self.listing = listing
+
+    def hot(self, limit, params=None):
+        return iter(self.listing[:limit])
+
+
+class DummyReddit:
+    def __init__(self, listing):
+        self.listing = listing
+
+    def subreddit(self, subs):
+        return DummySubreddit(self.listing)
+
+
+class ImageHostAdapter(BaseAdapter):
+    def __init__(self, images):
+        super().__init__()
+        self.images = images
+
+    def send(self, request, **kwargs):
+        res = Response()
+        res.status_code = 200
+        res.raw = BytesIO(self.images[request.url])
+        res.request = request
+        return res
+
+    def close(self):
+        pass
+
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.archive = Archive(self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def record(self, listing, images):
+        reddit = RecordingReddit(DummyReddit(listing), self.archive)
+        session = requests.Session()
+        session.mount("https://", ImageHostAdapter(images))
+        record_session(session, self.archive)
+        return [
+            compute_image_hash(FoodPost.derive_image_url(submission), session)
+            for submission in reddit.subreddit("food").hot(limit=len(listing))
+        ]
+
+    def test_record_and_replay_listing(self):
+        listing = [DummySubmission("a", "foo", "tacos")]
+        self.record(listing, {"https://i.redd.it/a.png": make_image(1)})
+        listing = [DummySubmission("b", "bar", "ramen")]
+        hashes = self.record(listing, {"https://i.redd.it/b.png": make_image(2)})
+
+        runs = list(self.archive.runs())
+        self.assertEqual(len(runs), 2)
+        reddit = ReplayReddit()
+        reddit.load(runs[1])
+        replayed = list(reddit.subreddit("food").hot(limit=5))
+        self.assertEqual([s.id for s in replayed], ["b"])
+        self.assertEqual(replayed[0].author.name, "bar")
+        self.assertEqual(list(reddit.subreddit("food").rising(limit=5)), [])
+
+        sink = ReplayAdapter(self.archive)
+        session = requests.Session()
+        session.mount("https://", sink)
+        url = FoodPost.derive_image_url(replayed[0])
+        self.assertEqual(compute_image_hash(url, session), hashes[0])
+        self.assertEqual(session.get("https://i.redd.it/c.png").status_code, 404)
+        session.post("https://discord.com/api/webhooks/1", json={"content": "hi"})
+        self.assertEqual(sink.delivered, [{"content": "hi"}])
+
+    def test_replay_hot_with_smaller_limit(self):
+        listing = [DummySubmission(i, "foo", "tacos") for i in "abc"]
+        images = {f"https://i.redd.it/{i}.png": make_image(0) for i in "abc"}
+        self.record(listing, images)
+        reddit = ReplayReddit()
+        reddit.load(next(self.archive.runs()))
+        sub = reddit.subreddit("food")
+        self.assertEqual([s.id for s in sub.hot(limit=2)], ["a", "b"])
+        next_page = sub.hot(limit=2, params={"after": "t3_b"})
+        self.assertEqual([s.id for s in next_page], ["c"])
+
+    def test_replay_reports_repeats(self):
+        red, blue = make_image(1), make_image(2)
+        now = time.time()
+        # the same photo, reposted by another account an hour later
+        self.record(
+            [DummySubmission("a", "foo", "tacos", now)],
+            {"https://i.redd.it/a.png": red},
+        )
+        self.record(
+            [
+                DummySubmission("b", "bar", "tacos", now + 3600),
+                DummySubmission("c", "baz", "ramen", now + 3600),
+            ],
+            {"https://i.redd.it/b.png": red, "https://i.redd.it/c.png": blue},
+        )
+
+        with redirect_stdout(StringIO()):
+            caught = replay(self.archive)
+            missed = replay(self.archive, global_images=False)
+        self.assertEqual(caught["runs"], 2)
+        self.assertEqual(caught["delivered"], 2)
+        self.assertEqual(caught["repeats"], 0)
+        self.assertEqual(caught["fallbacks"], 0)
+        self.assertEqual(missed["delivered"], 2)
+        self.assertEqual(missed["repeats"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+from bloom import BloomFilter, RotatingBloomFilter
+from datetime import timedelta
+from deduplicate_util import prefetch_candidates, record_post
+from fakeredis import FakeStrictRedis
+from food_post import FoodPost
+import time
+import unittest
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        f = BloomFilter(capacity=1000)
+        keys = [f"author{i}/post{i}" for i in range(1000)]
+        for key in keys:
+            f.add(key)
+        self.assertTrue(all(f.contains(key) for key in keys))
+
+    def test_false_positive_rate(self):
+        f = BloomFilter(capacity=1000, error_rate=0.01)
+        for i in range(1000):
+            f.add(f"author{i}/post{i}")
+        false_positives = sum(f.contains(f"other{i}/post{i}") for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class RotatingBloomFilterTest(unittest.TestCase):
+    def test_old_slices_are_dropped(self):
+        f = RotatingBloomFilter(timedelta(weeks=1))
+        f.add("foo/old", time.time() - timedelta(days=8).total_seconds())
+        f.add("foo/new")
+        self.assertFalse(f.might_contain("foo/old"))
+        self.assertTrue(f.might_contain("foo/new"))
+
+    def test_rebuild_from_redis(self):
+        r = FakeStrictRedis(version=6)
+        record_post(r, "foo", {"id": "bar"})
+        r.set("imghash:https://i.redd.it/foo.jpg", "1")
+
+        f = RotatingBloomFilter(timedelta(weeks=1))
+        self.assertEqual(f.rebuild(r), 1)
+        self.assertTrue(f.might_contain("foo/bar"))
+        self.assertFalse(f.might_contain("foo/baz"))
+
+    def test_prefetch_skips_exists_for_new_posts(self):
+        r = FakeStrictRedis(version=6)
+        f = RotatingBloomFilter(timedelta(weeks=1))
+        record_post(r, "foo", {"id": "bar"}, id_filter=f)
+        # bypass the filter, to show that the EXISTS call was skipped
+        r.set("foo/sneaky", "{}")
+
+        seen = FoodPost(id="bar")
+        sneaky = FoodPost(id="sneaky")
+        prefetch_candidates(r, [("foo", seen), ("foo", sneaky)], f)
+        self.assertTrue(seen.checks["id"])
+        self.assertFalse(sneaky.checks["id"])
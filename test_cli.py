@@ -0,0 +1,61 @@
+from cli import main, report
+from io import StringIO
+from unittest import mock
+import subprocess
+import sys
+import unittest
+
+
+class CliTest(unittest.TestCase):
+    def test_import_has_no_side_effects(self):
+        # a fresh interpreter, since other tests already imported these
+        code = (
+            "import food, sys; "
+            "print(sorted({'PIL', 'thefuzz', 'schedule'} & set(sys.modules)))"
+        )
+        out = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        self.assertEqual(out.stdout.strip(), "[]")
+
+    def test_claim_without_history_skips_fuzzy_matching(self):
+        code = (
+            "from fakeredis import FakeStrictRedis; import sys; "
+            "from deduplicate_util import claim_post; "
+            "claim_post(FakeStrictRedis(version=6), 'foo', {'id': 'a', 'title': 'x'}); "
+            "print('thefuzz' in sys.modules)"
+        )
+        out = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        self.assertEqual(out.stdout.strip(), "False")
+
+    def test_post_once(self):
+        with mock.patch("context.AppContext.from_env") as from_env, mock.patch(
+            "food.post"
+        ) as post, mock.patch("sys.stdout", new_callable=StringIO) as out:
+            self.assertEqual(main(["post", "once"]), 0)
+        post.assert_called_once_with(from_env.return_value)
+        self.assertIn("import", out.getvalue())
+        self.assertIn("context", out.getvalue())
+        self.assertIn("total", out.getvalue())
+
+    def test_post_once_fails(self):
+        with mock.patch("context.AppContext.from_env") as from_env, mock.patch(
+            "sys.stdout", new_callable=StringIO
+        ) as out:
+            from_env.side_effect = Exception("Reddit API credentials not configured")
+            self.assertEqual(main(["post", "once"]), 1)
+        self.assertIn("credentials", out.getvalue())
+        self.assertNotIn("context ", out.getvalue())
+
+    def test_report(self):
+        text = report({"import": 0.05, "select": 0.2}, 0.3)
+        self.assertIn("  import        50.0 ms", text)
+        self.assertIn("  select       200.0 ms", text)
+        self.assertIn("  total        300.0 ms", text)
+        self.assertNotIn("deliver", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+from context import AppContext, init_session
+from fakeredis import FakeStrictRedis
+import os
+import unittest
+from unittest import mock
+
+
+class AppContextTest(unittest.TestCase):
+    def test_session_retries_idempotent_requests(self):
+        session = init_session(pool_size=5)
+        retry = session.get_adapter("https://i.redd.it").max_retries
+        self.assertEqual(retry.total, 3)
+        self.assertIn(503, retry.status_forcelist)
+        self.assertNotIn("POST", retry.allowed_methods)
+
+    def test_image_cache_shares_redis(self):
+        r = FakeStrictRedis(version=6)
+        ctx = AppContext(redis=r)
+        self.assertIs(ctx.image_cache.redis, r)
+        self.assertEqual(ctx.request_limit, 24)
+
+    def from_env(self, r=None, **env) -> AppContext:
+        env = {
+            "REDDIT_CLIENT_ID": "id",
+            "REDDIT_CLIENT_SECRET": "secret",
+            "SUBREDDITS": "food",
+            "WEBHOOK_URL": "https://discord.com/api/webhooks/1",
+            **env,
+        }
+        with mock.patch.dict(os.environ, env, clear=True), mock.patch(
+            "context.init_redis", return_value=r or FakeStrictRedis(version=6)
+        ):
+            return AppContext.from_env()
+
+    def test_from_env(self):
+        ctx = self.from_env()
+        self.assertTrue(ctx.global_images)
+        self.assertIsNotNone(ctx.outbox)
+
+    def test_from_env_metrics(self):
+        ctx = self.from_env()
+        self.assertIsNone(ctx.metrics_port)
+        self.assertIsNone(ctx.metrics_file)
+        ctx = self.from_env(METRICS_PORT="9100", METRICS_FILE="metrics.json")
+        self.assertEqual(ctx.metrics_port, 9100)
+        self.assertEqual(ctx.metrics_file, "metrics.json")
+
+    def test_from_env_id_filter(self):
+        r = FakeStrictRedis(version=6)
+        r.set("foo/a", "{}", ex=60)
+        ctx = self.from_env(r)
+        self.assertTrue(ctx.id_filter.might_contain("foo/a"))
+        self.assertFalse(ctx.id_filter.might_contain("foo/b"))
+
+    def test_from_env_id_filter_off(self):
+        r = FakeStrictRedis(version=6)
+        with mock.patch("context.RotatingBloomFilter.rebuild") as rebuild:
+            ctx = self.from_env(r, ID_FILTER="off")
+        self.assertIsNone(ctx.id_filter)
+        rebuild.assert_not_called()
+
+    def test_from_env_requires_webhook(self):
+        with mock.patch.dict(os.environ, {}, clear=True):
+            with self.assertRaises(Exception):
+                AppContext.from_env()
@@ -1,9 +1,26 @@
 import unittest
 from datetime import datetime, timedelta
-from deduplicate_util import already_posted, fuzzy_match
-from food_post import DATETIME_FMT
-from fakeredis import FakeStrictRedis
+from deduplicate_util import (
+    already_posted,
+    backfill_index,
+    claim_post,
+    fuzzy_match,
+    is_duplicate,
+    needs_image_hash,
+    prefetch_candidates,
+    record_post,
+    similar_title,
+    title_match,
+    stored_posts,
+    tokenize,
+)
+from food_post import DATETIME_FMT, FoodPost
+from record import encode_record
+from concurrent.futures import ThreadPoolExecutor
+from fakeredis import FakeServer, FakeStrictRedis
+from unittest import mock
 import json
+import random
 
 
 class DeduplicateUtilTest(unittest.TestCase):
@@ -17,6 +34,17 @@ class DeduplicateUtilTest(unittest.TestCase):
         b = {"hash": 1}
         self.assertTrue(fuzzy_match(a, b))
 
+    def test_fuzzy_match_similar_hash(self):
+        a = {"hash": str(0b1111_0000)}
+        b = {"hash": str(0b1111_0011)}  # 2 bits differ
+        self.assertTrue(fuzzy_match(a, b))
+        self.assertFalse(fuzzy_match(a, b, threshold=1))
+
+    def test_fuzzy_match_unparseable_hash(self):
+        a = {"hash": "None"}
+        b = {"hash": "1"}
+        self.assertFalse(fuzzy_match(a, b))
+
     def test_fuzzy_match_title(self):
         d = datetime(2022, 8, 21, 1)
         ds = d.strftime(DATETIME_FMT)
@@ -65,7 +93,191 @@ class DeduplicateUtilTest(unittest.TestCase):
     def test_already_posted_match_img_hash(self):
         r = FakeStrictRedis(version=6)
         stored = {"id": "bar", "hash": 1}
-        r.set("foo/bar", json.dumps(stored))
+        record_post(r, "foo", stored)
 
         matching = {"id": "baz", "hash": 1}
         self.assertTrue(already_posted(r, "foo", matching))
+
+    def test_is_duplicate_id_match_skips_image_download(self):
+        r = FakeStrictRedis(version=6)
+        r.set("foo/bar", "{}")
+
+        fp = FoodPost(id="bar", title="tacos")
+        with mock.patch.object(FoodPost, "image_hash") as image_hash:
+            self.assertTrue(is_duplicate(r, "foo", fp))
+        image_hash.assert_not_called()
+        self.assertEqual(fp.checks, {"id": True, "match": "foo/bar"})
+
+    def test_is_duplicate_title_match_skips_image_download(self):
+        r = FakeStrictRedis(version=6)
+        d = datetime.now()
+        stored = {"id": "bar", "hash": "1", "title": "Homemade beef tacos."}
+        stored["date"] = d.strftime(DATETIME_FMT)
+        record_post(r, "foo", stored)
+
+        fp = FoodPost(id="baz", title="[homemade] Beef tacos.")
+        fp.date_posted = d
+        with mock.patch.object(FoodPost, "image_hash") as image_hash:
+            self.assertTrue(is_duplicate(r, "foo", fp))
+        image_hash.assert_not_called()
+
+    def test_is_duplicate_memoizes_stages(self):
+        r = FakeStrictRedis(version=6)
+        record_post(r, "foo", {"id": "bar", "hash": "1"})
+
+        fp = FoodPost(id="baz", title="tacos")
+        with mock.patch.object(FoodPost, "image_hash", return_value=0xFFFF) as h:
+            self.assertFalse(is_duplicate(r, "foo", fp))
+            self.assertFalse(is_duplicate(r, "foo", fp))
+        self.assertEqual(h.call_count, 1)
+
+    def test_prefetch_candidates_memoizes_id_check(self):
+        r = FakeStrictRedis(version=6)
+        record_post(r, "foo", {"id": "bar", "hash": "1"})
+
+        seen = FoodPost(id="bar", title="tacos")
+        fresh = FoodPost(id="baz", title="burritos")
+        history = prefetch_candidates(r, [("foo", seen), ("foo", fresh)])
+        self.assertEqual(seen.checks, {"id": True, "match": "foo/bar"})
+        self.assertEqual(fresh.checks, {"id": False})
+        self.assertEqual(history, {"foo": [{"id": "bar", "hash": 1}]})
+
+    def test_claim_post(self):
+        r = FakeStrictRedis(version=6)
+        self.assertTrue(claim_post(r, "foo", {"id": "bar", "hash": "1"}))
+        self.assertFalse(claim_post(r, "foo", {"id": "bar", "hash": "1"}))
+        self.assertEqual(stored_posts(r, "foo"), [{"id": "bar", "hash": 1}])
+        self.assertGreater(r.ttl("foo/bar"), 0)
+
+    def test_lost_claim_keeps_winners_record(self):
+        r = FakeStrictRedis(version=6)
+        self.assertTrue(claim_post(r, "foo", {"id": "bar", "hash": "1"}))
+        # the other instance couldn't hash the image
+        self.assertFalse(claim_post(r, "foo", {"id": "bar", "hash": "None"}))
+        self.assertEqual(stored_posts(r, "foo"), [{"id": "bar", "hash": 1}])
+        self.assertEqual(
+            r.get("foo/bar"), encode_record({"id": "bar", "hash": "1"}).encode()
+        )
+
+    def test_claim_post_across_instances(self):
+        # every instance has its own client, connected to the same server
+        server = FakeServer()
+        clients = [FakeStrictRedis(server=server, version=6) for _ in range(8)]
+        with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+            claims = list(
+                pool.map(lambda c: claim_post(c, "foo", {"id": "bar"}), clients)
+            )
+        self.assertEqual(claims.count(True), 1)
+
+    def test_backfill_index(self):
+        r = FakeStrictRedis(version=6)
+        d = datetime.now()
+        stored = {"id": "bar", "hash": "1", "date": d.strftime(DATETIME_FMT)}
+        r.set("foo/bar", json.dumps(stored))
+        self.assertEqual(stored_posts(r, "foo"), [])
+
+        self.assertEqual(backfill_index(r), 1)
+        ts = int(datetime.strptime(stored["date"], DATETIME_FMT).timestamp())
+        self.assertEqual(stored_posts(r, "foo"), [{"id": "bar", "hash": 1, "ts": ts}])
+        self.assertTrue(r.get("foo/bar").startswith(b"2|"))
+        self.assertTrue(already_posted(r, "foo", {"id": "baz", "hash": "1"}))
+
+    def test_index_drops_expired_records(self):
+        r = FakeStrictRedis(version=6)
+        old = datetime.now() - timedelta(weeks=2)
+        with mock.patch("deduplicate_util.time.time", return_value=old.timestamp()):
+            record_post(r, "foo", {"id": "bar", "hash": "1"})
+        record_post(r, "foo", {"id": "baz", "hash": "2"})
+        self.assertEqual(stored_posts(r, "foo"), [{"id": "baz", "hash": 2}])
+        self.assertEqual(r.hkeys("posts:foo"), [b"baz"])
+
+    def test_index_keeps_records_as_long_as_their_key(self):
+        # created days before it was used, but only just recorded
+        r = FakeStrictRedis(version=6)
+        created = datetime.now() - timedelta(days=6, hours=23)
+        post = {"id": "bar", "hash": "1", "date": created.strftime(DATETIME_FMT)}
+        record_post(r, "foo", post)
+        later = datetime.now() + timedelta(days=2)
+        with mock.patch("deduplicate_util.time.time", return_value=later.timestamp()):
+            self.assertEqual([p["id"] for p in stored_posts(r, "foo")], ["bar"])
+
+    def test_needs_image_hash(self):
+        r = FakeStrictRedis(version=6)
+        record_post(r, "foo", {"id": "bar", "hash": "1", "title": "tacos"})
+
+        seen = FoodPost(id="bar", title="tacos")
+        fresh = FoodPost(id="baz", title="burritos")
+        no_history = FoodPost(id="qux", title="burritos")
+        self.assertFalse(needs_image_hash(r, "foo", seen))
+        self.assertTrue(needs_image_hash(r, "foo", fresh))
+        self.assertFalse(needs_image_hash(r, "quux", no_history))
+        self.assertNotIn("hash", fresh.checks)
+
+    def test_record_post_stores_match_fields(self):
+        r = FakeStrictRedis(version=6)
+        d = datetime.now().replace(second=0, microsecond=0)
+        post = {
+            "id": "bar",
+            "title": "[Homemade] Beef tacos!",
+            "date": d.strftime(DATETIME_FMT),
+        }
+        record_post(r, "foo", post)
+        stored = stored_posts(r, "foo")[0]
+        self.assertEqual(stored["tokens"], ["homemade", "beef", "tacos"])
+        self.assertEqual(stored["ts"], int(d.timestamp()))
+
+    def test_tokenize_matches_thefuzz(self):
+        # what full_process(title, force_ascii=True).split() returns in the
+        # pinned thefuzz 0.19. Later versions also split on underscores
+        for title, expected in [
+            ("Homemade beef tacos.", ["homemade", "beef", "tacos"]),
+            ("Crème brûlée!!", ["crme", "brle"]),
+            ("ramen_bowl (OC) [1080x1080]", ["ramen_bowl", "oc", "1080x1080"]),
+            ("日本 ラーメン", ["日本", "ラーメン"]),
+            ("pizza's ½ price", ["pizza", "s", "price"]),
+        ]:
+            self.assertEqual(tokenize(title), expected)
+
+    def test_similar_title_matches_word_prefixes(self):
+        d = datetime(2022, 8, 21, 1).strftime(DATETIME_FMT)
+        history = [
+            {"id": "a", "title": "Pizza margherita", "date": d},
+            {"id": "b", "title": "Homemade beef tacos", "date": d},
+        ]
+        post = {"title": "homemade beef taco", "date": d}
+        self.assertEqual(similar_title(post, history)["id"], "b")
+
+    def test_similar_title_matches_short_words(self):
+        d = datetime(2022, 8, 21, 1).strftime(DATETIME_FMT)
+        self.assertTrue(
+            title_match({"title": "rib", "date": d}, {"title": "ribs", "date": d})
+        )
+
+    def test_similar_title_matches_words_inside_words(self):
+        d = datetime(2022, 8, 21, 1).strftime(DATETIME_FMT)
+        for a, b in [("Burger", "Cheeseburger"), ("Pho", "Phở")]:
+            self.assertTrue(
+                title_match({"title": a, "date": d}, {"title": b, "date": d})
+            )
+
+    def test_similar_title_prefilter_skips_no_matches(self):
+        rng = random.Random(7)
+        words = ["beef", "tacos", "taco", "burger", "cheeseburger", "pho", "ramen"]
+        words += ["rib", "ribs", "bbq", "pizza", "pie", "oc", "homemade", "i", "ate"]
+        d = datetime(2022, 8, 21, 1).strftime(DATETIME_FMT)
+        for _ in range(2000):
+            a = {"title": " ".join(rng.sample(words, rng.randint(1, 4))), "date": d}
+            b = {"title": " ".join(rng.sample(words, rng.randint(1, 4))), "date": d}
+            # every pair gets the fuzzy ratio without the prefilter
+            with mock.patch("deduplicate_util._may_be_similar", return_value=True):
+                expected = title_match(a, b)
+            self.assertEqual(title_match(a, b), expected, (a, b))
+
+    def test_similar_title_outside_window(self):
+        d = datetime(2022, 8, 21, 1)
+        history = [{"id": "a", "tokens": ["beef", "tacos"], "ts": int(d.timestamp())}]
+        later = d + timedelta(days=2)
+        post = {"tokens": ["beef", "tacos"], "ts": int(later.timestamp())}
+        self.assertIsNone(similar_title(post, history))
+        post["ts"] = int(d.timestamp()) + 60
+        self.assertEqual(similar_title(post, history)["id"], "a")
@@ -0,0 +1,55 @@
+from depth import MAX_LIMIT, MIN_RUNS, LimitController
+from fakeredis import FakeStrictRedis
+from metrics import METRICS
+import unittest
+
+
+class LimitControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.r = FakeStrictRedis(version=6)
+        self.limits = LimitController(self.r, min_limit=5, max_limit=60, window=10)
+
+    def test_default_until_enough_history(self):
+        for _ in range(MIN_RUNS - 1):
+            self.limits.record("food", 1, found=True)
+        self.assertEqual(self.limits.stats("food", 24)["limit"], 24)
+        self.limits.record("food", 1, found=True)
+        self.assertEqual(self.limits.stats("food", 24)["limit"], 5)
+        # each set of subreddits has its own history
+        self.assertEqual(self.limits.stats("ramen", 24)["limit"], 24)
+
+    def test_limit_follows_depth(self):
+        for depth in [2, 3, 3, 4, 4, 5, 6, 8, 12, 16]:
+            self.limits.record("food", depth, found=True)
+        stats = self.limits.stats("food", 24)
+        self.assertEqual(stats["runs"], 10)
+        self.assertEqual(stats["median"], 4)
+        self.assertEqual(stats["quantile"], 12)
+        self.assertEqual(stats["limit"], 15)
+        self.assertEqual(METRICS.gauge("adaptive_limit", subs="food"), 15)
+
+    def test_misses_grow_the_limit(self):
+        for _ in range(10):
+            self.limits.record("food", 24, found=False)
+        stats = self.limits.stats("food", 24)
+        self.assertEqual((stats["misses"], stats["quantile"]), (10, 48))
+        self.assertEqual(stats["limit"], 60)
+
+    def test_only_latest_runs_count(self):
+        for _ in range(10):
+            self.limits.record("food", 40, found=True)
+        for _ in range(10):
+            self.limits.record("food", 8, found=True)
+        self.assertEqual(self.limits.stats("food", 24)["limit"], 10)
+        self.assertEqual(self.r.llen("depth:food"), 10)
+        self.assertGreater(self.r.ttl("depth:food"), 0)
+
+    def test_bounds(self):
+        limits = LimitController(self.r)
+        for _ in range(MIN_RUNS):
+            limits.record("food", 500, found=True)
+        self.assertEqual(limits.stats("food", 24)["limit"], MAX_LIMIT)
+
+
+if __name__ == "__main__":
+    unittest.main()
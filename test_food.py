@@ -0,0 +1,287 @@
+from context import AppContext
+from datetime import datetime
+from deduplicate_util import least_recently_posted, record_post
+from depth import LimitController
+from fakeredis import FakeStrictRedis
+from food import (
+    FALLBACK_CANDIDATES,
+    delivery_main,
+    find_new_posts,
+    get_submission,
+    post,
+    stop_delivery,
+)
+from food_post import DATETIME_FMT, FoodPost
+from image_cache import ImageHashCache
+from outbox import Outbox
+from reservoir import Reservoir
+from unittest import mock
+from webhook import Webhook
+import food
+import threading
+import time
+import unittest
+
+
+class Author:
+    def __init__(self, name):
+        self.name = name
+
+
+class DummySubmission:
+    def __init__(self, post_id, author="foo"):
+        self.id = post_id
+        self.author = Author(author)
+        self.url = f"https://i.redd.it/{post_id}.jpg"
+        self.permalink = f"/r/food/comments/{post_id}"
+        self.title = f"dish number {post_id}"
+        self.created_utc = datetime.now().timestamp()
+        self.media_metadata = None
+
+
+class DummySubreddit:
+    def __init__(self, reddit):
+        self.reddit = reddit
+
+    def hot(self, limit, params=None):
+        self.reddit.requests.append("hot" if params is None else "hot/next")
+        if params is not None:
+            return iter(self.reddit.pages["hot/next"][:limit])
+        return iter(self.reddit.pages["hot"][:limit])
+
+    def rising(self, limit):
+        self.reddit.requests.append("rising")
+        return iter(self.reddit.pages["rising"][:limit])
+
+    def top(self, time_filter, limit):
+        self.reddit.requests.append("top")
+        return iter(self.reddit.pages["top"][:limit])
+
+
+class DummyReddit:
+    def __init__(self, **pages):
+        self.pages = {"hot": [], "hot/next": [], "rising": [], "top": []}
+        self.pages.update(pages)
+        self.requests = []
+
+    def subreddit(self, subs):
+        return DummySubreddit(self)
+
+
+class FindNewPostsTest(unittest.TestCase):
+    def setUp(self):
+        self.r = FakeStrictRedis(version=6)
+        self.cache = ImageHashCache(self.r)
+
+    def posted(self, *post_ids):
+        for post_id in post_ids:
+            record_post(self.r, "foo", {"id": post_id})
+        return [DummySubmission(post_id) for post_id in post_ids]
+
+    def test_no_deeper_search_by_default(self):
+        reddit = DummyReddit(hot=self.posted("a", "b"), rising=[DummySubmission("c")])
+        self.assertEqual(list(find_new_posts(self.r, reddit, "food", 2)), [])
+        self.assertEqual(reddit.requests, ["hot"])
+
+    def test_deeper_search_finds_new_post(self):
+        reddit = DummyReddit(
+            hot=self.posted("a", "b"),
+            **{"hot/next": self.posted("c"), "rising": [DummySubmission("d")]},
+        )
+        self.cache.store(DummySubmission("d").url, 0xFFFF)
+        fp = get_submission(
+            self.r, reddit, "food", 2, cache=self.cache, search_requests=3
+        )
+        self.assertEqual(fp.id, "d")
+        self.assertEqual(reddit.requests, ["hot", "hot/next", "rising"])
+        self.assertEqual(self.r.exists("foo/d"), 1)
+
+    def test_deeper_search_skips_posts_already_examined(self):
+        seen = Reservoir(10)
+        reddit = DummyReddit(hot=self.posted("a"), rising=self.posted("a", "b"))
+        new = find_new_posts(self.r, reddit, "food", 2, seen=seen, search_requests=3)
+        self.assertEqual(list(new), [])
+        self.assertEqual([(c.id, c.rank) for c in seen], [("a", 0), ("b", 1)])
+        self.assertEqual(reddit.requests, ["hot", "hot/next", "rising", "top"])
+
+    def test_deeper_search_request_budget(self):
+        reddit = DummyReddit(hot=self.posted("a"), rising=[DummySubmission("b")])
+        new = find_new_posts(self.r, reddit, "food", 2, search_requests=1)
+        self.assertEqual(list(new), [])
+        self.assertEqual(reddit.requests, ["hot", "hot/next"])
+
+    def test_deeper_search_time_budget(self):
+        reddit = DummyReddit(hot=self.posted("a"), rising=[DummySubmission("b")])
+        # the first extra page takes longer than the whole budget
+        clock = lambda: 30 if "hot/next" in reddit.requests else 0
+        with mock.patch("food.time.monotonic", side_effect=clock):
+            new = find_new_posts(
+                self.r, reddit, "food", 2, search_requests=3, search_seconds=20
+            )
+            self.assertEqual(list(new), [])
+        self.assertEqual(reddit.requests, ["hot", "hot/next"])
+
+    def test_skips_post_claimed_by_another_instance(self):
+        reddit = DummyReddit(hot=[DummySubmission("a"), DummySubmission("b")])
+        for submission in reddit.pages["hot"]:
+            self.cache.store(submission.url, 0xFFFF)
+        # the other instance claims "a" after it was checked, but before
+        # this instance claims it
+        original = food.claim_post
+
+        def claim(r, author, post, *args):
+            if post["id"] == "a":
+                original(r, author, dict(post), *args)
+            return original(r, author, post, *args)
+
+        with mock.patch("food.claim_post", side_effect=claim):
+            fp = get_submission(self.r, reddit, "food", 2, cache=self.cache)
+        self.assertEqual(fp.id, "b")
+
+    def test_skips_posts_by_deleted_authors(self):
+        deleted = DummySubmission("b")
+        deleted.author = None
+        reddit = DummyReddit(hot=[DummySubmission("a"), deleted])
+        self.cache.store(DummySubmission("a").url, 0xFFFF)
+        fp = get_submission(self.r, reddit, "food", 2, cache=self.cache)
+        self.assertEqual(fp.id, "a")
+
+    def test_fallback_picks_least_recently_posted(self):
+        reddit = DummyReddit(hot=self.posted("a", "b", "c"))
+        self.r.pexpire("foo/b", 1000)
+        fp = get_submission(self.r, reddit, "food", 3)
+        self.assertEqual(fp.id, "b")
+
+    def test_fallback_memory_is_bounded(self):
+        posted = self.posted(*(f"p{i}" for i in range(500)))
+        reddit = DummyReddit(hot=posted)
+        seen = Reservoir(FALLBACK_CANDIDATES)
+        new = find_new_posts(self.r, reddit, "food", 500, seen=seen)
+        self.assertEqual(list(new), [])
+        self.assertEqual(seen.count, 500)
+        self.assertEqual(len(seen), FALLBACK_CANDIDATES)
+        fp = get_submission(self.r, reddit, "food", 500)
+        self.assertEqual(fp.title, "dish number " + fp.id)
+
+    def test_adapts_limit_to_selection_depth(self):
+        limits = LimitController(self.r, min_limit=2)
+        reddit = DummyReddit(hot=self.posted("a", "b") + [DummySubmission("c")])
+        self.cache.store(DummySubmission("c").url, 0xFFFF)
+        fp = get_submission(self.r, reddit, "food", 24, cache=self.cache, limits=limits)
+        self.assertEqual(fp.id, "c")
+        self.assertEqual(self.r.lrange("depth:food", 0, -1), [b"3"])
+
+        # every run so far found a new post in the first 3, so the next
+        # ones only fetch 4
+        for _ in range(4):
+            limits.record("food", 3, found=True)
+        reddit = DummyReddit(hot=self.posted(*(f"p{i}" for i in range(10))))
+        seen = Reservoir(FALLBACK_CANDIDATES)
+        with mock.patch("food.Reservoir", return_value=seen):
+            get_submission(self.r, reddit, "food", 24, limits=limits)
+        self.assertEqual(seen.count, 4)
+        self.assertEqual(self.r.lindex("depth:food", 0), b"4+")
+
+    def test_least_recently_posted_dates_posts_by_their_match(self):
+        record_post(self.r, "foo", {"id": "a"})
+        record_post(self.r, "foo", {"id": "b"})
+        self.r.pexpire("foo/b", 1000)
+        candidates = [
+            FoodPost(id="a").ref("foo", 0),
+            # only similar to "b", which went out the longest time ago
+            FoodPost(id="c").ref("foo", 1, "foo/b"),
+            # its match expired, so it can't be dated
+            FoodPost(id="d").ref("foo", 2, "foo/gone"),
+        ]
+        self.assertEqual(least_recently_posted(self.r, candidates).id, "c")
+        self.assertEqual(least_recently_posted(self.r, candidates[::2]).id, "a")
+        self.assertIsNone(least_recently_posted(self.r, []))
+
+    def test_fallback_remembers_what_candidates_matched(self):
+        date = datetime.now().strftime(DATETIME_FMT)
+        record_post(self.r, "foo", {"id": "a", "title": "dish number b", "date": date})
+        seen = Reservoir(10)
+        reddit = DummyReddit(hot=[DummySubmission("a"), DummySubmission("b")])
+        list(find_new_posts(self.r, reddit, "food", 2, seen=seen))
+        self.assertEqual(
+            [(c.id, c.match) for c in seen], [("a", "foo/a"), ("b", "foo/a")]
+        )
+
+    def test_post_enqueues_to_outbox(self):
+        reddit = DummyReddit(hot=[DummySubmission("a")])
+        self.cache.store(DummySubmission("a").url, 0xFFFF)
+        session = mock.Mock()
+        ctx = AppContext(
+            redis=self.r,
+            reddit=reddit,
+            session=session,
+            image_cache=self.cache,
+            webhooks=[Webhook("https://foo", "food"), Webhook("https://bar", "food")],
+            outbox=Outbox(self.r),
+        )
+        post(ctx)
+        # nothing is sent until the outbox is drained
+        session.post.assert_not_called()
+        self.assertEqual(len(ctx.outbox), 2)
+        session.post.return_value.status_code = 204
+        self.assertEqual(ctx.outbox.drain(session), 2)
+        urls = sorted(c.kwargs["url"] for c in session.post.call_args_list)
+        self.assertEqual(urls, ["https://bar", "https://foo"])
+
+    def test_fallback_is_delivered_again_through_outbox(self):
+        reddit = DummyReddit(hot=[DummySubmission("a")])
+        self.cache.store(DummySubmission("a").url, 0xFFFF)
+        session = mock.Mock()
+        session.post.return_value.status_code = 204
+        ctx = AppContext(
+            redis=self.r,
+            reddit=reddit,
+            session=session,
+            image_cache=self.cache,
+            webhooks=[Webhook("https://foo", "food")],
+            outbox=Outbox(self.r),
+        )
+        post(ctx)
+        self.assertEqual(ctx.outbox.drain(session), 1)
+        # "a" was already used, so the next run sends it again
+        post(ctx)
+        self.assertEqual(ctx.outbox.drain(session), 1)
+        self.assertEqual(session.post.call_count, 2)
+
+    def test_post_fails_when_every_delivery_is_rejected(self):
+        reddit = DummyReddit(hot=[DummySubmission("a")])
+        self.cache.store(DummySubmission("a").url, 0xFFFF)
+        outbox = mock.Mock()
+        outbox.enqueue.return_value = False
+        ctx = AppContext(
+            redis=self.r,
+            reddit=reddit,
+            image_cache=self.cache,
+            webhooks=[Webhook("https://foo", "food")],
+            outbox=outbox,
+        )
+        with self.assertRaises(Exception):
+            post(ctx)
+
+    def test_delivery_thread_finishes_batch_before_stopping(self):
+        stop = threading.Event()
+        sending = threading.Event()
+        sent = []
+
+        def deliver(session, workers):
+            sending.set()
+            time.sleep(0.1)  # the batch is still in flight when stop is set
+            sent.append(1)
+            return 1
+
+        ctx = AppContext(redis=self.r, outbox=mock.Mock(deliver=deliver))
+        thread = threading.Thread(target=delivery_main, args=(ctx, stop))
+        thread.start()
+        sending.wait(1)
+        stop_delivery(stop, thread)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(sent, [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,8 @@
 # Tests for the FoodPost class
 from datetime import datetime
-from food_post import FoodPost, DATETIME_FMT
+from food_post import FoodPost, DATETIME_FMT, prefetch_image_hashes
+from unittest import mock
+import time
 import unittest
 
 
@@ -12,6 +14,8 @@ class DummySubmission:
         self.title = kwargs.get("title")
         self.media_metadata = kwargs.get("media_metadata")
         self.created_utc = kwargs.get("created_utc")
+        if "preview" in kwargs:
+            self.preview = kwargs["preview"]
 
 
 class FoodPostTest(unittest.TestCase):
@@ -92,6 +96,27 @@ class FoodPostTest(unittest.TestCase):
         self.assertEqual(d["title"], "hello")
         self.assertEqual(d["date"], now.strftime(DATETIME_FMT))
 
+    def test_post_has_no_instance_dict(self):
+        fp = FoodPost(id="1", title="hello")
+        self.assertFalse(hasattr(fp, "__dict__"))
+        ref = fp.ref("foo", 3)
+        self.assertEqual((ref.author, ref.id, ref.rank), ("foo", "1", 3))
+        self.assertEqual(ref.to_post().to_embed(), fp.to_embed())
+
+    def test_image_hash_uses_timeout_of_submission(self):
+        submission = DummySubmission(id="1", url="https://i.redd.it/1.jpg")
+        fp = FoodPost.from_submission(submission, timeout=2.5)
+        with mock.patch("food_post.compute_image_hash", return_value=7) as compute:
+            self.assertEqual(fp.to_json()["hash"], "7")
+        compute.assert_called_once_with("https://i.redd.it/1.jpg", None, 2.5)
+
+    def test_json_without_hash(self):
+        fp = FoodPost(id="1", title="hello")
+        with mock.patch.object(FoodPost, "image_hash") as image_hash:
+            d = fp.to_json(include_hash=False)
+        image_hash.assert_not_called()
+        self.assertEqual(d, {"id": "1", "title": "hello"})
+
     def test_derive_image_url_from_gallery(self):
         submission_params = {
             "id": "foo",
@@ -153,3 +178,81 @@ class FoodPostTest(unittest.TestCase):
         }
         res = FoodPost.derive_image_url(DummySubmission(**submission_params))
         self.assertIsNone(res)
+
+    def test_derive_preview_url_picks_smallest_resolution(self):
+        preview = {
+            "images": [
+                {
+                    "source": {"url": "https://i.redd.it/foo.jpg", "width": 4000},
+                    "resolutions": [
+                        {
+                            "url": "https://preview.redd.it/foo.jpg?width=640&amp;s=b",
+                            "width": 640,
+                        },
+                        {
+                            "url": "https://preview.redd.it/foo.jpg?width=108&amp;s=a",
+                            "width": 108,
+                        },
+                    ],
+                }
+            ]
+        }
+        submission_params = {
+            "id": "foo",
+            "url": "https://i.redd.it/foo.jpg",
+            "permalink": "baz",
+            "title": "something",
+            "preview": preview,
+        }
+        fp = FoodPost.from_submission(DummySubmission(**submission_params))
+        self.assertEqual(fp.image_url, "https://i.redd.it/foo.jpg")
+        self.assertEqual(
+            fp.preview_url, "https://preview.redd.it/foo.jpg?width=108&s=a"
+        )
+
+    def test_derive_preview_url_from_gallery(self):
+        submission_params = {
+            "id": "foo",
+            "url": "https://www.reddit.com/gallery/bar",
+            "permalink": "baz",
+            "title": "something",
+            "media_metadata": {
+                "foo1": {"p": [{"u": "https://preview.redd.it/foo1.jpg", "x": 108}]},
+                "bar2": {"p": [{"u": "https://preview.redd.it/bar2.jpg", "x": 108}]},
+            },
+        }
+        res = FoodPost.derive_preview_url(DummySubmission(**submission_params))
+        self.assertEqual(res, "https://preview.redd.it/bar2.jpg")
+
+    def test_derive_preview_url_without_preview(self):
+        submission_params = {"id": "foo", "url": "bar", "permalink": "baz"}
+        res = FoodPost.derive_preview_url(DummySubmission(**submission_params))
+        self.assertIsNone(res)
+
+
+class PrefetchImageHashesTest(unittest.TestCase):
+    def test_prefetch_hashes_all_posts(self):
+        posts = [FoodPost(id=str(i), title="tacos") for i in range(5)]
+
+        def image_hash(fp, session, timeout):
+            fp.img_hash = int(fp.id)
+
+        with mock.patch.object(FoodPost, "image_hash", image_hash):
+            prefetch_image_hashes(posts, workers=2, timeout=1)
+        self.assertEqual([fp.img_hash for fp in posts], [0, 1, 2, 3, 4])
+
+    def test_prefetch_marks_slow_images_as_failed(self):
+        fast = FoodPost(id="fast", title="tacos")
+        slow = FoodPost(id="slow", title="tacos")
+
+        def image_hash(fp, session, timeout):
+            if fp is slow:
+                time.sleep(0.5)
+            else:
+                fp.img_hash = 1
+
+        with mock.patch.object(FoodPost, "image_hash", image_hash):
+            prefetch_image_hashes([fast, slow], workers=2, timeout=0.1)
+        self.assertEqual(fast.img_hash, 1)
+        self.assertFalse(fast.hash_failed)
+        self.assertTrue(slow.hash_failed)
@@ -0,0 +1,55 @@
+from fakeredis import FakeStrictRedis
+from food_post import FoodPost
+from image_cache import ImageHashCache
+import unittest
+
+
+class ImageHashCacheTest(unittest.TestCase):
+    def test_memory_tier(self):
+        cache = ImageHashCache()
+        self.assertEqual(cache.lookup("foo"), (False, None))
+        cache.store("foo", 123)
+        self.assertEqual(cache.lookup("foo"), (True, 123))
+        self.assertEqual(cache.stats["memory_hits"], 1)
+        self.assertEqual(cache.stats["misses"], 1)
+        self.assertEqual(cache.hit_rate(), 0.5)
+
+    def test_memory_tier_is_bounded(self):
+        cache = ImageHashCache(max_size=2)
+        cache.store("a", 1)
+        cache.store("b", 2)
+        cache.lookup("a")  # b is now the least recently used
+        cache.store("c", 3)
+        self.assertEqual(list(cache.entries), ["a", "c"])
+
+    def test_redis_tier(self):
+        r = FakeStrictRedis(version=6)
+        ImageHashCache(r).store("foo", 123)
+
+        cache = ImageHashCache(r)  # e.g. after a restart
+        self.assertEqual(cache.lookup("foo"), (True, 123))
+        self.assertEqual(cache.stats["redis_hits"], 1)
+        self.assertEqual(cache.lookup("foo"), (True, 123))
+        self.assertEqual(cache.stats["memory_hits"], 1)
+
+    def test_negative_results(self):
+        r = FakeStrictRedis(version=6)
+        ImageHashCache(r).store("foo", None)
+        self.assertLessEqual(r.ttl("imghash:foo"), 24 * 60 * 60)
+
+        cache = ImageHashCache(r)
+        self.assertEqual(cache.lookup("foo"), (True, None))
+        self.assertEqual(cache.stats["negative_hits"], 1)
+
+    def test_food_post_uses_cache(self):
+        cache = ImageHashCache()
+        cache.store("https://i.redd.it/foo.jpg", 123)
+        fp = FoodPost(id="1", image_url="https://i.redd.it/foo.jpg", cache=cache)
+        self.assertEqual(fp.image_hash(), 123)
+
+    def test_food_post_caches_failures(self):
+        cache = ImageHashCache()
+        fp = FoodPost(id="1", image_url="not a url", cache=cache)
+        self.assertIsNone(fp.image_hash())
+        self.assertTrue(fp.hash_failed)
+        self.assertEqual(cache.lookup("not a url"), (True, None))
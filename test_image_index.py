@@ -0,0 +1,84 @@
+from datetime import timedelta
+from deduplicate_util import is_duplicate, needs_image_hash, record_post
+from fakeredis import FakeStrictRedis
+from food_post import FoodPost
+from image_index import BANDS, find_similar_images, index_image
+from unittest import mock
+import unittest
+
+TTL = timedelta(weeks=1)
+HASH = 0x0123456789ABCDEF
+
+
+class ImageIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.r = FakeStrictRedis(version=6)
+
+    def index(self, author, post_id, img_hash, ttl=TTL):
+        pipe = self.r.pipeline()
+        index_image(pipe, author, post_id, img_hash, ttl)
+        pipe.execute()
+
+    def test_finds_images_from_other_authors(self):
+        self.index("foo", "bar", HASH)
+        self.index("qux", "quux", HASH ^ 0b101)  # 2 bits off
+        self.index("baz", "far", HASH ^ 0xFFFF)  # 16 bits off
+        self.assertEqual(
+            find_similar_images(self.r, HASH, 6, TTL),
+            [("foo/bar", 0), ("qux/quux", 2)],
+        )
+
+    def test_finds_every_match_within_band_count(self):
+        # one differing bit in each band but the last still shares a bucket
+        near = HASH
+        for band in range(BANDS - 1):
+            near ^= 1 << (band * 8)
+        self.index("foo", "bar", near)
+        self.assertEqual(
+            find_similar_images(self.r, HASH, BANDS - 1, TTL),
+            [("foo/bar", BANDS - 1)],
+        )
+
+    def test_lookup_only_reads_matching_buckets(self):
+        self.index("foo", "bar", HASH)
+        self.index("foo", "baz", ~HASH & (2**64 - 1))
+        self.assertEqual(len(self.r.keys("lsh:*")), 2 * BANDS)
+        with mock.patch("image_index.hamming_distance") as distance:
+            distance.return_value = 0
+            find_similar_images(self.r, HASH, 6, TTL)
+        distance.assert_called_once()
+
+    def test_exclude(self):
+        self.index("foo", "bar", HASH)
+        self.assertEqual(find_similar_images(self.r, HASH, 6, TTL, "foo/bar"), [])
+
+    def test_expired_entries_are_ignored(self):
+        with mock.patch("image_index.time.time", return_value=1000):
+            self.index("foo", "bar", HASH)
+        self.assertEqual(find_similar_images(self.r, HASH, 6, TTL), [])
+        self.index("foo", "baz", HASH)
+        # the expired entry is pruned when its buckets are written to
+        self.assertEqual(self.r.zcard(f"lsh:0:{HASH & 0xFF:x}"), 1)
+        self.assertGreater(self.r.ttl(f"lsh:0:{HASH & 0xFF:x}"), 0)
+
+    def test_record_post_indexes_image(self):
+        record_post(self.r, "foo", {"id": "bar", "hash": str(HASH)})
+        record_post(self.r, "foo", {"id": "baz", "hash": "None"})
+        self.assertEqual(find_similar_images(self.r, HASH, 6, TTL), [("foo/bar", 0)])
+
+    def test_is_duplicate_across_authors(self):
+        record_post(self.r, "foo", {"id": "bar", "hash": str(HASH)})
+
+        fp = FoodPost(id="baz", title="tacos")
+        fp.img_hash = HASH ^ 1
+        self.assertFalse(is_duplicate(self.r, "qux", fp))
+
+        fp = FoodPost(id="baz", title="tacos")
+        self.assertTrue(needs_image_hash(self.r, "qux", fp, [], global_images=True))
+        fp.img_hash = HASH ^ 1
+        self.assertTrue(is_duplicate(self.r, "qux", fp, global_images=True))
+        self.assertEqual(fp.checks["hash"], True)
+
+
+if __name__ == "__main__":
+    unittest.main()
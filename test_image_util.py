@@ -1,4 +1,11 @@
-from image_util import compute_image_hash
+from image_util import (
+    compute_image_hash,
+    dhash,
+    hamming_distance,
+    open_thumbnail,
+)
+from io import BytesIO
+from PIL import Image, ImageDraw
 import unittest
 
 # Validating https://github.com/SaxyPandaBear/my-webhooks/issues/11
@@ -22,3 +29,59 @@ class ImageUtilTest(unittest.TestCase):
         h1 = compute_image_hash(img1)
         h2 = compute_image_hash(img3)
         self.assertNotEqual(h1, h2)
+
+
+def gradient(width: int, height: int, flip: bool = False) -> Image.Image:
+    im = Image.new("RGB", (width, height))
+    draw = ImageDraw.Draw(im)
+    for x in range(width):
+        shade = 255 * x // width
+        if flip:
+            shade = 255 - shade
+        draw.line([(x, 0), (x, height)], fill=(shade, shade, shade))
+    draw.rectangle([0, 0, width // 3, height // 3], fill=(255, 0, 0))
+    return im
+
+
+class PerceptualHashTest(unittest.TestCase):
+    def test_resized_image_has_similar_hash(self):
+        h1 = dhash(gradient(800, 600))
+        h2 = dhash(gradient(400, 300))
+        self.assertLessEqual(hamming_distance(h1, h2), 4)
+
+    def test_different_image_has_different_hash(self):
+        h1 = dhash(gradient(800, 600))
+        h2 = dhash(gradient(800, 600, flip=True))
+        self.assertGreater(hamming_distance(h1, h2), 16)
+
+    def test_hash_fits_in_64_bits(self):
+        self.assertLess(dhash(gradient(100, 100)), 1 << 64)
+
+    def test_open_thumbnail_decodes_at_reduced_size(self):
+        buf = BytesIO()
+        gradient(2000, 1500).save(buf, format="JPEG")
+        buf.seek(0)
+        with open_thumbnail(buf) as im:
+            self.assertLess(max(im.size), 500)
+            self.assertGreaterEqual(min(im.size), 64)
+            h = dhash(im)
+        self.assertLessEqual(hamming_distance(h, dhash(gradient(2000, 1500))), 4)
+
+    def test_open_thumbnail_png(self):
+        buf = BytesIO()
+        gradient(1000, 1000).save(buf, format="PNG")
+        buf.seek(0)
+        with open_thumbnail(buf) as im:
+            self.assertEqual(im.size, (67, 67))  # reduced by a factor of 15
+
+    def test_open_thumbnail_palette_images(self):
+        expected = dhash(gradient(1000, 1000))
+        for fmt, mode in [("PNG", "P"), ("GIF", "P"), ("PNG", "1"), ("PNG", "I;16")]:
+            buf = BytesIO()
+            gradient(1000, 1000).convert("L").convert(mode).save(buf, format=fmt)
+            buf.seek(0)
+            with open_thumbnail(buf) as im:
+                self.assertEqual(im.size, (67, 67))
+                h = dhash(im)
+            if mode == "P":
+                self.assertLessEqual(hamming_distance(h, expected), 4)
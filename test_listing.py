@@ -0,0 +1,104 @@
+from listing import fetch_deeper, fetch_parallel, listing_from_config, merge
+import unittest
+
+
+class DummySubmission:
+    def __init__(self, id, score=0):
+        self.id = id
+        self.score = score
+
+    def __repr__(self):
+        return self.id
+
+
+class DummySubreddit:
+    def __init__(self, reddit, name):
+        self.reddit = reddit
+        self.name = name
+
+    def hot(self, limit, params=None):
+        self.reddit.requests.append((self.name, limit))
+        listing = self.reddit.listings[self.name]
+        if params is not None and "after" in params:
+            ids = [f"t3_{s.id}" for s in listing]
+            listing = listing[ids.index(params["after"]) + 1 :]
+        return iter(listing[:limit])
+
+    def rising(self, limit):
+        self.reddit.requests.append((f"{self.name}/rising", limit))
+        return iter(self.reddit.listings[f"{self.name}/rising"][:limit])
+
+    def top(self, time_filter, limit):
+        self.reddit.requests.append((f"{self.name}/top/{time_filter}", limit))
+        return iter(self.reddit.listings[f"{self.name}/top/{time_filter}"][:limit])
+
+
+class DummyReddit:
+    def __init__(self, listings):
+        self.listings = listings
+        self.requests = []
+
+    def subreddit(self, name):
+        return DummySubreddit(self, name)
+
+
+class ListingTest(unittest.TestCase):
+    def test_fetch_deeper_is_lazy(self):
+        reddit = DummyReddit(
+            {
+                "food": [DummySubmission(f"h{i}") for i in range(4)],
+                "food/rising": [DummySubmission("r1")],
+                "food/top/day": [DummySubmission("t1")],
+            }
+        )
+        pages = fetch_deeper(reddit, "food", 2, after="t3_h1")
+        self.assertEqual(reddit.requests, [])
+        self.assertEqual([s.id for s in next(pages)], ["h2", "h3"])
+        self.assertEqual([s.id for s in next(pages)], ["r1"])
+        self.assertEqual(len(reddit.requests), 2)
+        self.assertEqual([s.id for s in next(pages)], ["t1"])
+        self.assertIsNone(next(pages, None))
+
+    def test_fetch_deeper_without_cursor(self):
+        reddit = DummyReddit({"food/rising": [], "food/top/day": []})
+        self.assertEqual(len(list(fetch_deeper(reddit, "food", 2))), 2)
+        self.assertEqual(reddit.requests, [("food/rising", 2), ("food/top/day", 2)])
+
+    def test_merge_round_robin(self):
+        a = [DummySubmission("a1"), DummySubmission("a2"), DummySubmission("a3")]
+        b = [DummySubmission("b1")]
+        merged = merge([a, b])
+        self.assertEqual([s.id for s in merged], ["a1", "b1", "a2", "a3"])
+
+    def test_merge_by_score(self):
+        a = [DummySubmission("a1", 10), DummySubmission("a2", 1)]
+        b = [DummySubmission("b1", 5)]
+        merged = merge([a, b], "score")
+        self.assertEqual([s.id for s in merged], ["a1", "b1", "a2"])
+
+    def test_merge_drops_duplicates(self):
+        a = [DummySubmission("x")]
+        b = [DummySubmission("x"), DummySubmission("b1")]
+        self.assertEqual([s.id for s in merge([a, b])], ["x", "b1"])
+
+    def test_merge_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            merge([], "foo")
+
+    def test_fetch_parallel_splits_limit(self):
+        reddit = DummyReddit(
+            {
+                "big": [DummySubmission(f"big{i}") for i in range(10)],
+                "small": [DummySubmission("small0")],
+            }
+        )
+        merged = fetch_parallel(reddit, "big+small", 4)
+        self.assertEqual([s.id for s in merged], ["big0", "small0", "big1"])
+        self.assertEqual(sorted(reddit.requests), [("big", 2), ("small", 2)])
+
+    def test_listing_from_config(self):
+        reddit = DummyReddit({"a": [DummySubmission("a0")], "b": []})
+        listing = listing_from_config("parallel")
+        self.assertEqual([s.id for s in listing(reddit, "a+b", 2)], ["a0"])
+        with self.assertRaises(ValueError):
+            listing_from_config("foo")
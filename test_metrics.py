@@ -0,0 +1,59 @@
+from metrics import Metrics
+from urllib.request import urlopen
+import json
+import os
+import tempfile
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counters(self):
+        m = Metrics()
+        m.incr("dedup_verdicts", reason="id")
+        m.incr("dedup_verdicts", reason="id")
+        m.incr("dedup_verdicts", reason="new")
+        self.assertEqual(m.counter("dedup_verdicts", reason="id"), 2)
+        self.assertEqual(m.counter("dedup_verdicts", reason="hash"), 0)
+
+    def test_gauges(self):
+        m = Metrics()
+        m.set("adaptive_limit", 24, subs="food")
+        m.set("adaptive_limit", 12, subs="food")
+        self.assertEqual(m.gauge("adaptive_limit", subs="food"), 12)
+        self.assertIn('adaptive_limit{subs="food"} 12', m.to_prometheus())
+
+    def test_timer_records_even_on_error(self):
+        m = Metrics()
+        with self.assertRaises(ValueError):
+            with m.timer("redis", op="exists"):
+                raise ValueError()
+        self.assertEqual(m.timers[("redis", (("op", "exists"),))]["count"], 1)
+
+    def test_prometheus_format(self):
+        m = Metrics()
+        m.incr("selection_runs")
+        m.observe("redis", 0.5, op="prefetch")
+        text = m.to_prometheus()
+        self.assertIn("selection_runs_total 1", text)
+        self.assertIn('redis_seconds_count{op="prefetch"} 1', text)
+        self.assertIn('redis_seconds_sum{op="prefetch"} 0.500000', text)
+
+    def test_dump(self):
+        m = Metrics()
+        m.incr("selection_fallbacks")
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "metrics.json")
+            m.dump(path)
+            with open(path) as f:
+                data = json.load(f)
+        self.assertEqual(data["counters"][0]["name"], "selection_fallbacks")
+
+    def test_serve(self):
+        m = Metrics()
+        m.incr("candidates_examined", 3)
+        server = m.serve(0)
+        try:
+            with urlopen(f"http://127.0.0.1:{server.server_port}/metrics") as res:
+                self.assertIn("candidates_examined_total 3", res.read().decode())
+        finally:
+            server.shutdown()
@@ -0,0 +1,110 @@
+from fakeredis import FakeStrictRedis
+from outbox import MAX_BACKOFF, Outbox, backoff, delivery_key
+from unittest import mock
+import json
+import requests
+import unittest
+
+
+def response(status: int, headers=None) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status
+    res.headers.update(headers or {})
+    res._content = b"{}"
+    return res
+
+
+class DummySession:
+    # returns the scripted responses for each URL, in order
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = []
+
+    def post(self, url, json, timeout=None):
+        self.sent.append((url, json))
+        res = self.responses[url].pop(0)
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.r = FakeStrictRedis(version=6)
+        self.outbox = Outbox(self.r, max_attempts=3)
+
+    def test_delivery_key(self):
+        key = delivery_key("abc", "https://discord.com/api/webhooks/1/token")
+        self.assertTrue(key.startswith("abc@"))
+        self.assertNotIn("token", key)
+        self.assertNotEqual(key, delivery_key("abc", "https://foo"))
+
+    def test_backoff(self):
+        self.assertEqual([backoff(n) for n in (1, 2, 3)], [2.0, 4.0, 8.0])
+        self.assertEqual(backoff(100), MAX_BACKOFF)
+
+    def test_delivers_once(self):
+        session = DummySession({"https://foo": [response(204)]})
+        self.assertTrue(self.outbox.enqueue("https://foo", {"a": 1}, "k"))
+        self.assertFalse(self.outbox.enqueue("https://foo", {"a": 1}, "k"))
+        self.assertEqual(len(self.outbox), 1)
+
+        self.assertEqual(self.outbox.drain(session), 1)
+        self.assertEqual(session.sent, [("https://foo", {"a": 1})])
+        self.assertEqual(len(self.outbox), 0)
+        # already delivered, so it's never queued again
+        self.assertFalse(self.outbox.enqueue("https://foo", {"a": 1}, "k"))
+        self.assertEqual(self.outbox.drain(session), 0)
+
+    def test_lease_keeps_other_workers_out(self):
+        self.outbox.enqueue("https://foo", {"a": 1}, "k")
+        other = Outbox(self.r)
+        self.assertEqual([key for key, _ in self.outbox.take()], ["k"])
+        self.assertEqual(other.take(), [])
+
+    def test_retries_when_rate_limited(self):
+        limited = response(429, {"Retry-After": "5"})
+        session = DummySession({"https://foo": [limited, response(204)]})
+        with mock.patch("outbox.time.time", return_value=1000):
+            self.outbox.enqueue("https://foo", {"a": 1}, "k")
+            self.assertEqual(self.outbox.drain(session), 1)
+            # not due yet
+            self.assertEqual(self.outbox.drain(session), 0)
+        self.assertEqual(self.r.zscore("outbox:pending", "k"), 1005)
+        self.assertEqual(len(self.outbox), 1)
+        with mock.patch("outbox.time.time", return_value=1005):
+            self.assertEqual(self.outbox.drain(session), 1)
+        self.assertEqual(len(session.sent), 2)
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_gives_up_after_max_attempts(self):
+        errors = [requests.ConnectionError(), response(502), response(503)]
+        session = DummySession({"https://foo": errors})
+        with mock.patch("outbox.time.time", return_value=1000):
+            self.outbox.enqueue("https://foo", {"a": 1}, "k")
+        for now in (1000, 1002, 1006):
+            with mock.patch("outbox.time.time", return_value=now):
+                self.assertEqual(self.outbox.drain(session), 1)
+        self.assertEqual(len(session.sent), 3)
+        self.assertEqual(len(self.outbox), 0)
+        dead = json.loads(self.r.lindex("outbox:dead", 0))
+        self.assertEqual((dead["key"], dead["reason"]), ("k", "status 503"))
+
+    def test_client_errors_are_not_retried(self):
+        session = DummySession({"https://foo": [response(404)], "https://bar": []})
+        self.outbox.enqueue("https://foo", {"a": 1}, "k")
+        self.assertEqual(self.outbox.drain(session), 1)
+        self.assertEqual(len(self.outbox), 0)
+        self.assertEqual(self.r.llen("outbox:dead"), 1)
+
+    def test_batches(self):
+        session = DummySession({"https://foo": [response(204) for _ in range(25)]})
+        for i in range(25):
+            self.outbox.enqueue("https://foo", {"a": i}, f"k{i}")
+        self.assertEqual(self.outbox.deliver(session), 10)
+        self.assertEqual(self.outbox.drain(session), 15)
+        self.assertEqual(sorted(d["a"] for _, d in session.sent), list(range(25)))
+
+
+if __name__ == "__main__":
+    unittest.main()
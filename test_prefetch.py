@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+from fakeredis import FakeStrictRedis
+from food_post import FoodPost
+from prefetch import CandidatePool
+import unittest
+
+
+def candidate(author: str, post_id: str):
+    fp = FoodPost(
+        id=post_id,
+        title=f"post {post_id}",
+        permalink=f"https://www.reddit.com/r/food/{post_id}",
+        image_url=f"https://i.redd.it/{post_id}.jpg",
+        img_hash=1,
+        created_utc=datetime.now().timestamp(),
+    )
+    return author, fp
+
+
+class CandidatePoolTest(unittest.TestCase):
+    def test_pop_in_ranked_order(self):
+        r = FakeStrictRedis(version=6)
+        pool = CandidatePool(r, "food", size=2)
+        pool.refresh(
+            iter([candidate("a", "1"), candidate("b", "2"), candidate("c", "3")])
+        )
+        self.assertEqual(len(pool), 2)
+
+        author, fp = pool.pop()
+        self.assertEqual((author, fp.id), ("a", "1"))
+        self.assertEqual(fp.post_url, "https://www.reddit.com/r/food/1")
+        self.assertEqual(pool.pop()[1].id, "2")
+        self.assertIsNone(pool.pop())
+
+    def test_popped_posts_keep_image_timeout(self):
+        r = FakeStrictRedis(version=6)
+        pool = CandidatePool(r, "food", image_timeout=2.5)
+        pool.refresh(iter([candidate("a", "1")]))
+        self.assertEqual(pool.pop()[1].timeout, 2.5)
+
+    def test_one_post_per_author(self):
+        r = FakeStrictRedis(version=6)
+        pool = CandidatePool(r, "food", size=2)
+        pool.refresh(
+            iter([candidate("a", "1"), candidate("a", "2"), candidate("b", "3")])
+        )
+        self.assertEqual([pool.pop()[1].id, pool.pop()[1].id], ["1", "3"])
+
+    def test_pop_skips_posts_used_since_queued(self):
+        r = FakeStrictRedis(version=6)
+        pool = CandidatePool(r, "food")
+        pool.refresh(iter([candidate("a", "1"), candidate("b", "2")]))
+        r.set("a/1", "{}")
+        self.assertEqual(pool.pop()[1].id, "2")
+
+    def test_pop_skips_stale_posts(self):
+        r = FakeStrictRedis(version=6)
+        pool = CandidatePool(r, "food", max_age=timedelta(minutes=30))
+        pool.refresh(iter([candidate("a", "1"), candidate("b", "2")]))
+        pool.entries[0]["fetched_at"] -= 60 * 60
+        self.assertEqual(pool.pop()[1].id, "2")
+
+    def test_survives_restart(self):
+        r = FakeStrictRedis(version=6)
+        CandidatePool(r, "food").refresh(iter([candidate("a", "1")]))
+
+        restarted = CandidatePool(r, "food")
+        author, fp = restarted.pop()
+        self.assertEqual((author, fp.id, fp.img_hash), ("a", "1", 1))
+        self.assertIsNone(CandidatePool(r, "food").pop())
@@ -0,0 +1,59 @@
+from datetime import datetime
+from deduplicate_util import match_fields
+from food_post import DATETIME_FMT
+from record import decode_record, encode_record
+import json
+import unittest
+
+
+class RecordTest(unittest.TestCase):
+    def test_round_trip(self):
+        post = {
+            "id": "abc123",
+            "hash": str(2**64 - 1),
+            "ts": 1661043600,
+            "tokens": ["homemade", "beef", "tacos"],
+        }
+        val = encode_record(post)
+        self.assertTrue(val.startswith("2|abc123|"))
+        self.assertEqual(
+            decode_record(val),
+            {
+                "id": "abc123",
+                "hash": 2**64 - 1,
+                "ts": 1661043600,
+                "tokens": ["homemade", "beef", "tacos"],
+            },
+        )
+        self.assertEqual(decode_record(val.encode()), decode_record(val))
+
+    def test_missing_fields(self):
+        for post in (
+            {"id": "abc123"},
+            {"id": "abc123", "hash": "None"},
+            {"id": "abc123", "tokens": []},
+        ):
+            self.assertEqual(decode_record(encode_record(post)), {"id": "abc123"})
+
+    def test_decode_legacy_json(self):
+        legacy = {"id": "abc123", "title": "Tacos", "hash": "1234"}
+        self.assertEqual(decode_record(json.dumps(legacy)), legacy)
+
+    def test_decode_malformed(self):
+        with self.assertRaises(ValueError):
+            decode_record("2|abc123")
+
+    def test_smaller_than_legacy_json(self):
+        legacy = {
+            "id": "wbv3x1",
+            "title": "[Homemade] Smoked brisket with pickled onions and white bread",
+            "date": datetime(2022, 8, 21, 1).strftime(DATETIME_FMT),
+            "hash": str(17834605234298770813),
+        }
+        compact = encode_record(match_fields(dict(legacy)))
+        self.assertLess(len(compact), len(json.dumps(match_fields(dict(legacy)))) / 2)
+        self.assertLess(len(compact), len(json.dumps(legacy)))
+
+
+if __name__ == "__main__":
+    unittest.main()
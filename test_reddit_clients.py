@@ -0,0 +1,77 @@
+from reddit_clients import BudgetedRequestor, RequestBudget, ThreadLocalReddit
+from unittest import mock
+import threading
+import unittest
+
+
+class RequestBudgetTest(unittest.TestCase):
+    def test_waits_once_the_budget_is_used_up(self):
+        clock = [0.0]
+        waits = []
+
+        def sleep(seconds):
+            waits.append(seconds)
+            clock[0] += seconds
+
+        budget = RequestBudget(per_minute=2)
+        with mock.patch("reddit_clients.time.monotonic", lambda: clock[0]), mock.patch(
+            "reddit_clients.time.sleep", sleep
+        ):
+            budget.acquire()
+            clock[0] = 10
+            budget.acquire()
+            self.assertEqual(waits, [])
+            budget.acquire()  # until the first request is a minute old
+            self.assertEqual(waits, [50])
+            budget.acquire()
+            self.assertEqual(waits, [50, 10])
+
+    def test_requestor_counts_every_request(self):
+        budget = mock.Mock()
+        requestor = BudgetedRequestor(
+            user_agent="discord:food_waifu:test",
+            session=mock.MagicMock(),
+            budget=budget,
+        )
+        requestor.request("GET", "https://oauth.reddit.com/r/food/hot")
+        requestor.request("GET", "https://oauth.reddit.com/r/food/hot")
+        self.assertEqual(budget.acquire.call_count, 2)
+
+
+class ThreadLocalRedditTest(unittest.TestCase):
+    def test_one_client_per_thread(self):
+        reddit = ThreadLocalReddit(object)
+        main = reddit.client()
+        self.assertIs(reddit.client(), main)
+
+        started, release = threading.Barrier(3), threading.Event()
+        clients = []
+
+        def use():
+            clients.append(reddit.client())
+            started.wait()
+            release.wait()
+
+        threads = [threading.Thread(target=use) for _ in range(2)]
+        for t in threads:
+            t.start()
+        started.wait()
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len({id(c) for c in [main, *clients]}), 3)
+
+    def test_clients_of_exited_threads_are_reused(self):
+        built = []
+        reddit = ThreadLocalReddit(lambda: built.append(object()) or built[-1])
+        for _ in range(3):
+            t = threading.Thread(target=reddit.client)
+            t.start()
+            t.join()
+        self.assertEqual(len(built), 1)
+
+    def test_delegates_to_the_client(self):
+        client = mock.Mock()
+        reddit = ThreadLocalReddit(lambda: client)
+        reddit.subreddit("food").hot(limit=2)
+        client.subreddit.assert_called_once_with("food")
@@ -0,0 +1,35 @@
+from collections import Counter
+from reservoir import Reservoir
+import random
+import unittest
+
+
+class ReservoirTest(unittest.TestCase):
+    def test_keeps_everything_until_full(self):
+        r = Reservoir(5)
+        for i in range(3):
+            r.add(i)
+        self.assertEqual(list(r), [0, 1, 2])
+
+    def test_size_is_bounded(self):
+        r = Reservoir(5)
+        for i in range(10000):
+            r.add(i)
+        self.assertEqual(len(r), 5)
+        self.assertEqual(r.count, 10000)
+
+    def test_sample_is_uniform(self):
+        rng = random.Random(0)
+        kept = Counter()
+        for _ in range(2000):
+            r = Reservoir(2, rng)
+            for i in range(10):
+                r.add(i)
+            kept.update(r)
+        # every item should be kept 2/10 of the time, i.e. ~400 times
+        for i in range(10):
+            self.assertTrue(300 < kept[i] < 500, kept)
+
+
+if __name__ == "__main__":
+    unittest.main()
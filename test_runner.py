@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+from runner import AsyncRunner, Job
+import asyncio
+import threading
+import time
+import unittest
+
+
+class JobTest(unittest.TestCase):
+    def test_next_run_hourly(self):
+        job = Job("foo", lambda: None)
+        now = datetime(2022, 8, 21, 13, 42, 10)
+        self.assertEqual(job.next_run(now), datetime(2022, 8, 21, 14))
+
+    def test_next_run_on_the_hour(self):
+        job = Job("foo", lambda: None)
+        now = datetime(2022, 8, 21, 13)
+        self.assertEqual(job.next_run(now), datetime(2022, 8, 21, 14))
+
+    def test_next_run_every_30_minutes(self):
+        job = Job("foo", lambda: None, interval=timedelta(minutes=30))
+        now = datetime(2022, 8, 21, 23, 42)
+        self.assertEqual(job.next_run(now), datetime(2022, 8, 22))
+
+
+class AsyncRunnerTest(unittest.TestCase):
+    def test_run_job_times_out(self):
+        done = threading.Event()
+        job = Job("slow", lambda: time.sleep(0.3) or done.set(), timeout=0.05)
+        runner = AsyncRunner([job])
+
+        async def run():
+            runner.semaphore = asyncio.Semaphore(1)
+            await runner.run_job(job)
+
+        start = time.monotonic()
+        asyncio.run(run())
+        self.assertLess(time.monotonic() - start, 0.25)
+        done.wait(1)
+
+    def test_timed_out_job_is_running_until_its_thread_exits(self):
+        release = threading.Event()
+        runs = []
+        job = Job("hung", lambda: runs.append(1) or release.wait(), timeout=0.05)
+        runner = AsyncRunner([job])
+
+        async def run():
+            runner.semaphore = asyncio.Semaphore(1)
+            await runner.run_job(job)
+            self.assertIn("hung", runner.running)
+            await runner.run_job(job)  # skipped, the first run is still going
+            self.assertEqual(runs, [1])
+
+            release.set()
+            while "hung" in runner.running:
+                await asyncio.sleep(0.01)
+            await runner.run_job(job)
+            self.assertEqual(runs, [1, 1])
+
+        try:
+            asyncio.run(run())
+        finally:
+            release.set()
+
+    def test_hung_runs_do_not_hold_up_later_runs(self):
+        hang = threading.Event()
+        hung = Job("hung", hang.wait, timeout=0.05)
+        finished = []
+        job = Job("foo", lambda: finished.append(1), timeout=0.5)
+        runner = AsyncRunner([hung, job], max_concurrency=1)
+
+        async def run():
+            runner.semaphore = asyncio.Semaphore(1)
+            await runner.run_job(hung)
+            await runner.run_job(job)
+
+        try:
+            asyncio.run(run())
+            self.assertEqual(finished, [1])
+            self.assertEqual(len(runner.abandoned), 1)
+        finally:
+            hang.set()
+
+    def test_run_job_swallows_exceptions(self):
+        def fail():
+            raise Exception("boom")
+
+        job = Job("fail", fail)
+        runner = AsyncRunner([job])
+
+        async def run():
+            runner.semaphore = asyncio.Semaphore(1)
+            await runner.run_job(job)
+
+        asyncio.run(run())  # does not raise
+
+    def test_shutdown_drains_in_flight_runs(self):
+        finished = []
+        job = Job("foo", lambda: time.sleep(0.1) or finished.append(1))
+        runner = AsyncRunner([])
+
+        async def run():
+            stopper = asyncio.ensure_future(runner.run())
+            await asyncio.sleep(0)
+            task = asyncio.ensure_future(runner.run_job(job))
+            runner.in_flight.add(task)
+            task.add_done_callback(runner.in_flight.discard)
+            runner.shutdown()
+            await stopper
+
+        asyncio.run(run())
+        self.assertEqual(finished, [1])
+
+    def test_shutdown_stops_background_work_after_drain(self):
+        calls = []
+        job = Job("foo", lambda: time.sleep(0.1) or calls.append("run"))
+        runner = AsyncRunner([], on_stop=lambda: calls.append("stop"))
+
+        async def run():
+            stopper = asyncio.ensure_future(runner.run())
+            await asyncio.sleep(0)
+            task = asyncio.ensure_future(runner.run_job(job))
+            runner.in_flight.add(task)
+            task.add_done_callback(runner.in_flight.discard)
+            runner.shutdown()
+            await stopper
+
+        asyncio.run(run())
+        self.assertEqual(calls, ["run", "stop"])
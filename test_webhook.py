@@ -0,0 +1,72 @@
+from webhook import deliver, deliver_all, parse_webhooks, retry_after
+import json
+import requests
+import unittest
+
+
+def response(status: int, headers=None, body=None) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status
+    res.headers.update(headers or {})
+    res._content = json.dumps(body or {}).encode()
+    return res
+
+
+class DummySession:
+    # returns the scripted responses for each URL, in order
+    def __init__(self, responses):
+        self.responses = responses
+        self.sent = []
+
+    def post(self, url, json):
+        self.sent.append((url, json))
+        return self.responses[url].pop(0)
+
+
+class WebhookTest(unittest.TestCase):
+    def test_parse_single_webhook_url(self):
+        hooks = parse_webhooks(None, "https://foo", "a+b")
+        self.assertEqual([(h.url, h.subs) for h in hooks], [("https://foo", "a+b")])
+
+    def test_parse_webhooks_with_own_subreddits(self):
+        webhooks = json.dumps(
+            [{"url": "https://foo"}, {"url": "https://bar", "subreddits": "ramen"}]
+        )
+        hooks = parse_webhooks(webhooks, None, "a+b")
+        self.assertEqual(
+            [(h.url, h.subs) for h in hooks],
+            [("https://foo", "a+b"), ("https://bar", "ramen")],
+        )
+
+    def test_parse_webhooks_without_subreddits(self):
+        with self.assertRaises(Exception):
+            parse_webhooks(None, "https://foo", None)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(response(429, {"Retry-After": "2.5"})), 2.5)
+        self.assertEqual(retry_after(response(429, body={"retry_after": 0.5})), 0.5)
+
+    def test_deliver_retries_when_rate_limited(self):
+        session = DummySession(
+            {"https://foo": [response(429, {"Retry-After": "0"}), response(204)]}
+        )
+        result = deliver(session, "https://foo", {"foo": "bar"})
+        self.assertEqual(result.status_code, 204)
+        self.assertEqual(len(session.sent), 2)
+
+    def test_deliver_gives_up(self):
+        limited = [response(429, {"Retry-After": "0"}) for _ in range(3)]
+        session = DummySession({"https://foo": limited})
+        with self.assertRaises(requests.HTTPError):
+            deliver(session, "https://foo", {}, max_attempts=3)
+
+    def test_deliver_all_isolates_failures(self):
+        session = DummySession(
+            {"https://foo": [response(500)], "https://bar": [response(204)]}
+        )
+        errors = deliver_all(
+            session,
+            [{"url": "https://foo", "data": {}}, {"url": "https://bar", "data": {}}],
+        )
+        self.assertIsInstance(errors[0], requests.HTTPError)
+        self.assertIsNone(errors[1])
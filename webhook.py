@@ -0,0 +1,129 @@
+from concurrent.futures import ThreadPoolExecutor
+from metrics import METRICS
+from typing import Dict, List, Optional
+import json
+import requests
+import time
+
+
+# how many times to try a delivery that keeps getting rate limited
+MAX_ATTEMPTS = 3
+# never wait longer than this for a rate limit to reset
+MAX_RETRY_AFTER = 60.0
+
+
+class Webhook:
+    # Attributes
+    # url - the Discord webhook URL
+    # subs - the subreddits to post from, separated by +
+    # interval - minutes between posts
+    def __init__(self, url: str, subs: str, interval: int = 60):
+        self.url = url
+        self.subs = subs
+        self.interval = interval
+
+    def __repr__(self):
+        return f"Webhook({self.subs})"
+
+
+def parse_webhooks(
+    webhooks: Optional[str], webhook_url: Optional[str], subs: Optional[str]
+) -> List[Webhook]:
+    """
+    Read the webhooks to post to. WEBHOOKS is a JSON list, where each entry
+    has a "url", and optionally its own "subreddits". Entries without their
+    own subreddits use SUBREDDITS. Entries can also set how many minutes apart
+    to post with "interval", which is only used by the async runner.
+    The single WEBHOOK_URL is still supported.
+    Example:
+    [
+        {"url": "https://discord.com/api/webhooks/1/a"},
+        {"url": "https://discord.com/api/webhooks/2/b", "subreddits": "ramen"},
+        {"url": "https://discord.com/api/webhooks/3/c", "interval": 30}
+    ]
+    @param webhooks the WEBHOOKS environment variable
+    @param webhook_url the WEBHOOK_URL environment variable
+    @param subs the SUBREDDITS environment variable
+    @return the configured webhooks
+    """
+    entries = json.loads(webhooks) if webhooks else []
+    if webhook_url:
+        entries.append({"url": webhook_url})
+
+    hooks = []
+    for entry in entries:
+        hook_subs = entry.get("subreddits") or subs
+        if hook_subs is None:
+            raise Exception(f"No subreddits defined for webhook {entry['url']}")
+        hooks.append(Webhook(entry["url"], hook_subs, entry.get("interval", 60)))
+    return hooks
+
+
+def deliver(
+    session: requests.Session, url: str, data: Dict, max_attempts: int = MAX_ATTEMPTS
+) -> requests.Response:
+    """
+    Post a payload to a Discord webhook. If Discord rate limits the
+    request, wait for as long as it asks before trying again.
+    https://discord.com/developers/docs/topics/rate-limits
+    @param session the session to send the request with
+    @param url the webhook URL
+    @param data the JSON payload
+    @param max_attempts give up after this many rate limited responses
+    @return the successful response
+    """
+    for attempt in range(1, max_attempts + 1):
+        with METRICS.timer("webhook_delivery"):
+            result = session.post(url=url, json=data)
+        METRICS.incr("webhook_responses", code=result.status_code)
+        if result.status_code != 429 or attempt == max_attempts:
+            break
+        wait = min(retry_after(result), MAX_RETRY_AFTER)
+        print(f"Rate limited by Discord, retrying in {wait} seconds")
+        time.sleep(wait)
+    result.raise_for_status()
+    return result
+
+
+def deliver_all(
+    session: requests.Session, deliveries: List[Dict], workers: int = 4
+) -> List[Optional[Exception]]:
+    """
+    Deliver payloads to several webhooks at once. A failure for one
+    webhook doesn't stop the others.
+    @param session the session to send the requests with
+    @param deliveries list of {"url": ..., "data": ...} to deliver
+    @param workers max number of deliveries in flight at once
+    @return for each delivery, None if it succeeded, or the exception if not
+    """
+
+    def send(delivery: Dict) -> Optional[Exception]:
+        try:
+            result = deliver(session, delivery["url"], delivery["data"])
+            print(f"Payload delivered successfully, code {result.status_code}.")
+            return None
+        except Exception as e:
+            print(f"Failed to deliver payload: {repr(e)}")
+            return e
+
+    if len(deliveries) < 1:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(deliveries)))) as pool:
+        return list(pool.map(send, deliveries))
+
+
+def retry_after(result: requests.Response) -> float:
+    """
+    Discord sends how long to wait in the Retry-After header, and as
+    "retry_after" in the JSON body, both in seconds.
+    """
+    header = result.headers.get("Retry-After")
+    if header is not None:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    try:
+        return float(result.json().get("retry_after", 1.0))
+    except (ValueError, AttributeError):
+        return 1.0